@@ -0,0 +1 @@
+"""Benchmark suite of phm, see bench_pipeline."""
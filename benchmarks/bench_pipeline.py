@@ -0,0 +1,248 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+pipeline benchmark module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Timings of the pipeline stages on synthetic data, compared with a baseline.
+
+The suite is written in the asv style (`time_*` and `track_*` methods of a
+parameterized class), so `asv run` picks it up. Without asv, run it from the
+repository root, no network is needed::
+
+    python -m benchmarks.bench_pipeline              # compare with baseline.json
+    python -m benchmarks.bench_pipeline --save       # store a new baseline
+    python -m benchmarks.bench_pipeline --sizes 8 32 --repeat 5
+
+The exit code is 1 if any timing is slower than `--tolerance` times its
+baseline or any tracked result drifts from its baseline.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import os
+import sys
+import json
+import shutil
+import atexit
+import logging
+import platform
+import argparse
+import tempfile
+import functools
+import threading
+import timeit
+import warnings
+import numpy as np
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from sklearn.metrics import euclidean_distances
+import phm.phm as phm
+from phm.modules import resultcache, utils
+from phm.vibration import cluster, mds
+from benchmarks import synthetic
+
+SIZES = [8, 32, 128]    # snapshots of each of the three runs
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+TOLERANCE = 1.5         # slowdown factor reported as a regression
+TRACKRTOL = {           # relative tolerance of the tracked results
+    'track_spectrum_sum': 1e-6,
+    'track_cluster_count': 0,
+    'track_mds_stress': 0.05,   # deterministic start, the rest is floating point noise of the blas
+    'track_fre2mds_points': 0,
+}
+LOWER = ['track_mds_stress']    # tracked results where a lower value is never a regression
+SAMPLERATE = 20480
+NPERSEG = 2048
+
+datasets_ = {}
+servers_ = {}
+
+
+def dataset(files):
+    """
+    Synthetic baseline of three runs and one obj file served over http,
+    generated once per process and size.
+    """
+    if files not in datasets_:
+        tmp = tempfile.mkdtemp(prefix='phm-bench-')
+        atexit.register(shutil.rmtree, tmp, True)
+        bench = os.path.join(tmp, 'baseline/')
+        remote = os.path.join(tmp, 'remote/')
+        names = synthetic.make_dataset(bench, files)
+        os.makedirs(remote)
+        rng = np.random.default_rng(files)
+        sig = synthetic.bearing_signal(SAMPLERATE, 0.9, 'inner', 0, synthetic.GAINS[1], rng=rng)  # late inner race
+        synthetic.write_ims(remote, 'obj', sig)
+        datasets_[files] = {'tmp': tmp, 'bench': bench, 'remote': remote, 'names': names}
+    return datasets_[files]
+
+
+def serve(path):
+    """
+    Url of `path` on a local http server serving its directory only,
+    started once per process and directory.
+    """
+    dirname, name = os.path.split(os.path.abspath(path))
+    if dirname not in servers_:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(SimpleHTTPRequestHandler, directory=dirname))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        atexit.register(server.shutdown)
+        servers_[dirname] = server
+    return f'http://127.0.0.1:{servers_[dirname].server_address[1]}/{name}'
+
+
+class PipelineSuite:
+    params = SIZES
+    param_names = ['files']
+    timeout = 600
+
+    def setup(self, files):
+        data = dataset(files)
+        self.bench_ = data['bench']
+        self.names_ = data['names']
+        self.tmp_ = data['tmp']
+        self.datumn_ = [utils.load_dat(name, self.bench_)[0] for name in self.names_]
+        fre, self.spectrum_ = cluster.ts2fft(self.datumn_, SAMPLERATE, NPERSEG)
+        self.url_ = serve(os.path.join(data['remote'], 'obj'))
+        self.cache_ = os.path.join(self.tmp_, 'data/')
+        self.store_ = os.path.join(self.tmp_, 'store/')
+        phm.fre2mds(self.url_, self.bench_, self.cache_, self.store_)  # baseline store and wave cache warm
+
+    def time_load_dat(self, files):
+        for name in self.names_:
+            utils.load_dat(name, self.bench_)
+
+    def time_ts2fft(self, files):
+        cluster.ts2fft(self.datumn_, SAMPLERATE, NPERSEG)
+
+    def time_cluster_vectors(self, files):
+        cluster.cluster_vectors(self.spectrum_)
+
+    def time_compute_mds_pos(self, files):
+        mds.compute_mds_pos(self.spectrum_)
+
+    def time_fre2mds(self, files):
+        resultcache.caches_.clear()  # the obj file is transformed and placed each time
+        phm.fre2mds(self.url_, self.bench_, self.cache_, self.store_)
+
+    def track_spectrum_sum(self, files):
+        return float(self.spectrum_.sum())
+
+    def track_cluster_count(self, files):
+        clusterer, df = cluster.cluster_vectors(self.spectrum_)
+        return int(clusterer.labels_.max() + 1)
+
+    def track_mds_stress(self, files):
+        """Kruskal stress-1 of the MDS configuration."""
+        dis = euclidean_distances(self.spectrum_)
+        pos = mds.compute_mds_pos(self.spectrum_)
+        return float(np.sqrt(((dis - euclidean_distances(pos)) ** 2).sum() / (dis ** 2).sum()))
+
+    def track_fre2mds_points(self, files):
+        resultcache.caches_.clear()
+        out = phm.fre2mds(self.url_, self.bench_, self.cache_, self.store_)
+        return len(json.loads(out)['shape'])
+
+
+def run(sizes=SIZES, repeat=3):
+    """
+    Run the suite without asv.
+
+    Returns
+    -------
+    out : dict
+        `{"<method>[<files>]": value}`, the best of `repeat` runs in seconds
+        for the timings, the value for the tracked results.
+    """
+    out = {}
+    suite = PipelineSuite()
+    methods = sorted(el for el in dir(suite) if el.startswith(('time_', 'track_')))
+    for files in sizes:
+        suite.setup(files)
+        for method in methods:
+            fn = functools.partial(getattr(suite, method), files)
+            if method.startswith('time_'):
+                value = min(timeit.repeat(fn, number=1, repeat=repeat))
+            else:
+                value = fn()
+            out[f'{method}[{files}]'] = value
+            logging.info(f'{method}[{files}]: {value:.6g}')
+    return out
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """
+    Regressions of the results against the baseline.
+
+    Returns
+    -------
+    out : list
+        A message of each timing slower than `tolerance` times its baseline
+        and each tracked result out of its `TRACKRTOL`.
+    """
+    out = []
+    for key, value in results.items():
+        if key not in baseline:
+            continue
+        ref = baseline[key]
+        method = key.split('[')[0]
+        if method.startswith('time_') and value > tolerance * ref:
+            out.append(f'{key}: {value:.4f}s is {value / ref:.2f}x of the baseline {ref:.4f}s')
+        elif method.startswith('track_') and not np.isclose(value, ref, rtol=TRACKRTOL.get(method, 1e-6), atol=0):
+            if method not in LOWER or value > ref:
+                out.append(f'{key}: {value} differs from the baseline {ref}')
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the PHM pipeline on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='snapshots of each run')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of each timing, the best one is kept')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='slowdown reported as a regression')
+    parser.add_argument('--baseline', default=BASELINE, help='json file of the stored baseline')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    warnings.simplefilter('ignore')  # library deprecations would bury the table
+
+    results = run(args.sizes, args.repeat)
+    for key, value in results.items():
+        print(f'{key:40s} {value:.6g}')
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': platform.platform(), 'python': platform.python_version(),
+                       'results': results}, f, indent=2, sort_keys=True)
+        print(f'Baseline saved: {args.baseline}')
+        return 0
+    if not os.path.isfile(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save first.')
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for msg in regressions:
+        print(f'REGRESSION {msg}')
+    print(f'{len(results)} benchmarks, {len(regressions)} regressions against {baseline["machine"]}.')
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
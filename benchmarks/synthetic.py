@@ -0,0 +1,131 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+synthetic module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+IMS like run-to-failure vibration files with injected bearing faults.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import os
+import numpy as np
+from datetime import datetime, timedelta
+
+SAMPLERATE = 20480          # IMS files are 1 second snapshots at 20 kHz
+CHANNELS = 8                # two accelerometers on each of the four bearings
+SHAFT = 2000 / 60           # shaft frequency in Hz, 2000 rpm
+RESONANCE = 4000            # structural resonance excited by the defect impacts
+FAULTS = {                  # defect frequencies in Hz of the Rexnord ZA-2115 bearing
+    'outer': 236.4,
+    'inner': 296.9,
+    'ball': 279.8,
+}
+START = datetime(2003, 10, 22, 12, 6, 24)
+INTERVAL = timedelta(minutes=10)
+ONSET = 0.6                 # part of the life before the defect starts to grow
+GAINS = [1.0, 1.5, 2.2]     # sensor gain of each run, the runs are separate clusters as in IMS
+
+
+def bearing_signal(points, age, fault='outer', bearing=2, gain=1.0, samplerate=SAMPLERATE, rng=None):
+    """
+    Synthesize one snapshot of the eight channels.
+
+    Parameters
+    ----------
+    points : int
+        Sample points of each channel.
+    age : float
+        Part of the life from 0 (new) to 1 (failure). The fault harmonics
+        and impacts appear at `ONSET` and grow quadratically until failure,
+        the noise floor grows linearly over the whole life.
+    fault : string
+        Defect of the faulty bearing, a key of `FAULTS`, None for a healthy
+        machine.
+    bearing : int
+        Index of the faulty bearing, its two channels carry the fault.
+    gain : float
+        Sensitivity of the sensors, the setup of a test rig.
+
+    Returns
+    -------
+    out : 2-D array
+        (points, 8) signal.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    t = np.arange(points) / samplerate
+    base = 0.05 * np.sin(2 * np.pi * SHAFT * t) + 0.02 * np.sin(2 * np.pi * 2 * SHAFT * t)  # imbalance
+    sig = base[:, None] + (0.05 + 0.1 * age) * rng.standard_normal((points, CHANNELS))
+    if fault is not None:
+        freq = FAULTS[fault]
+        severity = (max(0., age - ONSET) / (1 - ONSET)) ** 2
+        harmonics = sum(0.5 / k * np.sin(2 * np.pi * k * freq * t + rng.uniform(0, 2 * np.pi)) for k in range(1, 5))
+        phase = t % (1 / freq)  # time since the last impact
+        impacts = np.exp(-800 * phase) * np.sin(2 * np.pi * RESONANCE * phase)
+        if fault == 'inner':  # modulated by the load zone once per revolution
+            impacts *= 0.5 * (1 + np.cos(2 * np.pi * SHAFT * t))
+        sig[:, 2 * bearing: 2 * bearing + 2] += (severity * (0.3 * harmonics + impacts))[:, None]
+    return gain * sig
+
+
+def write_ims(path, name, sig):
+    """
+    Write a snapshot as an IMS text file, channels separated by tab.
+    """
+    np.savetxt(os.path.join(path, name), sig, fmt='%.3f', delimiter='\t')
+
+
+def make_run(path, files, points=SAMPLERATE, fault='outer', bearing=2, gain=1.0, start=START, seed=0):
+    """
+    Write a run-to-failure test of `files` snapshots, 10 minutes apart.
+
+    Returns
+    -------
+    out : list
+        File names in time order, named by their timestamp as IMS does.
+    """
+    rng = np.random.default_rng(seed)
+    names = []
+    for idx in range(files):
+        name = (start + idx * INTERVAL).strftime('%Y.%m.%d.%H.%M.%S')
+        age = idx / max(1, files - 1)
+        write_ims(path, name, bearing_signal(points, age, fault, bearing, gain, rng=rng))
+        names.append(name)
+    return names
+
+
+def make_dataset(path, files, points=SAMPLERATE, runs=('outer', 'inner', 'ball'), bearing=0, seed=0):
+    """
+    Write one run-to-failure test of each fault into `path`, the fault is
+    on the first bearing by default, whose channels `utils.load_dat` reads.
+
+    Returns
+    -------
+    out : list
+        File names of all the runs, runs one after another.
+    """
+    os.makedirs(path, exist_ok=True)
+    names = []
+    for idx, fault in enumerate(runs):
+        start = START + timedelta(days=40 * idx)
+        names += make_run(path, files, points, fault, bearing, GAINS[idx % len(GAINS)], start, seed + idx)
+    return names
@@ -7,3 +7,7 @@ __version__ = '0.1.0'
 
 # BENCHPATH = '../data/'
 BENCHPATH = '../../phm-model/data/baseline'
+
+# Heavy scientific and plotting packages, imported inside the functions using
+# them, so the mqtt and rest processes start without them.
+LAZY = ['pandas', 'scipy', 'sklearn', 'hdbscan', 'matplotlib', 'adjustText']
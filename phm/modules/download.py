@@ -0,0 +1,90 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+download module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Pooled http session and streamed downloads of the wave files.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import os
+import tempfile
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+POOLSIZE = 16           # keep-alive connections per host
+RETRIES = 3             # retries of connect errors and 5xx responses
+TIMEOUT = (5, 60)       # connect and read timeout in seconds
+CHUNKSIZE = 1 << 16     # bytes written per chunk
+PARTDIR = '.part/'      # sub directory of the local dir for partial downloads
+
+session_ = None
+pid_ = None
+
+
+def get_session():
+    """
+    The pooled session of this process, created at the first call.
+    """
+    global session_, pid_
+    if session_ is None or pid_ != os.getpid():  # never share sockets with a forked parent.
+        retry = Retry(total=RETRIES, backoff_factor=0.5, status_forcelist=[500, 502, 503, 504],
+                      allowed_methods=['GET'])
+        adapter = HTTPAdapter(pool_connections=POOLSIZE, pool_maxsize=POOLSIZE, max_retries=retry)
+        session_ = requests.Session()
+        session_.mount('http://', adapter)
+        session_.mount('https://', adapter)
+        pid_ = os.getpid()
+    return session_
+
+
+def download_file(url, local, timeout=TIMEOUT):
+    """
+    Stream the url into a local file.
+
+    The body is written chunk by chunk into a temporary file under
+    `PARTDIR`, which is renamed to `local` when complete, so readers never
+    see a partial file.
+
+    Returns
+    -------
+    out : int
+        http status code, the file is written only if it is 200.
+    """
+    localdir = os.path.dirname(local)
+    partdir = os.path.join(localdir, PARTDIR)
+    os.makedirs(partdir, exist_ok=True)
+    with get_session().get(url, stream=True, timeout=timeout) as r:
+        if r.status_code != 200:
+            return r.status_code
+        fd, tmp = tempfile.mkstemp(dir=partdir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in r.iter_content(chunk_size=CHUNKSIZE):
+                    f.write(chunk)
+            os.replace(tmp, local)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return r.status_code
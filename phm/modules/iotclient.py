@@ -0,0 +1,168 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+iot client module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Streaming telemetry client of the iot platform (ThingsBoard).
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import json
+import time
+import base64
+from phm.modules import download, utils
+
+LIMIT = 2500                # points per key of one request, the platform default
+SLICE = 24 * 3600 * 1000    # ms of a time slice requested at once
+TOKENTTL = 900              # seconds a token is trusted when it carries no exp claim
+
+clients_ = {}
+
+
+def token_expiry(token):
+    """
+    Expiry (epoch seconds) of a jwt token, None if it can not be decoded.
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, ValueError, TypeError):
+        return None
+
+
+class IotClient:
+    """
+    Telemetry client that logs in once and reuses the token until it expires.
+    """
+
+    # Constructor
+    def __init__(self, iot, usr, pwd):
+        self.iot_ = iot
+        self.usr_ = usr
+        self.pwd_ = pwd
+        self.token_ = None
+        self.expiry_ = 0
+
+    def token(self, renew=False):
+        if renew or self.token_ is None or time.time() > self.expiry_ - 60:
+            url = f'http://{self.iot_}/api/auth/login'
+            response = download.get_session().post(url, json={'username': self.usr_, 'password': self.pwd_},
+                                                   timeout=download.TIMEOUT)
+            response.raise_for_status()
+            self.token_ = response.json()['token']
+            expiry = token_expiry(self.token_)
+            self.expiry_ = expiry if expiry is not None else time.time() + TOKENTTL
+        return self.token_
+
+    def get_timeseries(self, entitytype, entityid, keys, st, et, limit=LIMIT):
+        """
+        One request of the telemetry in [st, et], ascending.
+
+        Returns
+        -------
+        out : dict
+            `[{"ts": ts, "value": value}, ...]` of each key with data.
+        """
+        url = f'http://{self.iot_}/api/plugins/telemetry/{entitytype}/{entityid}/values/timeseries'
+        payload = {
+            'limit': f'{limit}',
+            'agg': 'NONE',
+            'orderBy': 'ASC',
+            'keys': f'{keys}',
+            'startTs': f'{st}',
+            'endTs': f'{et}'
+        }
+        for renew in (False, True):  # login again once if the token is revoked.
+            headers = {'X-Authorization': f'Bearer {self.token(renew)}'}
+            response = download.get_session().get(url, headers=headers, params=payload, timeout=download.TIMEOUT)
+            if response.status_code != 401:
+                break
+        response.raise_for_status()
+        return response.json()
+
+    def iter_timeseries(self, entitytype, entityid, keys, st, et, slice_ms=SLICE, limit=LIMIT):
+        """
+        Page through [st, et] in time slices.
+
+        A slice in which any key returns `limit` points may be truncated by
+        the platform, it is split in halves and requested again, so no point
+        is lost however long the window is.
+
+        Yields
+        ------
+        out : dict
+            Telemetry of a slice, see `get_timeseries`, slices in time order.
+        """
+        pending = [(lo, min(lo + slice_ms - 1, et)) for lo in range(st, et + 1, slice_ms)]
+        pending.reverse()
+        while len(pending) > 0:
+            lo, hi = pending.pop()
+            datumn = self.get_timeseries(entitytype, entityid, keys, lo, hi, limit)
+            if hi > lo and any(len(vals) >= limit for vals in datumn.values()):
+                mid = (lo + hi) // 2
+                pending += [(mid + 1, hi), (lo, mid)]
+                continue
+            yield datumn
+
+    def iter_frames(self, entitytype, entityid, keys, st, et, slice_ms=SLICE, limit=LIMIT):
+        """
+        Rows of [st, et], yielded as one DataFrame of each time slice.
+
+        Columns are `ts` and each key, only timestamps that all the returned
+        keys have are kept (inner join), the values are not converted.
+        """
+        for datumn in self.iter_timeseries(entitytype, entityid, keys, st, et, slice_ms, limit):
+            frame = join_timeseries(datumn)
+            if frame is not None:
+                yield frame
+
+
+def join_timeseries(datumn):
+    """
+    Join the points of all keys on `ts` in one vectorized operation.
+
+    Returns
+    -------
+    out : DataFrame object
+        None if no key has data.
+    """
+    if len(datumn) == 0:
+        return None
+    pd = utils.pandas()
+    series = []
+    for key, vals in datumn.items():
+        df = pd.DataFrame.from_records(vals, columns=['ts', 'value'])
+        series.append(df.drop_duplicates('ts').set_index('ts')['value'].rename(key))
+    frame = pd.concat(series, axis=1, join='inner').sort_index()
+    frame.index.name = 'ts'
+    return frame.reset_index()
+
+
+def get_client(iot, usr, pwd):
+    """
+    The shared `IotClient` of an iot user in this process.
+    """
+    if (iot, usr, pwd) not in clients_:
+        clients_[(iot, usr, pwd)] = IotClient(iot, usr, pwd)
+    return clients_[(iot, usr, pwd)]
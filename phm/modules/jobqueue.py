@@ -0,0 +1,310 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+job queue module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Compute jobs drained by a pool of worker processes, status kept in sqlite.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import os
+import json
+import functools
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+import traceback
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from phm.modules import metrics
+
+JOBDB = '.cache/jobs.db'    # sqlite file shared by the rest process and the workers
+WORKERS = 2                 # compute worker processes
+DEVICEKEYS = ['iot', 'entitytype', 'entityid', 'entityids', 'keys', 'obj']   # params naming the computation of a device
+TIMEOUT = 30                # seconds to wait for the sqlite lock
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def jsonconverter(o):
+    if hasattr(o, 'item'):      # numpy scalars
+        return o.item()
+    if hasattr(o, 'isoformat'):
+        return o.isoformat()
+    return str(o)
+
+
+class JobStore:
+    """
+    Status and results of the jobs, one row each in table `jobs`.
+
+    Every process opens its own store on the same file, so the rest
+    process reports the jobs the workers are running. Within a process the
+    connection is shared by the submitting and the callback threads, each
+    use holds `lock_`.
+    """
+
+    # Constructor
+    def __init__(self, dbpath=JOBDB):
+        dirname = os.path.dirname(dbpath)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.lock_ = threading.Lock()
+        self.db_ = sqlite3.connect(dbpath, timeout=TIMEOUT, check_same_thread=False)
+        self.db_.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, status TEXT, command TEXT, result TEXT, error TEXT,
+            created REAL, started REAL, finished REAL)''')
+        self.db_.commit()
+
+    def create(self, command):
+        """
+        Record a queued job.
+
+        Returns
+        -------
+        out : string
+            The job id.
+        """
+        jobid = uuid.uuid4().hex
+        command = json.dumps(command, default=jsonconverter)
+        with self.lock_:
+            self.db_.execute('INSERT INTO jobs (id, status, command, created) VALUES (?, ?, ?, ?)',
+                             (jobid, QUEUED, command, time.time()))
+            self.db_.commit()
+        return jobid
+
+    def start(self, jobid):
+        with self.lock_:
+            self.db_.execute('UPDATE jobs SET status = ?, started = ? WHERE id = ?', (RUNNING, time.time(), jobid))
+            self.db_.commit()
+
+    def finish(self, jobid, result):
+        result = json.dumps(result, default=jsonconverter)
+        with self.lock_:
+            self.db_.execute('UPDATE jobs SET status = ?, result = ?, finished = ? WHERE id = ?',
+                             (DONE, result, time.time(), jobid))
+            self.db_.commit()
+
+    def fail(self, jobid, error):
+        with self.lock_:
+            self.db_.execute('UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?',
+                             (FAILED, error, time.time(), jobid))
+            self.db_.commit()
+
+    def get(self, jobid, result=False):
+        """
+        Status of a job, with its result if asked.
+
+        Returns
+        -------
+        out : dict
+            `id`, `status`, `error`, `created`, `started`, `finished` and
+            `result` if asked, None if the job is unknown.
+        """
+        with self.lock_:
+            row = self.db_.execute('SELECT id, status, error, created, started, finished, result FROM jobs '
+                                   'WHERE id = ?', (jobid,)).fetchone()
+        if row is None:
+            return None
+        out = dict(zip(['id', 'status', 'error', 'created', 'started', 'finished'], row[:6]))
+        if result:
+            out['result'] = None if row[6] is None else json.loads(row[6])
+        return out
+
+
+def run_job(dbpath, jobid, fn, *args):
+    """
+    Run a job in a worker process, its status is recorded in the store.
+    """
+    store = JobStore(dbpath)
+    store.start(jobid)
+    try:
+        result = fn(*args)
+    except Exception:
+        store.fail(jobid, traceback.format_exc())
+        raise
+    store.finish(jobid, result)
+    return result
+
+
+class JobQueue:
+    """
+    Jobs submitted in order and drained by `workers` processes, so long
+    computations of different devices run side by side.
+    """
+
+    # Constructor
+    def __init__(self, dbpath=JOBDB, workers=WORKERS):
+        self.dbpath_ = dbpath
+        self.store_ = JobStore(dbpath)
+        self.executor_ = ProcessPoolExecutor(max_workers=workers)
+
+    def submit(self, jobid, fn, *args, callback=None, profile=False):
+        """
+        Queue `fn(*args)` of a job created in the store.
+
+        Parameters
+        ----------
+        callback : callable, optional
+            `callback(jobid, result)` in this process once the job is done.
+        profile : bool
+            Dump the cProfile stats of the job, see `metrics.run_profiled`.
+        """
+        if profile or metrics.PROFILE:
+            fn = functools.partial(metrics.run_profiled, f'job-{jobid}', fn)
+        future = self.executor_.submit(run_job, self.dbpath_, jobid, fn, *args)
+
+        def done(fut):
+            err = fut.exception()
+            if err is not None:
+                logging.error(f'job {jobid} failed: {err}')
+                if self.store_.get(jobid)['status'] != FAILED:  # e.g. the worker died.
+                    self.store_.fail(jobid, repr(err))
+            elif callback is not None:
+                callback(jobid, fut.result())
+
+        future.add_done_callback(done)
+        return future
+
+    def shutdown(self, wait=True):
+        self.executor_.shutdown(wait=wait)
+
+
+def clip_rows(result, st, et):
+    """
+    Rows of `result` with `ts` in [st, et], a list of rows or a dict of them.
+    """
+    if isinstance(result, dict):
+        return {key: clip_rows(rows, st, et) for key, rows in result.items()}
+    if result is None:
+        return None
+    return [el for el in result if st <= el['ts'] <= et]
+
+
+def window_ms(param):
+    """
+    `(st, et)` in ms of the `stime` and `etime` of a command, local time as
+    `calculate_mds_indicator` takes them.
+    """
+    return tuple(round(datetime.fromisoformat(str(param[key])).timestamp() * 1000) for key in ('stime', 'etime'))
+
+
+class CoalescingJobQueue(JobQueue):
+    """
+    Job queue merging the windows of the same device.
+
+    Jobs of a device (see `DEVICEKEYS`) whose windows overlap are evaluated
+    once: a job whose window is covered by a running evaluation attaches to
+    it, jobs waiting for a free worker are merged into one evaluation of the
+    union of their windows. Each job gets the rows of its own window.
+    """
+
+    # Constructor
+    def __init__(self, dbpath=JOBDB, workers=WORKERS):
+        super().__init__(dbpath, workers)
+        self.workers_ = workers
+        self.lock_ = threading.Condition()
+        self.pending_ = []      # groups waiting for a free worker, in arrival order
+        self.running_ = []
+        self.closed_ = False
+
+    def submit(self, jobid, fn, param, *args, callback=None):
+        """
+        Queue `fn(param, *args)` of a job created in the store.
+
+        Parameters
+        ----------
+        param : dict
+            Command with `stime`, `etime` and the `DEVICEKEYS`, the
+            evaluation is profiled if any merged command has `profile`.
+        callback : callable, optional
+            `callback(jobids, result)` once an evaluation is done, with the
+            ids of all the jobs it served and the result of the union window.
+        """
+        key = tuple(param.get(el) for el in DEVICEKEYS)
+        st, et = window_ms(param)
+        with self.lock_:
+            for grp in self.running_:
+                if grp['key'] == key and grp['fn'] == fn and grp['st'] <= st and et <= grp['et']:
+                    grp['waiters'].append((jobid, st, et))
+                    self.store_.start(jobid)
+                    return
+            for grp in self.pending_:
+                if grp['key'] == key and grp['fn'] == fn and st <= grp['et'] and grp['st'] <= et:
+                    grp['waiters'].append((jobid, st, et))
+                    grp['param']['profile'] = grp['param'].get('profile') or param.get('profile')
+                    if st < grp['st']:
+                        grp['st'], grp['param']['stime'] = st, param['stime']
+                    if et > grp['et']:
+                        grp['et'], grp['param']['etime'] = et, param['etime']
+                    return
+            self.pending_.append({'key': key, 'fn': fn, 'param': dict(param), 'args': args, 'st': st, 'et': et,
+                                  'waiters': [(jobid, st, et)], 'callback': callback})
+            self._dispatch()
+
+    def _dispatch(self):
+        while len(self.pending_) > 0 and len(self.running_) < self.workers_ and not self.closed_:
+            grp = self.pending_.pop(0)
+            self.running_.append(grp)
+            for jobid, st, et in grp['waiters']:
+                self.store_.start(jobid)
+            fn = grp['fn']
+            if grp['param'].get('profile') or metrics.PROFILE:
+                fn = functools.partial(metrics.run_profiled, f'job-{grp["waiters"][0][0]}', fn)
+            future = self.executor_.submit(fn, grp['param'], *grp['args'])
+            future.add_done_callback(functools.partial(self._done, grp))
+
+    def _done(self, grp, future):
+        err = future.exception()
+        result = None if err is not None else future.result()
+        with self.lock_:  # the store is written by `submit` and `_dispatch` under the same lock
+            self.running_.remove(grp)
+            waiters = list(grp['waiters'])
+            for jobid, st, et in waiters:
+                if err is not None:
+                    self.store_.fail(jobid, repr(err))
+                else:
+                    self.store_.finish(jobid, clip_rows(result, st, et))
+            self._dispatch()
+            self.lock_.notify_all()
+        if err is not None:
+            logging.error(f'jobs {[el[0] for el in waiters]} failed: {err}')
+            return
+        if grp['callback'] is not None:
+            grp['callback']([el[0] for el in waiters], result)
+
+    def shutdown(self, wait=True):
+        with self.lock_:
+            if wait:  # drain the merged jobs too, they are submitted as workers become free.
+                self.lock_.wait_for(lambda: len(self.pending_) == 0 and len(self.running_) == 0)
+            self.closed_ = True
+            for grp in self.pending_:
+                for jobid, st, et in grp['waiters']:
+                    self.store_.fail(jobid, 'Service is shut down.')
+            self.pending_ = []
+        super().shutdown(wait)
@@ -0,0 +1,213 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+metrics module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Stage timing, profiling and prometheus exposition of the pipeline.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import os
+import json
+import time
+import cProfile
+import functools
+import threading
+from multiprocessing import util
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
+
+METRICSDIR = None                # snapshot of each process, merged by `collect`, None keeps them in memory
+DUMPINTERVAL = 10.0              # seconds between two snapshots of a process, the last one is written at exit
+PROFILEDIR = '.cache/profiles/'  # cProfile dumps of the profiled jobs
+PROFILE = False                  # profile every job, else only the requests asking for it
+PREFIX = 'phm_stage'             # prometheus metric name prefix
+
+FIELDS = ['calls', 'seconds', 'cpu_seconds', 'bytes', 'segments']
+PEAK = 'process_peak_bytes'      # high-water mark of the process, not of the stage
+stats_ = {}
+lock_ = threading.Lock()
+local_ = threading.local()
+dumped_ = None                   # (pid, monotonic time) of the last snapshot written by this process
+
+
+def peak_rss():
+    """
+    Peak resident memory of this process in bytes since it started, 0 if
+    unknown. It never decreases, so a stage only raises it if the process
+    never used more memory before.
+    """
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Stage:
+    """
+    Times a pipeline stage, as a context manager or a decorator.
+
+    Wall and cpu time of the calling thread, bytes and segments added with
+    `add` are accumulated per stage name, along with `PEAK`, the memory
+    high-water mark of the process when the stage last ended. Stages may
+    nest, the snapshot of the process is written to `METRICSDIR` when an
+    outermost stage ends at most every `DUMPINTERVAL` seconds, and at exit.
+
+    Examples
+    --------
+    >>> with metrics.Stage('fft') as st:
+    ...     st.add(segments=len(segs))
+    """
+
+    # Constructor
+    def __init__(self, name, nbytes=0, segments=0):
+        self.name_ = name
+        self.bytes_ = nbytes
+        self.segments_ = segments
+
+    def add(self, nbytes=0, segments=0):
+        self.bytes_ += nbytes
+        self.segments_ += segments
+
+    def __enter__(self):
+        local_.depth = getattr(local_, 'depth', 0) + 1
+        self.wall_ = time.perf_counter()
+        self.cpu_ = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall_
+        cpu = time.thread_time() - self.cpu_
+        with lock_:
+            st = stats_.setdefault(self.name_, dict.fromkeys(FIELDS + [PEAK], 0))
+            for key, val in zip(FIELDS, [1, wall, cpu, self.bytes_, self.segments_]):
+                st[key] += val
+            st[PEAK] = max(st[PEAK], peak_rss())
+        local_.depth -= 1
+        if local_.depth == 0:
+            dump_due()
+        return False
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with Stage(self.name_, self.bytes_, self.segments_):
+                return fn(*args, **kwargs)
+        return wrapper
+
+
+def snapshot():
+    with lock_:
+        return {name: dict(st) for name, st in stats_.items()}
+
+
+def dump_due():
+    """
+    Write the snapshot if the last one of this process is older than
+    `DUMPINTERVAL`, the first one also registers the write at exit.
+    """
+    global dumped_
+    if not METRICSDIR:
+        return
+    now = time.monotonic()
+    with lock_:
+        if dumped_ is not None and dumped_[0] == os.getpid() and now - dumped_[1] < DUMPINTERVAL:
+            return
+        if dumped_ is None or dumped_[0] != os.getpid():
+            # runs at exit of the main and the worker processes, these skip the atexit handlers.
+            util.Finalize(None, dump, exitpriority=0)
+        dumped_ = (os.getpid(), now)
+    dump()
+
+
+def dump(path=None):
+    """
+    Write the snapshot of this process into `METRICSDIR` atomically.
+    """
+    path = METRICSDIR if path is None else path
+    if not path:
+        return
+    os.makedirs(path, exist_ok=True)
+    tmp = f'{path}.{os.getpid()}.json.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(tmp, f'{path}{os.getpid()}.json')
+
+
+def collect(path=None):
+    """
+    Merge the snapshots of all processes, counters are summed and the peak
+    memory is the max of the processes.
+    """
+    path = METRICSDIR if path is None else path
+    snaps = []
+    if path and os.path.isdir(path):
+        for item in sorted(os.listdir(path)):
+            if item.endswith('.json') and item != f'{os.getpid()}.json':
+                try:
+                    with open(f'{path}{item}') as f:
+                        snaps.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+    snaps.append(snapshot())
+    out = {}
+    for snap in snaps:
+        for name, st in snap.items():
+            merged = out.setdefault(name, dict.fromkeys(FIELDS + [PEAK], 0))
+            for key in FIELDS:
+                merged[key] += st.get(key, 0)
+            merged[PEAK] = max(merged[PEAK], st.get(PEAK, 0))
+    return out
+
+
+def exposition(stats=None):
+    """
+    Prometheus text exposition of the stage metrics.
+    """
+    stats = collect() if stats is None else stats
+    helps = {'calls': ('counter', 'Times the stage is run.'),
+             'seconds': ('counter', 'Wall time spent in the stage.'),
+             'cpu_seconds': ('counter', 'Cpu time of the thread running the stage.'),
+             'bytes': ('counter', 'Bytes processed by the stage.'),
+             'segments': ('counter', 'Signal segments processed by the stage.'),
+             PEAK: ('gauge', 'High-water mark of the resident memory of the processes running the stage.')}
+    lines = []
+    for key, (kind, desc) in helps.items():
+        name = f'{PREFIX}_{key}' + ('_total' if kind == 'counter' else '')
+        lines += [f'# HELP {name} {desc}', f'# TYPE {name} {kind}']
+        lines += [f'{name}{{stage="{stage}"}} {st[key]}' for stage, st in sorted(stats.items())]
+    return '\n'.join(lines) + '\n'
+
+
+def run_profiled(name, fn, *args, **kwargs):
+    """
+    Call `fn` under cProfile, stats are dumped into `PROFILEDIR` as
+    `<name>-<ns>-<pid>.prof`, see `pstats` or snakeviz to read them.
+    """
+    os.makedirs(PROFILEDIR, exist_ok=True)
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        profiler.dump_stats(f'{PROFILEDIR}{name}-{time.time_ns()}-{os.getpid()}.prof')
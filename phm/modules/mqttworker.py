@@ -27,30 +27,30 @@ Exploring->Clustering->MDS->Predicting.
 # Author: Awen <26896225@qq.com>
 # License: MIT
 
+import json
 import logging
-import paho.mqtt.client as mqtt
+import functools
+from phm.modules import metrics, publisher, sharedarray, subscriber
 
 
 class MqttCliDaemon:
-    topic_ = 'v1/devices/me/telemetry'
-    client_ = None
+    publisher_ = None
     pipe_ = None
 
     # Constructor
-    def __init__(self, pipe, clientid, host, port=1883, keepalive=60):
+    def __init__(self, pipe, clientid, host, port=1883, keepalive=60, interval=publisher.INTERVAL,
+                 batchsize=publisher.BATCHSIZE, inflight=publisher.INFLIGHT):
         self.pipe_ = pipe
-        self.client_ = mqtt.Client()
-        self.client_.username_pw_set(clientid)
-        self.client_.connect(host, port, keepalive)
-        self.client_.loop_start()
+        self.publisher_ = publisher.MqttPublisher(clientid, host, port, keepalive, interval, batchsize, inflight)
 
     # De-constructor
     def __del__(self):
-        self.client_.loop_stop()
-        self.client_.disconnect()
-        self.client_ = None
-        self.pipe_.close()
-        self.pipe_ = None
+        if self.publisher_ is not None:
+            self.publisher_.close()
+            self.publisher_ = None
+        if self.pipe_ is not None:
+            self.pipe_.close()
+            self.pipe_ = None
         logging.info('Mqtt process exit.')
 
     # receive and publish data to iot
@@ -60,11 +60,64 @@ class MqttCliDaemon:
             # print(f'process:{data}')
             if data == "stop":
                 logging.info(f'close pipe and exit.')
-                self.pipe_.close()
                 break
-            # Sending data to iot
-            sensor_data = data
-            self.client_.publish(self.topic_, sensor_data, 1)
+            # Buffer the points, sent in batches by the publisher
+            self.publisher_.publish(frame_points(data))
+
+
+def frame_points(data):
+    """
+    Telemetry points of a pipe message. A message packed by `sharedarray.pack`
+    holds a `ts` column and a column of each value, others are points already.
+    """
+    msg = json.loads(data) if isinstance(data, (str, bytes)) else data
+    if not sharedarray.is_packed(msg):
+        return msg
+    cols = sharedarray.unpack_lists(msg)
+    ts = cols.pop('ts')
+    return [{'ts': el, 'values': {key: col[idx] for key, col in cols.items()}} for idx, el in enumerate(ts)]
+
+
+class MqttSubDaemon:
+    """
+    Scores each wave file announced on the broker and publishes its MDS
+    result right away, until "stop" is received on the pipe.
+    """
+
+    # Constructor
+    def __init__(self, pipe, clientid, host, scorer, port=1883, keepalive=60, topic=subscriber.TOPIC,
+                 key=subscriber.WAVEKEY):
+        self.pipe_ = pipe
+        self.scorer_ = scorer
+        self.publisher_ = publisher.MqttPublisher(clientid, host, port, keepalive)
+        self.subscriber_ = subscriber.MqttSubscriber(clientid, host, self.score, port, keepalive, [topic], key=key)
+
+    # De-constructor
+    def __del__(self):
+        if self.subscriber_ is not None:
+            self.subscriber_.close()
+            self.subscriber_ = None
+        if self.publisher_ is not None:
+            self.publisher_.close()
+            self.publisher_ = None
+        if self.pipe_ is not None:
+            self.pipe_.close()
+            self.pipe_ = None
+        logging.info('Mqtt subscriber process exit.')
+
+    # score the arrived wave files and publish the results
+    def score(self, rows):
+        with metrics.Stage('score', segments=len(rows)):
+            ret = self.scorer_(rows)
+        points = [{'ts': el['ts'], 'values': {'MDS': el['MDS']}} for el in ret if el['MDS'] is not None]
+        if len(points) > 0:
+            self.publisher_.publish(points)
+            self.publisher_.flush()
+
+    def run(self):
+        while self.pipe_.recv() != 'stop':
+            pass
+        logging.info('close pipe and exit.')
 
 
 # 进程函数
@@ -76,3 +129,15 @@ def proc_mqtt(pi, tk, iot, port):
     except ConnectionRefusedError as cre:
         logging.info(cre)
 
+
+# 订阅进程函数，基线模型在进程启动时加载一次
+def proc_subscribe(pi, tk, iot, port, topic, bp):
+    import phm.phm as phm
+    try:
+        store = phm.load_store(bp)
+        svrobj = MqttSubDaemon(pi, tk, iot, functools.partial(phm.score_waves, bp=bp, store=store), port,
+                               topic=topic)
+        svrobj.run()
+        del svrobj
+    except ConnectionRefusedError as cre:
+        logging.info(cre)
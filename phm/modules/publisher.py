@@ -0,0 +1,210 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+publisher module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Persistent mqtt connection publishing batched telemetry to the iot platform.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import json
+import time
+import logging
+import threading
+from collections import deque
+import paho.mqtt.client as mqtt
+
+INTERVAL = 1.0      # seconds between flushes of the buffered points
+BATCHSIZE = 500     # points of one telemetry array payload
+INFLIGHT = 20       # QoS 1 messages sent and not acknowledged yet
+LATENCIES = 1024    # publish latencies kept for the statistics
+
+publishers_ = {}
+
+
+def percentile(values, q):
+    """
+    The `q`-th percentile of sorted `values`, linear as `numpy.percentile`,
+    numpy is not loaded for it in the mqtt process.
+    """
+    pos = (len(values) - 1) * q / 100
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+class MqttPublisher:
+    """
+    One long-lived mqtt connection of a device access token.
+
+    Points `{"ts": ts, "values": {...}}` are buffered and published as one
+    ThingsBoard telemetry array `[{"ts": ..., "values": ...}, ...]` when
+    `batchsize` points are buffered or every `interval` seconds. At most
+    `inflight` messages wait for their acknowledgement, `publish` blocks
+    beyond that.
+    """
+    topic_ = 'v1/devices/me/telemetry'
+
+    # Constructor
+    def __init__(self, token, host, port=1883, keepalive=60, interval=INTERVAL, batchsize=BATCHSIZE,
+                 inflight=INFLIGHT, qos=1):
+        self.interval_ = interval
+        self.batchsize_ = batchsize
+        self.qos_ = qos
+        self.points_ = []
+        self.sent_ = {}                         # mid -> time the message is sent
+        self.acked_ = {}                        # mid -> time acknowledged before `sent_` is recorded
+        self.latency_ = deque(maxlen=LATENCIES)
+        self.cond_ = threading.Condition()     # guards the buffer, wakes the flush thread on close only
+        self.acks_ = threading.Condition()     # guards the sent messages, notified on each acknowledgement
+        self.flushlock_ = threading.Lock()      # keeps the batches in order
+        self.slots_ = threading.BoundedSemaphore(inflight)
+        self.closed_ = False
+        self.client_ = mqtt.Client()
+        self.client_.username_pw_set(token)
+        self.client_.max_inflight_messages_set(inflight)
+        self.client_.on_publish = self._on_publish
+        self.client_.connect(host, port, keepalive)
+        self.client_.loop_start()
+        self.thread_ = threading.Thread(target=self._run, daemon=True)
+        self.thread_.start()
+
+    def _on_publish(self, client, userdata, mid):
+        now = time.monotonic()
+        with self.acks_:
+            if mid in self.sent_:
+                self.latency_.append(now - self.sent_.pop(mid))
+            else:
+                self.acked_[mid] = now
+            self.acks_.notify_all()
+        self.slots_.release()
+
+    def _run(self):
+        while True:
+            with self.cond_:
+                if self.cond_.wait_for(lambda: self.closed_, self.interval_):
+                    return
+            self.flush()
+
+    def publish(self, data):
+        """
+        Buffer telemetry points.
+
+        Parameters
+        ----------
+        data : dict, list or string
+            A point, a list of points or their json. A dict without `ts` is
+            taken as the values of a point stamped now.
+        """
+        if isinstance(data, (str, bytes)):
+            data = json.loads(data)
+        if isinstance(data, dict):
+            data = [data]
+        data = [el if 'ts' in el else {'ts': round(time.time() * 1000), 'values': el} for el in data]
+        with self.cond_:
+            self.points_ += data
+            full = len(self.points_) >= self.batchsize_
+        if full:
+            self.flush(partial=False)
+
+    def flush(self, wait=False, timeout=None, partial=True):
+        """
+        Publish the buffered points now.
+
+        Parameters
+        ----------
+        wait : bool
+            Block until all sent messages are acknowledged.
+        timeout : float, optional
+            Seconds to wait at most.
+        partial : bool
+            Publish the last batch even if it is not full, else it is kept
+            in the buffer until the next flush.
+
+        Returns
+        -------
+        out : bool
+            False if `wait` timed out.
+        """
+        with self.flushlock_:
+            with self.cond_:
+                cut = len(self.points_) if partial else len(self.points_) // self.batchsize_ * self.batchsize_
+                points, self.points_ = self.points_[:cut], self.points_[cut:]
+            for i in range(0, len(points), self.batchsize_):
+                payload = json.dumps(points[i:i + self.batchsize_])
+                self.slots_.acquire()
+                sent = time.monotonic()
+                info = self.client_.publish(self.topic_, payload, self.qos_)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    logging.error(f'mqtt publish error: {mqtt.error_string(info.rc)}')
+                    if info.rc != mqtt.MQTT_ERR_NO_CONN or self.qos_ == 0:  # dropped, never acknowledged.
+                        self.slots_.release()
+                        continue
+                with self.acks_:
+                    if info.mid in self.acked_:  # acknowledged before publish returned.
+                        self.latency_.append(self.acked_.pop(info.mid) - sent)
+                    else:
+                        self.sent_[info.mid] = sent
+        if not wait:
+            return True
+        with self.acks_:
+            return self.acks_.wait_for(lambda: len(self.sent_) == 0, timeout)
+
+    def latency(self):
+        """
+        Statistics of the recent publish latencies (publish to ack).
+
+        Returns
+        -------
+        out : dict
+            `count` of the messages, `mean`, `p50`, `p99` and `max` in seconds.
+        """
+        with self.acks_:
+            lat = sorted(self.latency_)
+        if len(lat) == 0:
+            return {'count': 0}
+        return {'count': len(lat), 'mean': sum(lat) / len(lat), 'p50': percentile(lat, 50),
+                'p99': percentile(lat, 99), 'max': lat[-1]}
+
+    def close(self, timeout=10):
+        """
+        Flush, wait for the acknowledgements and disconnect.
+        """
+        if not self.flush(wait=True, timeout=timeout):
+            logging.error(f'{len(self.sent_)} mqtt messages are not acknowledged.')
+        with self.cond_:
+            self.closed_ = True
+            self.cond_.notify_all()
+        self.thread_.join()
+        self.client_.loop_stop()
+        self.client_.disconnect()
+        logging.info(f'mqtt publish latency: {self.latency()}')
+
+
+def get_publisher(host, port, token, **kwargs):
+    """
+    The shared `MqttPublisher` of a device token in this process.
+    """
+    if (host, port, token) not in publishers_:
+        publishers_[(host, port, token)] = MqttPublisher(token, host, port, **kwargs)
+    return publishers_[(host, port, token)]
@@ -32,10 +32,12 @@ import psutil
 import json
 import uvicorn
 import phm as phm
+from phm.modules import jobqueue, metrics, scheduler, subscriber
 
 from datetime import datetime, timedelta
-from fastapi import FastAPI, Request
-from typing import Optional
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from typing import List, Optional
 from pydantic import BaseModel
 
 ###############################
@@ -53,6 +55,7 @@ IOTtok_ = 'ZOKriyQPgItNmPbtuxpo'                    # 设备标识 iot的access
 
 # default value for convenience
 pipe_ = None
+jobs_ = None
 # start_ = datetime.strptime('2008-05-22T20:26:31.383470+08:00', '%Y-%m-%dT%X.%f%z')
 start_ = datetime.fromtimestamp(1209820000)  # 1209820400000(python is based on second while js is ms)
 # start_ = datetime.strftime(start_, '%Y-%m-%dT%X.%f%z')
@@ -80,6 +83,16 @@ class ComboIndicatorItem(BaseModel):
     port: Optional[int] = IOTmqpt_
 
     keys: str = 'wave_url,MDS'
+    profile: bool = False               # 是否输出本次计算的cProfile记录
+
+
+class FleetIndicatorItem(ComboIndicatorItem):
+    entityids: List[str] = [IOTdev_]    # 设备标识列表，取代entityid
+
+
+class ScheduleItem(FleetIndicatorItem):
+    tokens: List[str] = [IOTtok_]                 # 各设备的access token，与entityids对应
+    interval: float = scheduler.INTERVAL          # 评估周期，秒
 
 
 class MqttItem(BaseModel):
@@ -88,6 +101,10 @@ class MqttItem(BaseModel):
     port: Optional[int] = IOTmqpt_
 
 
+class SubscribeItem(MqttItem):
+    topic: str = subscriber.TOPIC                 # 波形文件地址所在的主题
+
+
 def self_kill():
     process = psutil.Process(os.getpid())
     parent = process.parent()
@@ -103,6 +120,13 @@ def defaultconverter(o):
         return o.isoformat()  # __str__()
 
 
+def get_jobs():
+    global jobs_
+    if jobs_ is None:
+        jobs_ = jobqueue.JobStore()
+    return jobs_
+
+
 # receive and publish data to iot
 def run(pt):
     uvicorn.run(app_, host="0.0.0.0", port=pt)
@@ -126,8 +150,59 @@ async def comboindicator(item: ComboIndicatorItem):
     cmd = item.dict()
     # FIXME:要检查是否传入合适的obj,src,stime,etime
     cmd['command'] = 'comboindicator'
+    cmd['jobid'] = get_jobs().create(cmd)
     pipe_.send(json.dumps(cmd, default=defaultconverter))
-    return {"status": "Command completed successfully."}
+    return {"status": "Command is queued.", "jobid": cmd['jobid']}
+
+
+@app_.post("/api/fleetindicator")
+async def fleetindicator(item: FleetIndicatorItem):
+    cmd = item.dict()
+    cmd['command'] = 'fleetindicator'
+    cmd['jobid'] = get_jobs().create(cmd)
+    pipe_.send(json.dumps(cmd, default=defaultconverter))
+    return {"status": "Command is queued.", "jobid": cmd['jobid']}
+
+
+@app_.post("/api/schedule")
+async def schedule(item: ScheduleItem):
+    cmd = item.dict()
+    if len(cmd['tokens']) != len(cmd['entityids']):
+        raise HTTPException(status_code=422, detail='Each of entityids needs its token.')
+    cmd['command'] = 'schedule'
+    pipe_.send(json.dumps(cmd, default=defaultconverter))
+    return {"status": "Devices are scheduled, only new telemetry is scored on each tick."}
+
+
+@app_.post("/api/unschedule")
+async def unschedule(item: FleetIndicatorItem):
+    cmd = item.dict()
+    cmd['command'] = 'unschedule'
+    pipe_.send(json.dumps(cmd, default=defaultconverter))
+    return {"status": "Devices are unscheduled."}
+
+
+@app_.get("/metrics", response_class=PlainTextResponse)
+async def stagemetrics():
+    return metrics.exposition()
+
+
+@app_.get("/api/jobs/{jobid}")
+async def jobstatus(jobid: str):
+    job = get_jobs().get(jobid)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'Job {jobid} is not found.')
+    return job
+
+
+@app_.get("/api/jobs/{jobid}/result")
+async def jobresult(jobid: str):
+    job = get_jobs().get(jobid, result=True)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f'Job {jobid} is not found.')
+    if job['status'] != jobqueue.DONE:
+        raise HTTPException(status_code=409, detail=f'Job {jobid} is {job["status"]}.')
+    return job
 
 
 # @app_.post("/api/setupmqtt")
@@ -139,6 +214,22 @@ async def setupmqtt(item: MqttItem):
     return {"status": "Command completed successfully."}
 
 
+@app_.post("/api/subscribe")
+async def subscribe(item: SubscribeItem):
+    cmd = item.dict()
+    cmd['command'] = 'subscribe'
+    pipe_.send(json.dumps(cmd))
+    return {"status": "Command is sent, wave files are scored on arrival."}
+
+
+@app_.post("/api/unsubscribe")
+async def unsubscribe(item: MqttItem):
+    cmd = item.dict()
+    cmd['command'] = 'unsubscribe'
+    pipe_.send(json.dumps(cmd))
+    return {"status": "Command is sent."}
+
+
 @app_.post("/api/kill")
 async def kill():
     cmd = {"command": 'kill', "desc": 'A kill command from browser.'}
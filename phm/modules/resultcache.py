@@ -0,0 +1,119 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+result cache module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Memoized spectrum and MDS results keyed by wave file content.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import os
+import pickle
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+DBPATH = None       # sqlite file backing the cache, None keeps results in memory only
+MAXITEMS = 4096     # results kept in memory
+
+caches_ = {}
+
+
+class ResultCache:
+    """
+    LRU cache of computed results in memory, optionally backed by sqlite.
+
+    Keys are strings built from the content hash of a wave file (see
+    `file_hash`) and whatever the result depends on, e.g. the fft
+    parameters or the baseline model version.
+    """
+
+    # Constructor
+    def __init__(self, dbpath=None, maxitems=MAXITEMS):
+        self.maxitems_ = maxitems
+        self.items_ = OrderedDict()
+        self.hashes_ = {}   # (path, size, mtime) -> content hash
+        self.lock_ = threading.Lock()
+        self.db_ = None
+        if dbpath:
+            dirname = os.path.dirname(dbpath)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            self.db_ = sqlite3.connect(dbpath, check_same_thread=False)
+            self.db_.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB)')
+            self.db_.commit()
+
+    def file_hash(self, path):
+        """
+        sha1 of the file content, each file version is read once.
+        """
+        st = os.stat(path)
+        stamp = (path, st.st_size, st.st_mtime_ns)
+        digest = self.hashes_.get(stamp)
+        if digest is None:
+            sha = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    sha.update(chunk)
+            digest = sha.hexdigest()
+            self.hashes_[stamp] = digest
+        return digest
+
+    def get(self, key):
+        with self.lock_:
+            if key in self.items_:
+                self.items_.move_to_end(key)
+                return self.items_[key]
+            if self.db_ is None:
+                return None
+            row = self.db_.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            value = pickle.loads(row[0])
+            self._remember(key, value)
+            return value
+
+    def put(self, key, value):
+        with self.lock_:
+            self._remember(key, value)
+            if self.db_ is not None:
+                self.db_.execute('INSERT OR REPLACE INTO results (key, value) VALUES (?, ?)',
+                                 (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)))
+                self.db_.commit()
+
+    def _remember(self, key, value):
+        self.items_[key] = value
+        self.items_.move_to_end(key)
+        while len(self.items_) > self.maxitems_:
+            self.items_.popitem(last=False)
+
+
+def get_cache(dbpath=None):
+    """
+    The shared `ResultCache` of this process, backed by `dbpath` or `DBPATH`.
+    """
+    dbpath = DBPATH if dbpath is None else dbpath
+    if dbpath not in caches_:
+        caches_[dbpath] = ResultCache(dbpath)
+    return caches_[dbpath]
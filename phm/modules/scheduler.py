@@ -0,0 +1,244 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+scheduler module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Periodic evaluation of many devices, only telemetry newer than a watermark.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from phm.modules import publisher
+
+WATERMARKDB = '.cache/watermarks.db'    # sqlite file of the watermark of each device
+INTERVAL = 600                          # seconds between two evaluations of a device
+LOOKBACK = 86400 * 1000                 # ms of telemetry fetched at most, e.g. for a new device
+RETRIES = 3                             # ticks a wave file failing to score holds its device back
+WORKERS = 1                             # fleet evaluations run side by side
+TIMEOUT = 30                            # seconds to wait for the sqlite lock and the mqtt acks
+FLEETKEYS = ['iot', 'usr', 'pwd', 'entitytype', 'keys', 'obj']  # params of devices evaluated in one pass
+
+
+class WatermarkStore:
+    """
+    Last timestamp scored and published of each device, one row each in
+    table `watermarks`. Marks only move forward.
+    """
+
+    # Constructor
+    def __init__(self, dbpath=WATERMARKDB):
+        dirname = os.path.dirname(dbpath)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.db_ = sqlite3.connect(dbpath, timeout=TIMEOUT, check_same_thread=False)
+        self.db_.execute('CREATE TABLE IF NOT EXISTS watermarks (device TEXT PRIMARY KEY, ts INTEGER, updated REAL)')
+        self.db_.commit()
+
+    def get(self, device):
+        """
+        Watermark of a device in ms, None if it is never evaluated.
+        """
+        row = self.db_.execute('SELECT ts FROM watermarks WHERE device = ?', (device,)).fetchone()
+        return None if row is None else row[0]
+
+    def advance(self, device, ts):
+        """
+        Move the watermark of a device to `ts`, in one statement so a crash
+        leaves the old or the new mark. An older `ts` is ignored.
+        """
+        with self.db_:
+            self.db_.execute('''INSERT INTO watermarks (device, ts, updated) VALUES (?, ?, ?)
+                ON CONFLICT(device) DO UPDATE SET ts = MAX(ts, excluded.ts), updated = excluded.updated''',
+                             (device, int(ts), time.time()))
+
+
+def device_key(param):
+    """
+    Watermark key of the device of a command.
+    """
+    return '|'.join(str(param.get(el)) for el in ['iot', 'entitytype', 'entityid', 'keys', 'obj'])
+
+
+def strftime(ms):
+    """
+    `stime` or `etime` of a command, local time as `calculate_fleet_indicator`
+    takes them.
+    """
+    return datetime.fromtimestamp(ms / 1000).strftime('%Y-%m-%dT%X')
+
+
+def publish_rows(param, rows, timeout=TIMEOUT):
+    """
+    Publish MDS rows to the device of `param` with its access token.
+
+    Returns
+    -------
+    out : bool
+        True once the broker acknowledged all of them.
+    """
+    pub = publisher.get_publisher(param['host'], param['port'], param['token'])
+    pub.publish([{'ts': el['ts'], 'values': {'MDS': el['MDS']}} for el in rows])
+    return pub.flush(wait=True, timeout=timeout)
+
+
+class Scheduler:
+    """
+    Evaluates registered devices every `interval` seconds, fetching and
+    scoring only the telemetry newer than their watermark.
+
+    Due devices sharing the `FLEETKEYS` are evaluated in one pass by
+    `evaluate(param, bp, since=marks)` in a worker process, see
+    `calculate_fleet_indicator`. The rows of each device are then published
+    by `publish(param, rows)` and its watermark is advanced once the
+    publish is acknowledged, so a crash republishes at most the last batch.
+    A row whose wave file fails to score holds the watermark for `RETRIES`
+    ticks, then it is skipped.
+    """
+
+    # Constructor
+    def __init__(self, evaluate, bp, publish=publish_rows, dbpath=WATERMARKDB, lookback=LOOKBACK, workers=WORKERS):
+        self.evaluate_ = evaluate
+        self.bp_ = bp
+        self.publish_ = publish
+        self.lookback_ = lookback
+        self.store_ = WatermarkStore(dbpath)
+        self.executor_ = ProcessPoolExecutor(max_workers=workers)
+        self.devices_ = {}      # key -> {'param': command, 'interval': seconds, 'due': seconds}
+        self.failures_ = {}     # key -> (ts, ticks) of the row holding the watermark
+        self.lock_ = threading.Condition()
+        self.thread_ = None
+        self.closed_ = False
+
+    def add(self, param, interval=INTERVAL):
+        """
+        Register the device of a command, with `host`, `port` and `token`
+        to publish, it is due at once.
+
+        Returns
+        -------
+        out : string
+            The device key, see `device_key`.
+        """
+        key = device_key(param)
+        with self.lock_:
+            self.devices_[key] = {'param': dict(param), 'interval': interval, 'due': 0}
+            self.lock_.notify_all()
+        return key
+
+    def remove(self, key):
+        with self.lock_:
+            self.devices_.pop(key, None)
+            self.failures_.pop(key, None)
+
+    def tick(self, now=None):
+        """
+        Evaluate the due devices once.
+
+        Returns
+        -------
+        out : dict
+            Rows published of each evaluated device key.
+        """
+        now = time.time() if now is None else now
+        with self.lock_:
+            due = {key: dev for key, dev in self.devices_.items() if dev['due'] <= now}
+            for dev in due.values():
+                dev['due'] = now + dev['interval']
+        groups = {}
+        for key, dev in due.items():
+            groups.setdefault(tuple(dev['param'].get(el) for el in FLEETKEYS), []).append(key)
+        et = round(now * 1000)
+        futures = []
+        for keys in groups.values():
+            param = dict(due[keys[0]]['param'])
+            param['entityids'] = [due[key]['param']['entityid'] for key in keys]
+            param['stime'], param['etime'] = strftime(et - self.lookback_), strftime(et)
+            since = {due[key]['param']['entityid']: self.store_.get(key) for key in keys}
+            futures.append((keys, self.executor_.submit(self.evaluate_, param, self.bp_, since=since)))
+        out = {}
+        for keys, future in futures:
+            try:
+                result = future.result() or {}
+            except Exception as e:
+                logging.error(f'evaluation of {keys} failed: {e}')
+                continue
+            for key in keys:
+                out[key] = self._publish(key, due[key]['param'], result.get(due[key]['param']['entityid']))
+        return out
+
+    def _publish(self, key, param, rows):
+        mark = self.store_.get(key)
+        rows = sorted((el for el in rows or [] if mark is None or el['ts'] > mark), key=lambda el: el['ts'])
+        end = len(rows)  # rows before end are scored or given up
+        for idx, el in enumerate(rows):
+            if el['MDS'] is not None:
+                continue
+            ts, ticks = self.failures_.get(key, (None, 0))
+            ticks = ticks + 1 if ts == el['ts'] else 1
+            if ticks < RETRIES:
+                self.failures_[key] = (el['ts'], ticks)
+                end = idx
+                break
+            logging.error(f'wave file of {key} at {el["ts"]} is skipped after {ticks} failures.')
+        ready = [el for el in rows[:end] if el['MDS'] is not None]
+        if len(ready) > 0 and not self.publish_(param, ready):
+            logging.error(f'publish of {key} is not acknowledged, the watermark is kept.')
+            return []
+        if end > 0:
+            self.store_.advance(key, rows[end - 1]['ts'])
+        if end == len(rows):
+            self.failures_.pop(key, None)
+        return ready
+
+    def _run(self, resolution):
+        while True:
+            with self.lock_:
+                if self.closed_:
+                    return
+            try:
+                self.tick()
+            except Exception:
+                logging.exception('scheduler tick failed.')
+            with self.lock_:
+                self.lock_.wait(resolution)
+
+    def start(self, resolution=1.0):
+        """
+        Tick every `resolution` seconds in a background thread.
+        """
+        self.thread_ = threading.Thread(target=self._run, args=(resolution,), daemon=True)
+        self.thread_.start()
+
+    def shutdown(self, wait=True):
+        with self.lock_:
+            self.closed_ = True
+            self.lock_.notify_all()
+        if self.thread_ is not None and wait:
+            self.thread_.join()
+        self.executor_.shutdown(wait=wait)
@@ -0,0 +1,218 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+shared array module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Bulk arrays between the service processes through shared memory blocks.
+
+The writer copies an array, or a column of texts such as the MDS json of
+each row, into a new block and sends a small descriptor over the pipe, the
+reader maps the block and frees it. A block belongs to its reader: it
+outlives the writer process and is unlinked by `load`, `load_list`,
+`load_texts` or `release`.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import struct
+import logging
+from multiprocessing import resource_tracker, shared_memory
+
+THRESHOLD = 65536   # bytes of a column put into shared memory, smaller ones travel inline in the message
+FRAME = 'frame'     # key of the columns of a packed message
+
+
+def share(array):
+    """
+    Copy an array into a new shared memory block.
+
+    Parameters
+    ----------
+    array : array_like
+        Numeric array of any shape.
+
+    Returns
+    -------
+    out : dict
+        Json-able descriptor `{"shm": name, "dtype": ..., "format": ...,
+        "shape": [...]}`, see `load`.
+    """
+    import numpy as np
+    arr = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    # the reader unlinks the block, the tracker of this process must not do it at exit.
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    shm.close()
+    return {'shm': shm.name, 'dtype': arr.dtype.str, 'format': arr.dtype.char, 'shape': list(arr.shape)}
+
+
+def load(desc):
+    """
+    A copy of the array of a descriptor, its block is freed.
+    """
+    import numpy as np
+    shm = shared_memory.SharedMemory(desc['shm'])
+    try:
+        out = np.ndarray(desc['shape'], dtype=np.dtype(desc['dtype']), buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return out
+
+
+def load_list(desc):
+    """
+    The flat values of a descriptor as a list, without numpy, its block is
+    freed. Only native byte order dtypes are supported.
+    """
+    size = struct.calcsize(desc['format'])
+    for el in desc['shape']:
+        size *= el
+    shm = shared_memory.SharedMemory(desc['shm'])
+    try:
+        with shm.buf[:size] as raw, raw.cast(desc['format']) as view:
+            out = view.tolist()
+    finally:
+        shm.close()
+        shm.unlink()
+    return out
+
+
+def share_texts(texts):
+    """
+    Copy strings, None allowed, into a new shared memory block as utf-8,
+    without numpy.
+
+    Returns
+    -------
+    out : dict
+        Json-able descriptor `{"shm": name, "offsets": [...], "nulls":
+        [...]}`, see `load_texts`.
+    """
+    raw = [b'' if el is None else el.encode() for el in texts]
+    offsets = [0]
+    for el in raw:
+        offsets.append(offsets[-1] + len(el))
+    shm = shared_memory.SharedMemory(create=True, size=max(offsets[-1], 1))
+    shm.buf[:offsets[-1]] = b''.join(raw)
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    shm.close()
+    return {'shm': shm.name, 'offsets': offsets, 'nulls': [idx for idx, el in enumerate(texts) if el is None]}
+
+
+def load_texts(desc):
+    """
+    The strings of a descriptor of `share_texts`, its block is freed.
+    """
+    offsets = desc['offsets']
+    shm = shared_memory.SharedMemory(desc['shm'])
+    try:
+        raw = bytes(shm.buf[:offsets[-1]])
+    finally:
+        shm.close()
+        shm.unlink()
+    nulls = set(desc['nulls'])
+    return [None if idx in nulls else raw[offsets[idx]:offsets[idx + 1]].decode()
+            for idx in range(len(offsets) - 1)]
+
+
+def release(desc):
+    """
+    Free the block of a descriptor never loaded, e.g. the reader is gone.
+    """
+    try:
+        shm = shared_memory.SharedMemory(desc['shm'])
+        shm.close()
+        shm.unlink()
+    except FileNotFoundError:
+        logging.error(f'shared memory {desc["shm"]} is already freed.')
+
+
+def pack(columns, threshold=None):
+    """
+    A message of named columns, numeric arrays and columns of strings (None
+    allowed, e.g. the MDS json of each row) of at least `threshold` bytes
+    are put into shared memory. Smaller columns and other values are
+    inlined as lists.
+
+    Returns
+    -------
+    out : dict
+        `{"frame": {name: descriptor or {"data": [...]}}}`, json-able.
+    """
+    import numpy as np
+    threshold = THRESHOLD if threshold is None else threshold
+    frame = {}
+    for name, col in columns.items():
+        if not isinstance(col, np.ndarray) and all(el is None or isinstance(el, str) for el in col):
+            if sum(len(el) for el in col if el is not None) >= threshold:
+                frame[name] = share_texts(col)
+            else:
+                frame[name] = {'data': list(col)}
+            continue
+        arr = np.asarray(col) if isinstance(col, np.ndarray) else np.asarray(col, dtype=object)
+        if arr.dtype.kind in 'biuf' and arr.nbytes >= threshold:
+            frame[name] = share(arr)
+        else:
+            frame[name] = {'data': arr.tolist()}
+    return {FRAME: frame}
+
+
+def is_packed(msg):
+    return isinstance(msg, dict) and isinstance(msg.get(FRAME), dict)
+
+
+def unpack(msg):
+    """
+    The named arrays of a packed message, see `pack`.
+    """
+    import numpy as np
+    out = {}
+    for name, desc in msg[FRAME].items():
+        if 'offsets' in desc:
+            out[name] = np.asarray(load_texts(desc), dtype=object)
+        else:
+            out[name] = load(desc) if 'shm' in desc else np.asarray(desc['data'])
+    return out
+
+
+def unpack_lists(msg):
+    """
+    The named flat lists of a packed message, without numpy.
+    """
+    out = {}
+    for name, desc in msg[FRAME].items():
+        if 'offsets' in desc:
+            out[name] = load_texts(desc)
+        else:
+            out[name] = load_list(desc) if 'shm' in desc else desc['data']
+    return out
+
+
+def release_packed(msg):
+    """
+    Free the blocks of a packed message never unpacked.
+    """
+    for desc in msg[FRAME].values():
+        if 'shm' in desc:
+            release(desc)
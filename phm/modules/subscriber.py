@@ -0,0 +1,154 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+subscriber module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Mqtt subscription handing each new wave file to the model as it arrives.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import json
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict
+import paho.mqtt.client as mqtt
+
+TOPIC = 'v1/devices/me/attributes'  # shared attribute updates of the device on ThingsBoard
+WAVEKEY = 'wave_url'                # telemetry or attribute key of the wave file url
+BATCH = 64                          # arrivals handled together at most
+SEEN = 4096                         # recent urls kept to drop redelivered messages
+
+
+def wave_rows(payload, key=WAVEKEY):
+    """
+    Wave file rows of an mqtt message.
+
+    Parameters
+    ----------
+    payload : bytes or string
+        Json of a telemetry point `{"ts": ts, "values": {...}}`, a list of
+        them or flat values `{key: url}` as attribute updates are sent,
+        which are stamped now.
+
+    Returns
+    -------
+    out : list
+        `{"ts": ts, key: url}` of each point carrying `key`.
+    """
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        logging.error(f'mqtt message is not json: {payload[:100]}')
+        return []
+    if isinstance(data, dict):
+        data = [data]
+    now = round(time.time() * 1000)
+    out = []
+    for el in data if isinstance(data, list) else []:
+        if not isinstance(el, dict):
+            continue
+        values = el.get('values', {}) if 'ts' in el else el
+        if isinstance(values, dict) and isinstance(values.get(key), str):
+            out.append({'ts': int(el.get('ts', now)), key: values[key]})
+    return out
+
+
+class MqttSubscriber:
+    """
+    Subscription of a device access token to the wave file urls.
+
+    Each new url is queued as it arrives and `handler(rows)` is called by a
+    background thread with the rows queued so far, at most `batch` of them,
+    so the mqtt network loop is never blocked by the model. Topics are
+    subscribed again on each reconnect.
+    """
+
+    # Constructor
+    def __init__(self, token, host, handler, port=1883, keepalive=60, topics=(TOPIC,), qos=1, key=WAVEKEY,
+                 batch=BATCH):
+        self.handler_ = handler
+        self.topics_ = list(topics)
+        self.qos_ = qos
+        self.key_ = key
+        self.batch_ = batch
+        self.queue_ = queue.Queue()
+        self.seen_ = OrderedDict()
+        self.client_ = mqtt.Client()
+        self.client_.username_pw_set(token)
+        self.client_.on_connect = self._on_connect
+        self.client_.on_message = self._on_message
+        self.thread_ = threading.Thread(target=self._run, daemon=True)
+        self.thread_.start()
+        self.client_.connect(host, port, keepalive)
+        self.client_.loop_start()
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logging.error(f'mqtt connect error: {mqtt.connack_string(rc)}')
+            return
+        for topic in self.topics_:
+            client.subscribe(topic, self.qos_)
+
+    def _on_message(self, client, userdata, msg):
+        for row in wave_rows(msg.payload, self.key_):
+            url = row[self.key_]
+            if url in self.seen_:
+                continue
+            self.seen_[url] = True
+            if len(self.seen_) > SEEN:
+                self.seen_.popitem(last=False)
+            self.queue_.put(row)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            rows = [self.queue_.get()]
+            while len(rows) < self.batch_:
+                try:
+                    rows.append(self.queue_.get_nowait())
+                except queue.Empty:
+                    break
+            if None in rows:
+                stop = True
+                rows = rows[:rows.index(None)]
+            if len(rows) == 0:
+                continue
+            try:
+                self.handler_(rows)
+            except Exception:
+                logging.exception(f'handling {len(rows)} wave files failed.')
+
+    def close(self, wait=True):
+        """
+        Unsubscribe and disconnect, the queued urls are handled first if
+        `wait`.
+        """
+        self.client_.loop_stop()
+        self.client_.disconnect()
+        if not wait:
+            with self.queue_.mutex:
+                self.queue_.queue.clear()
+        self.queue_.put(None)
+        self.thread_.join()
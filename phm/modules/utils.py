@@ -27,13 +27,26 @@ Common ultilities function.
 # Author: Awen <26896225@qq.com>
 # License: MIT
 
-import pandas as pd
-import scipy.fftpack
-import scipy.io
+import os
+import logging
+import numpy as np
+
+SIDECAR = '.sidecar/'  # sub directory of the data path to keep float32 copies of the data files
+BLOCK = 1 << 20        # rows of a data file read at once by `iter_dat`
+
+
+def pandas():
+    """
+    The pandas module, imported on first use so the service processes start
+    without it, see `phm.LAZY`.
+    """
+    import pandas
+    return pandas
 
 
 def load_mat(file, path):
     strf = f'{path}{file}'
+    import scipy.io  # loaded on demand, see `phm.LAZY`
     data = scipy.io.loadmat(strf)
     # fid = '{:0>3}'.format(file)  # 99 --> 099
     fileid = [int(si) for si in file.split('.') if si.isdigit()][0]  # xx.97.mat now changed to 97
@@ -41,27 +54,137 @@ def load_mat(file, path):
     fid = f'{fileid:0{width}d}'  # 97 -> 097, and 100 -> 100
     de = data[f'X{fid}_DE_time']
     fe = data[f'X{fid}_FE_time']
-    # drive end amplitude
-    ampde = []
-    for i in range(de.shape[0]):
-        ampde.append(de[i][0])
-    # fan end amplitude
-    ampfe = []
-    for i in range(fe.shape[0]):
-        ampfe.append(fe[i][0])
-
+    # drive end and fan end amplitude, (n, 1) arrays flattened without copy
+    ampde = de[:, 0]
+    ampfe = fe[:, 0]
     return ampde, ampfe
 
 
 def load_csv(file, path, ns=['c1', 'c2', 'c3', 'c4', 'c5', 'c6', 'c7', 'c8']):
     strf = f'{path}{file}'
-    df = pd.read_table(strf, names=ns)
-    c1 = df.iloc[:, 0].values
-    c2 = df.iloc[:, 1].values
+    # only the first two channels are parsed, by the c engine of pandas.
+    pd = pandas()
+    df = pd.read_csv(strf, sep='\t', header=None, names=ns[:2], usecols=[0, 1], dtype=np.float64, engine='c')
+    c1 = df.iloc[:, 0].to_numpy()
+    c2 = df.iloc[:, 1].to_numpy()
     return c1, c2
 
 
-def load_dat(file, path, ns=['c1', 'c2', 'c3', 'c4', 'c5', 'c6', 'c7', 'c8']):
-    return load_csv(file, path, ns)
-    # return load_mat(file, path)
+def sidecar_path(file, path):
+    return f'{path}{SIDECAR}{file}.f32'
+
+
+def load_sidecar(file, path):
+    """
+    Map the float32 sidecar of a data file, if it is newer than the data file.
+
+    Returns
+    -------
+    out : numpy.memmap or None
+        A (n, 2) array of the drive end and fan end amplitude.
+    """
+    side = sidecar_path(file, path)
+    try:
+        if os.stat(side).st_mtime_ns < os.stat(f'{path}{file}').st_mtime_ns:
+            return None
+        return np.memmap(side, dtype=np.float32, mode='r').reshape(-1, 2)
+    except (OSError, ValueError):
+        return None
+
+
+def save_sidecar(file, path, de, fe):
+    side = sidecar_path(file, path)
+    tmp = f'{side}.tmp'
+    try:
+        os.makedirs(os.path.dirname(side), exist_ok=True)
+        np.column_stack([de, fe]).astype(np.float32).tofile(tmp)
+        os.replace(tmp, side)
+    except OSError as err:
+        logging.warning(f'Sidecar of {file} is not saved: {err}')
+
+
+def load_dat(file, path, ns=['c1', 'c2', 'c3', 'c4', 'c5', 'c6', 'c7', 'c8'], sidecar=False):
+    """
+    Load the drive end and fan end amplitude of a data file.
+
+    Parameters
+    ----------
+    file : string
+        Data file name.
+    path : string
+        Directory of the data file, ends with '/'.
+    ns : list, optional
+        Column names of the text file.
+    sidecar : bool, optional
+        Parse the text file once and keep a float32 binary copy under
+        `path/.sidecar/`, later loads map the copy directly.
+
+    Returns
+    -------
+    A tuple, `(de, fe)`
+        Numpy arrays of the two channels.
+    """
+    if sidecar:
+        arr = load_sidecar(file, path)
+        if arr is not None:
+            return arr[:, 0], arr[:, 1]
+    (de, fe) = load_csv(file, path, ns)
+    # (de, fe) = load_mat(file, path)
+    if sidecar:
+        save_sidecar(file, path, de, fe)
+    return de, fe
+
+
+def iter_dat(file, path, block=BLOCK, ns=['c1', 'c2', 'c3', 'c4', 'c5', 'c6', 'c7', 'c8'], sidecar=False):
+    """
+    Read the drive end and fan end amplitude of a data file in blocks, for
+    files larger than memory, see `load_dat`.
+
+    Parameters
+    ----------
+    block : int, optional
+        Rows of each block.
+    sidecar : bool, optional
+        Read the float32 sidecar through a memory map if it is up to date,
+        else parse the text file and write the sidecar block by block.
 
+    Yields
+    ------
+    A tuple, `(de, fe)`
+        Numpy arrays of the two channels, `block` rows each but the last.
+        Concatenated they equal `load_dat`.
+    """
+    if sidecar:
+        arr = load_sidecar(file, path)
+        if arr is not None:
+            for start in range(0, len(arr), block):
+                yield arr[start: start + block, 0], arr[start: start + block, 1]
+            return
+    pd = pandas()
+    reader = pd.read_csv(f'{path}{file}', sep='\t', header=None, names=ns[:2], usecols=[0, 1], dtype=np.float64,
+                         engine='c', chunksize=block)
+    side = sidecar_path(file, path)
+    tmp = f'{side}.tmp'
+    out = None
+    if sidecar:
+        try:
+            os.makedirs(os.path.dirname(side), exist_ok=True)
+            out = open(tmp, 'wb')
+        except OSError as err:
+            logging.warning(f'Sidecar of {file} is not saved: {err}')
+    try:
+        with reader:
+            for df in reader:
+                de = df.iloc[:, 0].to_numpy()
+                fe = df.iloc[:, 1].to_numpy()
+                if out is not None:
+                    np.column_stack([de, fe]).astype(np.float32).tofile(out)
+                yield de, fe
+        if out is not None:
+            out.close()
+            os.replace(tmp, side)
+            out = None
+    finally:
+        if out is not None:  # stopped early or failed, the partial sidecar is dropped
+            out.close()
+            os.remove(tmp)
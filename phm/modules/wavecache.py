@@ -0,0 +1,195 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+wave cache module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Bounded cache of the downloaded wave files, keyed by url.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import os
+import json
+import fcntl
+import time
+import hashlib
+import logging
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from phm.modules import download, metrics, utils
+
+MAXBYTES = 2 << 30          # size budget of the cached wave files
+MAXAGE = 7 * 24 * 3600      # seconds a wave file is kept after download
+
+caches_ = {}
+
+
+class WaveCache:
+    """
+    Wave files downloaded into `cachepath`, each one named by the sha1 of
+    its url.
+
+    ``.index.json`` in `cachepath` records url, size, download time and
+    last access time of each file, lookups never list the directory. The
+    least recently used files are evicted when the size budget is exceeded,
+    files older than `maxage` are always evicted.
+
+    Many processes may share a cache path: the index is read again and
+    merged under the file lock ``.index.lock`` before each write, and an
+    entry whose file was evicted by another process is dropped on lookup.
+    """
+    index_ = '.index.json'
+    lockfile_ = '.index.lock'
+
+    # Constructor
+    def __init__(self, cachepath='.cache/data/', maxbytes=MAXBYTES, maxage=MAXAGE):
+        self.cachepath_ = cachepath
+        self.maxbytes_ = maxbytes
+        self.maxage_ = maxage
+        self.lock_ = threading.Lock()
+        self.entries_ = self._read()
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha1(url.encode()).hexdigest()
+
+    def _read(self):
+        try:
+            with open(os.path.join(self.cachepath_, self.index_)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _merge(self):
+        """
+        Union of the entries on disk and in memory, the last accessed one of
+        each file, and only the files still in `cachepath`.
+        """
+        merged = self._read()
+        for key, el in self.entries_.items():
+            if key not in merged or merged[key]['atime'] < el['atime']:
+                merged[key] = el
+        self.entries_ = {key: el for key, el in merged.items() if os.path.isfile(os.path.join(self.cachepath_, key))}
+
+    def _write(self):
+        tmp = os.path.join(self.cachepath_, f'{self.index_}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.entries_, f)
+        os.replace(tmp, os.path.join(self.cachepath_, self.index_))
+
+    def _remove(self, key):
+        self.entries_.pop(key, None)
+        for path in (os.path.join(self.cachepath_, key), utils.sidecar_path(key, self.cachepath_)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def _download(self, url):
+        key = self.key(url)
+        try:
+            status = download.download_file(url, os.path.join(self.cachepath_, key))
+        except requests.exceptions.RequestException as err:
+            logging.error(err)
+            return url, None
+        if status != 200:
+            logging.error(f'{url} is not retrieved: {status}')
+            return url, None
+        now = time.time()
+        size = os.path.getsize(os.path.join(self.cachepath_, key))
+        return url, {'url': url, 'size': size, 'ctime': now, 'atime': now}
+
+    def get(self, url):
+        """
+        Cached file name of the url, None if it is not cached.
+        """
+        key = self.key(url)
+        with self.lock_:
+            entry = self.entries_.get(key)
+            if entry is None:
+                return None
+            if not os.path.isfile(os.path.join(self.cachepath_, key)):  # evicted by another process
+                self.entries_.pop(key)
+                return None
+            entry['atime'] = time.time()
+            return key
+
+    def fetch(self, urls, workers=8):
+        """
+        Download the urls not cached yet, concurrently.
+
+        Returns
+        -------
+        out : dict
+            File name in `cachepath` of each url, None if it could not be
+            retrieved.
+        """
+        urls = list(dict.fromkeys(urls))
+        fns = {url: self.get(url) for url in urls}
+        missing = [url for url in urls if fns[url] is None]
+        if len(missing) > 0:
+            with metrics.Stage('download') as st, \
+                    ThreadPoolExecutor(max_workers=max(1, min(workers, len(missing)))) as executor:
+                for url, entry in executor.map(self._download, missing):
+                    if entry is not None:
+                        with self.lock_:
+                            self.entries_[self.key(url)] = entry
+                        fns[url] = self.key(url)
+                        st.add(nbytes=entry['size'])
+        self.evict(keep=[fn for fn in fns.values() if fn is not None])
+        return fns
+
+    def evict(self, keep=()):
+        """
+        Evict expired and least recently used files beyond the budget.
+
+        Parameters
+        ----------
+        keep : list
+            File names never evicted, often the ones in use by the caller.
+        """
+        keep = set(keep)
+        os.makedirs(self.cachepath_, exist_ok=True)
+        with self.lock_, open(os.path.join(self.cachepath_, self.lockfile_), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # released on close
+            self._merge()
+            now = time.time()
+            for key in [k for k, el in self.entries_.items() if now - el['ctime'] > self.maxage_ and k not in keep]:
+                self._remove(key)
+            total = sum(el['size'] for el in self.entries_.values())
+            for key in sorted(self.entries_, key=lambda k: self.entries_[k]['atime']):
+                if total <= self.maxbytes_:
+                    break
+                if key not in keep:
+                    total -= self.entries_[key]['size']
+                    self._remove(key)
+            self._write()
+
+
+def get_cache(cachepath='.cache/data/'):
+    """
+    The shared `WaveCache` of a cache path in this process.
+    """
+    if cachepath not in caches_:
+        caches_[cachepath] = WaveCache(cachepath)
+    return caches_[cachepath]
@@ -29,79 +29,57 @@ Exploring->Clustering->MDS->Predicting.
 
 import os
 import errno
-import time
 import requests
-import json
-import pandas as pd
-import matplotlib.pyplot as plt
-from adjustText import adjust_text
-from matplotlib import patches as mpatches
+import numpy as np
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from os import listdir
 from os.path import isfile, join
-from phm.modules import utils
-from phm.vibration import cluster, mds
-import paho.mqtt.client as mqtt
+from phm.modules import download, iotclient, metrics, publisher, resultcache, utils, wavecache
+from phm.vibration import baseline, cluster, ingest, mds, render
 import logging
 import unittest
 
-
-def on_connect(client, userdata, flags, rc):
-    if rc == 0:
-        logging.info('connected.')
-        client.connected_flag = True
+MDSLAYOUT = 2  # layout of the json of `mds_json`, part of the result cache keys
 
 
 def mqtt_publish(host, port, accesstoken, sensor_data):
-    topic = 'v1/devices/me/telemetry'
-    client = mqtt.Client()
-    mqtt.Client.connected_flag = False
-    client.on_connect = on_connect
-    client.username_pw_set(accesstoken)
-    client.connect(host, port, 60)
-    client.loop_start()
-    client.publish(topic, sensor_data, 1)
-    while not client.connected_flag:
-        time.sleep(1)
-    client.loop_stop()
-    client.disconnect()
+    """
+    Publish telemetry through the shared connection of the access token.
+
+    Parameters
+    ----------
+    sensor_data : string
+        Json of a point `{"ts": ts, "values": {...}}` or a list of points.
+    """
+    client = publisher.get_publisher(host, port, accesstoken)
+    client.publish(sensor_data)
+    client.flush(wait=True, timeout=publisher.INTERVAL * 10)
     return
 
 
 def get_iot_data(iot, usr, pwd, entitytype, entityid, keys, st, et):
+    """
+    Telemetry of a device in [st, et], see `IotClient.iter_frames`.
+
+    The whole window is paged through in time slices, the auth token is
+    reused across calls until it expires.
+
+    Returns
+    -------
+    out : DataFrame object
+        Columns `ts` and each key, None if there is no data or no `wave_url`
+        at all, e.g. a device with MDS history only.
+    """
     try:
-        url = f'http://{iot}/api/auth/login'
-        data = f'''{{
-             "username": "{usr}",
-             "password": "{pwd}"
-         }}'''
-        response = requests.post(url, data=data)
-
-        token = json.loads(response.text)['token']
-        headers = {
-            'X-Authorization': f'Bearer {token}'
-        }
-
-        url = f'http://{iot}/api/plugins/telemetry/{entitytype}/{entityid}/values/timeseries'
-        payload = {
-            'limit': '2500',
-            'agg': 'NONE',
-            'orderBy': 'ASC',
-            'keys': f'{keys}',
-            'startTs': f'{st}',
-            'endTs': f'{et}'
-        }
-        response = requests.get(url, headers=headers, params=payload)
-        datumn = json.loads(response.text)
-        keys = list(datumn.keys())
-        if len(keys) == 0:
+        client = iotclient.get_client(iot, usr, pwd)
+        frames = list(client.iter_frames(entitytype, entityid, keys, st, et))
+        if len(frames) == 0:
             return None
-        df1 = pd.DataFrame.from_dict(datumn['wave_url'])  # FIXME hardcode
-        for key in keys:
-            dfr = pd.DataFrame.from_dict(datumn[key])
-            df1 = pd.merge(df1, dfr, on='ts', suffixes=['', key])
-            df1 = df1.rename(columns={f'value{key}': key})
-        return df1.drop(columns=['value'])
+        df = utils.pandas().concat(frames, ignore_index=True)
+        if 'wave_url' not in df.columns:  # FIXME hardcode
+            return None
+        return df
     except Exception as e:
         logging.error(e)
         return None
@@ -135,16 +113,189 @@ def retrieve_url_file(url, localdir):
     elif os.path.isdir(local):
         ret = -3  # url path ends at / and fn=''.
     else:
-        r = requests.get(url)
-        if r.status_code == 200:
-            with safe_open_w(local) as f:
-                f.write(r.content)
-                f.close()
-                ret = r.status_code  # ret = 200 is fine.
+        status = download.download_file(url, local)  # pooled session, streamed and renamed when complete.
+        if status == 200:
+            ret = status  # ret = 200 is fine.
     return ret
 
 
-def fre2mds(url, benchpath, cachepath='.cache/data/'):
+def mds_pipeline(benchpath, cachepath='.cache/data/', storepath='.cache/baseline/', workers=None, incremental=True,
+                 objfiles=None, store=None):
+    """
+    Computes cluster and MDS position of the baseline and obj points, no plotting.
+
+    Parameters
+    ----------
+    benchpath : string
+        `benchpath` is something like ../phm-model/hvac/data/
+
+    cachepath : string
+        `cachepath` holds the obj data files.
+
+    storepath : string
+        `storepath` keeps the precomputed baseline spectrum, see `BaselineStore`.
+
+    workers : int
+        `workers` is the process pool size to load and transform data files.
+
+    incremental : bool
+        `incremental` predicts the clusters of obj points by the persisted
+        baseline HDBSCAN model and places them into the persisted baseline
+        MDS configuration, otherwise both are fitted again over all points.
+
+    objfiles : list
+        `objfiles` are the obj data file names in `cachepath`, all files
+        (but hidden ones) in `cachepath` by default.
+
+    store : BaselineStore
+        `store` is a loaded baseline store, loaded from `benchpath` and
+        `storepath` by default.
+
+    Returns
+    -------
+    out : dict
+        `pos`, `df2` (dev, age, color of each point), `dfnew` (cluster
+        frame), `objpos`, `agelist`, `strengths`, `objfiles` and `objages`
+        (segment counts of each obj file).
+    """
+    sr = 20480  # sample rate
+    ws = 2048  # window size
+
+    # 2.read benchmark spectrum, precomputed once in the baseline store
+    chunksize = 20480
+    if store is None:
+        store = baseline.BaselineStore(benchpath, storepath, sr, ws, chunksize, workers)
+        store.load()
+    frequencies, benchspec, agelist = store.frequencies, store.spectrum, list(store.agelist)
+    agelist = [28, 12, 52]  # FIXME: The benchmark datasets originally include three run to failure tests.
+    objpos = len(benchspec)  # This position should be used to plot object sample.
+    if sum(agelist) != objpos:  # not the original benchmark datasets, take each file as a device.
+        agelist = list(store.agelist)
+    logging.info(f'1.Benchmark data read: {objpos}')
+
+    # 3.read obj data files
+    mypath = cachepath  # Obj data from url, cached in local .cache directory.
+    if objfiles is None:
+        onlyfiles = [f for f in listdir(mypath) if isfile(join(mypath, f)) and not f.startswith('.')]
+    else:
+        onlyfiles = [f for f in objfiles if isfile(join(mypath, f))]
+
+    fre, objspec, objages = ingest.ingest_spectrum(onlyfiles, mypath, sr, ws, chunksize, sidecar=True,
+                                                   workers=workers, cache=resultcache.get_cache())
+    agelist += objages  # each file contains agelist[i] segments.
+    logging.info(f'2.Total points(include obj ones): {objpos + len(objspec)}')
+    # 4.fft and cluster
+    spectrum = np.vstack([benchspec, objspec])
+    df2 = mds.dev_age_compute(spectrum, frequencies, agelist)  # should label at data reading phase.seg
+    if incremental:  # baseline models are persisted, obj points are predicted and placed only.
+        with metrics.Stage('cluster', objspec.nbytes, len(objspec)):
+            clusternew_ = store.cluster_model()
+            objlabels, objstrengths = cluster.predict_clusters(clusternew_, objspec)
+            dfnew = cluster.cluster_frame(np.concatenate([clusternew_.labels_, objlabels]), clusternew_.labels_)
+            strengths = np.concatenate([clusternew_.probabilities_, objstrengths])
+        with metrics.Stage('mds', objspec.nbytes, len(objspec)):
+            model = store.mds_model()
+            pos = np.vstack([model['pos'], mds.place_mds_pos(model, objspec)])
+    else:
+        with metrics.Stage('cluster', spectrum.nbytes, len(spectrum)):
+            clusternew_, dfnew = cluster.cluster_vectors(spectrum, False)
+            strengths = clusternew_.probabilities_
+        with metrics.Stage('mds', spectrum.nbytes, len(spectrum)):
+            pos = mds.compute_mds_pos(spectrum)
+    df2 = df2[['dev', 'age']].copy()  # frequency columns are not needed any more.
+    # set color for each points in df2
+    colors = np.full(len(df2), '#000000', dtype=object)
+    for idx, elems in enumerate(dfnew['vectors']):
+        colors[elems] = dfnew.loc[idx, 'color']
+    df2['color'] = colors
+    logging.info('3.MDS pos computed.')
+    return {'pos': pos, 'df2': df2, 'dfnew': dfnew, 'objpos': objpos, 'agelist': agelist, 'strengths': strengths,
+            'objfiles': onlyfiles, 'objages': objages}
+
+
+@metrics.Stage('serialize')
+def mds_json(res, objfile=None):
+    """
+    Serializes the result of `mds_pipeline` to the json published to iot.
+
+    Parameters
+    ----------
+    res : dict
+        Result of `mds_pipeline`.
+
+    objfile : string
+        Keep the baseline points and the points of this obj file only, as if
+        it were the only obj file: its points are labeled with the first dev
+        id after the baseline devices. All points are kept by default.
+    """
+    objpos = res['objpos']
+    rows = np.arange(len(res['pos']))
+    if objfile is not None:
+        idx = res['objfiles'].index(objfile)
+        start = objpos + sum(res['objages'][:idx])
+        rows = np.concatenate([rows[:objpos], rows[start: start + res['objages'][idx]]])
+    df2 = res['df2'].iloc[rows].reset_index(drop=True)
+    if objfile is not None:
+        df2.loc[objpos:, 'dev'] = len(res['agelist']) - len(res['objages'])
+    df2['pos_x'] = res['pos'][rows, 0]
+    df2['pos_y'] = res['pos'][rows, 1]
+    df2['strength'] = res['strengths'][rows]  # cluster membership strength
+    df2['shape'] = 0
+    df2.loc[objpos:, 'shape'] = 1
+    return df2.to_json()  # return a valid json string
+
+
+def mds_results(benchpath, objfiles, cachepath='.cache/data/', storepath='.cache/baseline/', workers=None,
+                incremental=True, plotpath=None, store=None):
+    """
+    Computes the json of each obj file, see `mds_json(res, objfile)`.
+
+    In incremental mode the json of an obj file only depends on its content,
+    the baseline models and the json layout, not on the other obj files of
+    the batch, so it is memoized by the content hash,
+    `BaselineStore.model_version` and `MDSLAYOUT` in the shared
+    `ResultCache`. Only the obj files not in the cache go through
+    `mds_pipeline`.
+
+    Parameters
+    ----------
+    plotpath : string
+        `plotpath` renders the MDS chart of all obj files in background,
+        see `fre2mds`.
+
+    store : BaselineStore
+        `store` is a loaded baseline store, loaded from `benchpath` and
+        `storepath` by default.
+
+    Returns
+    -------
+    out : dict
+        json of each obj file.
+    """
+    if store is None:
+        store = baseline.BaselineStore(benchpath, storepath, workers=workers)
+        store.load()
+    results = resultcache.get_cache()
+    keys = {}
+    if incremental and not plotpath:
+        version = store.model_version()
+        keys = {fn: f'mds:{results.file_hash(join(cachepath, fn))}:{version}:{MDSLAYOUT}' for fn in objfiles}
+    out = {fn: results.get(keys[fn]) if fn in keys else None for fn in objfiles}
+    pending = [fn for fn in objfiles if out[fn] is None]
+    if len(pending) > 0:
+        res = mds_pipeline(benchpath, cachepath, storepath, workers, incremental, pending, store)
+        for fn in res['objfiles']:
+            out[fn] = mds_json(res, fn)
+            if fn in keys:
+                results.put(keys[fn], out[fn])
+        if plotpath:
+            render.submit_render(res, plotpath)  # off the request path
+            logging.info(f'4.MDS plot submitted: {plotpath}')
+    return out
+
+
+def fre2mds(url, benchpath, cachepath='.cache/data/', storepath='.cache/baseline/', workers=None,
+            incremental=True, plotpath=None):
     """
     Determines soh according the given wave file.
 
@@ -157,7 +308,21 @@ def fre2mds(url, benchpath, cachepath='.cache/data/'):
         `benchpath` is something like ../phm-model/hvac/data/
 
     cachepath : string
-        `localpath` is something like ./cache/data
+        `cachepath` is something like ./cache/data, see `WaveCache`.
+
+    storepath : string
+        `storepath` keeps the precomputed baseline spectrum, see `BaselineStore`.
+
+    workers : int
+        `workers` is the process pool size to load and transform data files.
+
+    incremental : bool
+        `incremental` predicts and places obj points by the persisted
+        baseline models, see `mds_pipeline`.
+
+    plotpath : string
+        `plotpath` is a .png or .svg file, the MDS chart is rendered into it
+        by a background thread. No chart is rendered by default.
 
     Returns
     -------
@@ -165,132 +330,122 @@ def fre2mds(url, benchpath, cachepath='.cache/data/'):
         Float result of SOH calculated by the frequency analysis model.
 
     """
-    sr = 20480  # sample rate
-    ws = 2048  # window size
     out = None
     try:
-        # 1.download the dat file if necessary.
-        retrieve_url_file(url, cachepath)
-
-        # 2.read benchamark data files
-        datumn = []
-        mypath = benchpath
-        onlyfiles = [f for f in listdir(mypath) if isfile(join(mypath, f))]
-
-        chunksize = 20480
-        agelist = []
-        for ii, item in enumerate(onlyfiles):
-            fractionlet = 0  # some segment is too short and should be drop out.
-            (de, fe) = utils.load_dat(item, mypath)
-            # segment by chunksize(default 20480)
-            for idx, subset in enumerate(range(0, len(de), chunksize)):
-                seg = de[subset: subset + chunksize]
-                if len(seg) > ws:
-                    datumn.append(seg)
-                    fractionlet += 1
-            agelist.append(fractionlet)  # each chunk contains idx+1 segments.
-        agelist = [28, 12, 52]  # FIXME: The benchmark datasets originally include three run to failure tests.
-        objpos = len(datumn)  # This position should be used to plot object sample.
-        logging.info(f'1.Benchmark data read: {objpos}')
-
-        # 3.read obj data files
-        mypath = cachepath  # Obj data from url, cached in local .cache directory.
-        onlyfiles = [f for f in listdir(mypath) if isfile(join(mypath, f))]
-
-        for ii, item in enumerate(onlyfiles):
-            fractionlet = 0  # some segment is too short and should be drop out.
-            (de, fe) = utils.load_dat(item, mypath)
-            # segment by chunksize(default 20480)
-            for idx, subset in enumerate(range(0, len(de), chunksize)):
-                seg = de[subset: subset + chunksize]
-                if len(seg) > ws:
-                    datumn.append(seg)
-                    fractionlet += 1
-            agelist.append(fractionlet)  # each chunk contains idx+1 segments.
-        logging.info(f'2.Total points(include obj ones): {len(datumn)}')
-        # 4.fft and cluster
-        frequencies, spectrum = cluster.ts2fft(datumn, sr, ws)
-        clusternew_, dfnew = cluster.cluster_vectors(spectrum, False)
-        df2 = mds.dev_age_compute(spectrum, frequencies, agelist)  # should label at data reading phase.seg
-        pos = mds.compute_mds_pos(spectrum)
-        # set color for each points in df2
-        df2.loc[:, 'color'] = '#000000'
-        for idx, elems in enumerate(dfnew['vectors']):
-            for el in elems:
-                df2.loc[el, 'color'] = dfnew.loc[idx, 'color']
-        logging.info(f'3.MDS pos computed.')
-        # plot mds scatter chart
-        plt.figure(1)
-        plt.axes([0., 0., 1., 1.])
-        # collections = list(range(len(pos)))
-        # mask = dfnew[dfnew['cid'] == -1]['vectors'][0]
-        # dispindices = list(set(collections).difference(set(mask)))
-        dispindices = list(range(objpos))  # only plot benchmark points.
-        plt.scatter(x=pos[dispindices, 0],
-                    y=pos[dispindices, 1],
-                    s=df2.loc[dispindices, 'age'],
-                    label=df2.loc[dispindices, 'color'],
-                    edgecolors=df2.loc[dispindices, 'color'],
-                    facecolors='none', marker='.', alpha=0.5, lw=1)
-        hnds = []
-        for idx, el in enumerate(dfnew['color']):
-            pop = mpatches.Patch(color=el, label=f'C: [{dfnew["cid"][idx]}], cnts:[{len(dfnew["vectors"][idx])}]')
-            hnds.append(pop)
-        plt.legend(handles=hnds, prop={'size': 6})
-        # label baseline points
-        # baseline should be the first points
-        # agelist = [24, 12, 24, 24, 6, ...]
-        # dfnew:
-        #       cid,       vectors
-        #        -1     [84,85,86,87, ...]
-        #         0     [156,157, ...]
-        #        ...
-        #         8     [0,1,2, ...]
-        # should label points: 0, 24, 36, 60
-        blcnts = 2
-        baselineclass = [0]
-        for idx, el in enumerate(agelist[0: blcnts]):
-            ps = baselineclass[idx] + el
-            baselineclass.append(ps)
-        # find baselineclass leader points in dfnew and
-        texts = []
-        for obj in baselineclass:  # 0, 24, 36, 60
-            for idx, vecs in enumerate(dfnew['vectors']):
-                if obj in vecs:
-                    txt = f'{obj} in C: [{dfnew["cid"][idx]}]'
-                    texts.append(plt.text(pos[obj, 0], pos[obj, 1], txt))
-        adjust_text(texts)
-        # label object points
-        plt.scatter(x=pos[objpos:, 0],
-                    y=pos[objpos:, 1],
-                    label=df2.loc[objpos:, 'color'],
-                    marker='*', s=300, color='k', alpha=0.5, lw=1)
-        for txt in list(range(objpos, len(datumn))):
-            plt.text(pos[txt, 0], pos[txt, 1], f'PT: {txt}', c='#000000')
-        plt.show()
-        logging.info('4.MDS plot finished.')
-        df2.drop(df2.columns[list(range(len(df2.T) - 3))], axis=1, inplace=True)
-        df2['pos_x'] = pos[:, 0]
-        df2['pos_y'] = pos[:, 1]
-        df2['shape'] = 0
-        df2.loc[objpos:, 'shape'] = 1
-        json.loads(df2.to_json())
+        # 1.download the dat file if necessary, only this wave file is the obj.
+        fn = wavecache.get_cache(cachepath).fetch([url])[url]
+        if fn is None:
+            return out
+        out = mds_results(benchpath, [fn], cachepath, storepath, workers, incremental, plotpath)[fn]
         logging.info('5.Return to main procedure.')
-        out = df2.to_json()  # return a valid json string
     except requests.exceptions.ConnectionError as ce:
         logging.error(ce)
 
     return out
 
 
-def wrap_mds(df, base):
-    ret = []
-    for index, row in df.iterrows():
-        item = {"ts": row['ts'], "MDS": fre2mds(row[1], base)}
-        ret.append(item)
+def wrap_mds(df, base, cachepath='.cache/data/', storepath='.cache/baseline/', workers=None, incremental=True,
+             store=None):
+    """
+    Evaluates all the wave files of the iot rows in one pipeline pass.
+
+    Parameters
+    ----------
+    df : DataFrame object
+        Rows of `ts` and `wave_url`, see `get_iot_data`.
+
+    base : string
+        `base` is the baseline path, see `fre2mds`.
+
+    store : BaselineStore
+        `store` is a loaded baseline store, see `load_store`. It is loaded
+        from `base` and `storepath` by default.
+
+    Returns
+    -------
+    out : list
+        `{"ts": ts, "MDS": json}` of each row, MDS is None if the wave file
+        could not be retrieved. Each json holds the baseline points and the
+        points of the row's own wave file.
+    """
+    return wrap_fleet_mds({None: df}, base, cachepath, storepath, workers, incremental, store)[None]
+
+
+def wrap_fleet_mds(dfs, base, cachepath='.cache/data/', storepath='.cache/baseline/', workers=None,
+                   incremental=True, store=None):
+    """
+    Evaluates the iot rows of many devices in one pipeline pass, see `wrap_mds`.
+
+    Parameters
+    ----------
+    dfs : dict
+        Rows of `ts` and `wave_url` of each device, None if it has no data.
+
+    store : BaselineStore
+        `store` is a loaded baseline store, shared by all the devices.
+
+    Returns
+    -------
+    out : dict
+        `wrap_mds` rows of each device, None if it has no data.
+    """
+    urls = [url for df in dfs.values() if df is not None for url in df['wave_url']]
+    # 1.download all the referenced wave files of all devices once.
+    fns = wavecache.get_cache(cachepath).fetch(urls)
+    objfiles = [fn for fn in dict.fromkeys(fns.values()) if fn is not None]
+    # 2.compute spectrum, cluster and MDS of all of them together, memoized ones are skipped.
+    out = {}
+    if len(objfiles) > 0:
+        out = mds_results(base, objfiles, cachepath, storepath, workers, incremental, store=store)
+    # 3.fan out per device and timestamp.
+    ret = {}
+    for dev, df in dfs.items():
+        if df is None:
+            ret[dev] = None
+            continue
+        ret[dev] = [{"ts": int(ts), "MDS": out.get(fns.get(url))} for ts, url in zip(df['ts'], df['wave_url'])]
     return ret
 
 
+def load_store(bp, storepath='.cache/baseline/', workers=None):
+    """
+    The baseline store of `bp` with its spectrum and fitted models loaded,
+    to be shared by the calls of a long running process.
+    """
+    store = baseline.BaselineStore(bp, storepath, workers=workers)
+    store.load()
+    store.cluster_model()
+    store.mds_model()
+    return store
+
+
+def score_waves(rows, bp, cachepath='.cache/data/', storepath='.cache/baseline/', workers=None, store=None):
+    """
+    Evaluates wave files as they arrive, see `subscriber.MqttSubscriber`.
+
+    Only the new files are downloaded and placed against the persisted
+    baseline models, nothing of the earlier arrivals is recomputed.
+
+    Parameters
+    ----------
+    rows : list
+        `{"ts": ts, "wave_url": url}` of each arrival.
+
+    store : BaselineStore
+        `store` is the baseline store loaded once by the caller, see
+        `load_store`, else it is loaded on each call.
+
+    Returns
+    -------
+    out : list
+        `{"ts": ts, "MDS": json}` of each row, see `wrap_mds`.
+    """
+    if len(rows) == 0:
+        return []
+    df = utils.pandas().DataFrame(rows, columns=['ts', 'wave_url'])
+    return wrap_mds(df, bp, cachepath, storepath, workers, store=store)
+
+
 def calculate_mds_indicator(modelparam, bp):
     idx = None
     try:
@@ -310,145 +465,115 @@ def calculate_mds_indicator(modelparam, bp):
         if not (df is None):
             if modelparam['obj'] == 'MDS':
                 idx = wrap_mds(df, bp)
-    except ValueError as ve:
-        logging.error('Exception occured.', ve)
-        pass
+    except (ValueError, OSError) as ve:  # OSError, e.g. a wave file evicted by another process meanwhile
+        logging.error(f'Exception occured: {ve}')
     return idx
 
 
-def compute_mdsdata(benchpath, objpath):
+def calculate_fleet_indicator(modelparam, bp, cachepath='.cache/data/', storepath='.cache/baseline/', workers=8,
+                              since=None):
     """
-    Determines soh according the given wave file.
+    Computes the MDS indicator of many devices in the same time window.
+
+    The baseline spectrum and models are loaded once, the telemetry of the
+    devices is fetched concurrently and all their wave files are scored in
+    one pipeline pass.
 
     Parameters
     ----------
-    benchpath : string
-        `benchpath` is a local path maintained that stores baseline data files.
+    modelparam : dict
+        Same as `calculate_mds_indicator` but `entityids`, the list of
+        device ids, in place of `entityid`.
 
-    objpath : string
-        `objpath` is a url to a csv file containing new spectrum samples.
+    bp : string
+        `bp` is the baseline path, see `fre2mds`.
+
+    cachepath : string
+        `cachepath` holds the wave files, see `WaveCache`.
+
+    storepath : string
+        `storepath` keeps the precomputed baseline spectrum, see `BaselineStore`.
+
+    workers : int
+        `workers` bounds the concurrent telemetry requests.
+
+    since : dict
+        `since` maps device ids to the last timestamp already scored in ms,
+        only their newer telemetry is fetched, see `scheduler.Scheduler`.
 
     Returns
     -------
-    out : DataFrame object
-        Details information include cid, color, pos, age etc.
+    out : dict
+        `{"ts": ts, "MDS": json}` rows of each device id, None if the device
+        has no data.
     """
+    idx = None
+    try:
+        entityids = list(dict.fromkeys(modelparam['entityids']))
+        st = round(datetime.timestamp(datetime.strptime(modelparam['stime'], '%Y-%m-%dT%X')) * 1000)
+        et = round(datetime.timestamp(datetime.strptime(modelparam['etime'], '%Y-%m-%dT%X')) * 1000)
 
-    sr = 20480  # sample rate
-    ws = 2048  # window size
+        since = {} if since is None else since
+
+        def job(entityid):
+            start = st if since.get(entityid) is None else max(st, since[entityid] + 1)
+            return get_iot_data(modelparam['iot'], modelparam['usr'], modelparam['pwd'], modelparam['entitytype'],
+                                entityid, modelparam['keys'], start, et)
+
+        dfs = {}
+        if len(entityids) > 0:
+            with ThreadPoolExecutor(max_workers=max(1, min(workers, len(entityids)))) as executor:
+                dfs = dict(zip(entityids, executor.map(job, entityids)))
+        if modelparam['obj'] == 'MDS':
+            store = baseline.BaselineStore(bp, storepath)
+            store.load()
+            idx = wrap_fleet_mds(dfs, bp, cachepath, storepath, store=store)
+    except (ValueError, OSError) as ve:  # OSError, e.g. a wave file evicted by another process meanwhile
+        logging.error(f'Exception occured: {ve}')
+    return idx
 
-    # 1.download the mat file if necessary.
-    fn = objpath.rsplit('/', 1)[-1]
-    cachepath = '.cache/data/'
-    local = f'{cachepath}{fn}'
-    if not os.path.exists(local):
-        retrieve_url_file(objpath, local)
 
-    # 2.read benchamark data files
-    datumn = []
-    mypath = benchpath
-    onlyfiles = [f for f in listdir(mypath) if isfile(join(mypath, f))]
+def compute_mdsdata(benchpath, objpath, storepath='.cache/baseline/', workers=None, plotpath='.cache/mds.png',
+                    cachepath='.cache/data/'):
+    """
+    Determines soh according the given wave file.
 
-    chunksize = 20480
-    agelist = []
-    for ii, item in enumerate(onlyfiles):
-        fractionlet = 0  # some segment is too short and should be drop out.
-        (de, fe) = utils.load_dat(item, mypath)
-        # segment by chunksize(default 20480)
-        for idx, subset in enumerate(range(0, len(de), chunksize)):
-            seg = de[subset: subset + chunksize]
-            if len(seg) > ws:
-                datumn.append(seg)
-                fractionlet += 1
-        agelist.append(fractionlet)  # each chunk contains idx+1 segments.
-    agelist = [28, 12, 52]  # FIXME: The benchmark datasets originally include three run to failure tests.
-    objpos = len(datumn)  # This position should be used to plot object sample.
-    logging.info(f'Benchmark data read {objpos} cnts of points.')
+    Parameters
+    ----------
+    benchpath : string
+        `benchpath` is a local path maintained that stores baseline data files.
 
-    # 3.read obj data files
-    mypath = cachepath  # Obj data from url, cached in local .cache directory.
-    onlyfiles = [f for f in listdir(mypath) if isfile(join(mypath, f))]
-
-    for ii, item in enumerate(onlyfiles):
-        fractionlet = 0  # some segment is too short and should be drop out.
-        (de, fe) = utils.load_dat(item, mypath)
-        # segment by chunksize(default 20480)
-        for idx, subset in enumerate(range(0, len(de), chunksize)):
-            seg = de[subset: subset + chunksize]
-            if len(seg) > ws:
-                datumn.append(seg)
-                fractionlet += 1
-        agelist.append(fractionlet)  # each chunk contains idx+1 segments.
-    logging.info('Total points(include obj ones): ', len(datumn))
+    objpath : string
+        `objpath` is a url to a csv file containing new spectrum samples.
 
-    # 4.fft and cluster
+    storepath : string
+        `storepath` keeps the precomputed baseline spectrum, see `BaselineStore`.
 
-    frequencies, spectrum = cluster.ts2fft(datumn, sr, ws)
-    clusternew_, dfnew = cluster.cluster_vectors(spectrum, False)
+    workers : int
+        `workers` is the process pool size to load and transform data files.
 
-    df2 = mds.dev_age_compute(spectrum, frequencies, agelist)  # should label at data reading phase.seg
-    pos = mds.compute_mds_pos(spectrum)
+    plotpath : string
+        `plotpath` is the .png or .svg file the MDS chart is rendered into.
 
-    logging.info(f'MDS pos computed.')
+    cachepath : string
+        `cachepath` holds the obj data files, see `WaveCache`.
 
-    # set color for each points in df2
-    df2.loc[:, 'color'] = '#000000'
-    for idx, elems in enumerate(dfnew['vectors']):
-        for el in elems:
-            df2.loc[el, 'color'] = dfnew.loc[idx, 'color']
-
-    # plot mds scatter chart
-    plt.figure(1)
-    plt.axes([0., 0., 1., 1.])
-    logging.info(f'Total {len(agelist)} cnts samples loaded.')
-    # collections = list(range(len(pos)))
-    # mask = dfnew[dfnew['cid'] == -1]['vectors'][0]
-    # dispindices = list(set(collections).difference(set(mask)))
-    dispindices = list(range(objpos))  # only plot benchmark points.
-    plt.scatter(x=pos[dispindices, 0],
-                y=pos[dispindices, 1],
-                s=df2.loc[dispindices, 'age'],
-                label=df2.loc[dispindices, 'color'],
-                edgecolors=df2.loc[dispindices, 'color'],
-                facecolors='none', marker='.', alpha=0.5, lw=1)
-    hnds = []
-    for idx, el in enumerate(dfnew['color']):
-        pop = mpatches.Patch(color=el, label=f'C: [{dfnew["cid"][idx]}], cnts:[{len(dfnew["vectors"][idx])}]')
-        hnds.append(pop)
-    plt.legend(handles=hnds, prop={'size': 6})
-    # label baseline points
-    # baseline should be the first points
-    # agelist = [24, 12, 24, 24, 6, ...]
-    # dfnew:
-    #       cid,       vectors
-    #        -1     [84,85,86,87, ...]
-    #         0     [156,157, ...]
-    #        ...
-    #         8     [0,1,2, ...]
-    # should label points: 0, 24, 36, 60
-    blcnts = 2
-    baselineclass = [0]
-    for idx, el in enumerate(agelist[0: blcnts]):
-        ps = baselineclass[idx] + el
-        baselineclass.append(ps)
-    # find baselineclass leader points in dfnew and
-    texts = []
-    for obj in baselineclass:  # 0, 24, 36, 60
-        for idx, vecs in enumerate(dfnew['vectors']):
-            if obj in vecs:
-                txt = f'{obj} in C: [{dfnew["cid"][idx]}]'
-                texts.append(plt.text(pos[obj, 0], pos[obj, 1], txt))
-    adjust_text(texts)
-
-    plt.scatter(x=pos[objpos:, 0],
-                y=pos[objpos:, 1],
-                label=df2.loc[objpos:, 'color'],
-                marker='*', s=300, color='k', alpha=0.5, lw=1)
-
-    for txt in list(range(objpos, len(datumn))):
-        plt.text(pos[txt, 0], pos[txt, 1], f'Object {txt}', c='#000000')
-
-    plt.show()
+    Returns
+    -------
+    out : DataFrame object
+        Details information include cid, color, pos, age etc.
+    """
+    # 1.download the mat file if necessary.
+    fn = wavecache.get_cache(cachepath).fetch([objpath])[objpath]
+    if fn is None:
+        return 0
+
+    # 2.fit cluster and MDS over all the points
+    res = mds_pipeline(benchpath, cachepath, storepath, workers, incremental=False, objfiles=[fn])
+    logging.info(f'Total {len(res["agelist"])} cnts samples loaded.')
+
+    # 3.plot mds scatter chart
+    render.render_mds(res, plotpath, 'Object')
     logging.info('---over---')
 
     return 1
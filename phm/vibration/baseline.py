@@ -0,0 +1,213 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+baseline module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Precomputed baseline spectrum store.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import os
+import json
+import hashlib
+import logging
+import numpy as np
+from os import listdir
+from os.path import isfile, join
+from phm.vibration import cluster, ingest, mds
+
+
+class BaselineStore:
+    """
+    Baseline spectrum computed once and kept on disk.
+
+    The store directory holds five files:
+
+    * ``spectrum.npy``, all baseline spectrum vectors, one row per segment.
+    * ``frequency.npy``, frequency components shared by all the vectors.
+    * ``manifest.json``, name, size and mtime of each baseline file and the
+      rows its segments occupy in ``spectrum.npy``.
+    * ``mds.npz``, the baseline MDS configuration, see `mds_model`.
+    * ``hdbscan.pkl``, the baseline cluster model, see `cluster_model`.
+
+    Only the files added or modified since the last load are read and
+    transformed again, unchanged ones are taken from ``spectrum.npy``.
+    """
+    manifest_ = 'manifest.json'
+    spectrum_ = 'spectrum.npy'
+    frequency_ = 'frequency.npy'
+    mds_ = 'mds.npz'
+    cluster_ = 'hdbscan.pkl'
+
+    # Constructor
+    def __init__(self, benchpath, storepath='.cache/baseline/', samplerate=20480, nperseg=2048, chunksize=20480,
+                 workers=None):
+        self.benchpath_ = benchpath
+        self.storepath_ = storepath
+        self.workers_ = workers  # process pool size to transform the changed files
+        self.params_ = {
+            'benchpath': os.path.abspath(benchpath),
+            'samplerate': samplerate,
+            'nperseg': nperseg,
+            'chunksize': chunksize
+        }
+        self.files = []         # baseline file names, in segment order
+        self.frequencies = None
+        self.spectrum = None    # (n_segments, n_frequencies)
+        self.agelist = []       # segment counts of each baseline file
+        self.version = None     # digest of the manifest
+        self.models_ = {}       # baseline models loaded by this instance
+
+    def _scan(self):
+        onlyfiles = sorted(f for f in listdir(self.benchpath_) if isfile(join(self.benchpath_, f)))
+        entries = []
+        for item in onlyfiles:
+            st = os.stat(join(self.benchpath_, item))
+            entries.append({'name': item, 'size': st.st_size, 'mtime': st.st_mtime_ns})
+        return entries
+
+    def _read(self):
+        try:
+            with open(join(self.storepath_, self.manifest_)) as f:
+                manifest = json.load(f)
+            if manifest['params'] != self.params_:
+                return None, None, None
+            spectrum = np.load(join(self.storepath_, self.spectrum_), mmap_mode='r')
+            frequencies = np.load(join(self.storepath_, self.frequency_))
+            return manifest, frequencies, spectrum
+        except (OSError, ValueError, KeyError) as err:
+            logging.info(f'Baseline store is rebuilt: {err}')
+            return None, None, None
+
+    def _save(self, np_name, arr):
+        tmp = join(self.storepath_, f'.{np_name}.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, arr)
+        os.replace(tmp, join(self.storepath_, np_name))
+
+    def _write(self, manifest, frequencies, spectrum):
+        os.makedirs(self.storepath_, exist_ok=True)
+        self._save(self.spectrum_, spectrum)
+        self._save(self.frequency_, frequencies)
+        tmp = join(self.storepath_, f'.{self.manifest_}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        # manifest is replaced at last, so it never refers to stale arrays.
+        os.replace(tmp, join(self.storepath_, self.manifest_))
+
+    def load(self):
+        """
+        Load the baseline spectrum, recompute the changed files only.
+
+        Returns
+        -------
+        A tuple, `(frequencies, spectrum, agelist)`
+            The spectrum is a (n_segments, n_frequencies) array and agelist
+            counts the segments of each baseline file.
+        """
+        entries = self._scan()
+        manifest, frequencies, spectrum = self._read()
+        frequencies = np.empty(0) if frequencies is None else frequencies
+        cached = {}
+        if manifest is not None:
+            cached = {(el['name'], el['size'], el['mtime']): el for el in manifest['files']}
+
+        missing = [el['name'] for el in entries if (el['name'], el['size'], el['mtime']) not in cached]
+        fresh = dict(ingest.ingest_files(missing, self.benchpath_, self.params_['samplerate'],
+                                         self.params_['nperseg'], self.params_['chunksize'], workers=self.workers_))
+        if len(missing) > 0:
+            frequencies = np.fft.rfftfreq(self.params_['nperseg'], 1 / self.params_['samplerate'])
+
+        blocks = []
+        changed = manifest is None or len(manifest['files']) != len(entries)
+        start = 0
+        for el in entries:
+            hit = cached.get((el['name'], el['size'], el['mtime']))
+            if hit is not None:
+                block = spectrum[hit['start']: hit['start'] + hit['count']]
+                changed = changed or hit['start'] != start
+            else:
+                block = fresh[el['name']]
+                changed = True
+            el['start'] = start
+            el['count'] = len(block)
+            start += len(block)
+            blocks.append(block)
+
+        if changed:
+            blocks = [block for block in blocks if len(block) > 0]
+            spectrum = np.concatenate(blocks) if len(blocks) > 0 else np.empty((0, 0))
+            manifest = {'params': self.params_, 'files': entries}
+            self._write(manifest, frequencies, spectrum)
+            logging.info(f'Baseline store updated: {len(entries)} files, {start} segments.')
+
+        self.files = [el['name'] for el in entries]
+        self.agelist = [el['count'] for el in entries]
+        self.frequencies = frequencies
+        self.spectrum = spectrum
+        self.version = hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+        return self.frequencies, self.spectrum, self.agelist
+
+    def mds_model(self):
+        """
+        Baseline MDS configuration, fitted once for each store version.
+
+        New spectrum vectors are placed into it by `mds.place_mds_pos`.
+        """
+        if self.mds_ in self.models_:
+            return self.models_[self.mds_]
+        path = join(self.storepath_, self.mds_)
+        model = mds.load_mds_model(path, self.version)
+        if model is None:
+            model = mds.fit_mds_model(self.spectrum)
+            mds.save_mds_model(model, path, self.version)
+            logging.info(f'Baseline MDS model fitted: {len(self.spectrum)} points.')
+        self.models_[self.mds_] = model
+        return model
+
+    def cluster_model(self):
+        """
+        Baseline HDBSCAN model, fitted once for each store version.
+
+        New spectrum vectors are assigned by `cluster.predict_clusters`.
+        """
+        if self.cluster_ in self.models_:
+            return self.models_[self.cluster_]
+        path = join(self.storepath_, self.cluster_)
+        clusterer = cluster.load_cluster_model(path, self.version)
+        if clusterer is None:
+            clusterer = cluster.fit_cluster_model(self.spectrum)
+            cluster.save_cluster_model(clusterer, path, self.version)
+            logging.info(f'Baseline cluster model fitted: {len(self.spectrum)} points.')
+        self.models_[self.cluster_] = clusterer
+        return clusterer
+
+    def model_version(self):
+        """
+        Digest of the baseline and its fitted models, results computed from
+        the models are valid as long as it does not change.
+        """
+        self.mds_model()
+        self.cluster_model()
+        stamps = [os.stat(join(self.storepath_, name)).st_mtime_ns for name in (self.mds_, self.cluster_)]
+        return hashlib.sha1(f'{self.version}:{stamps}'.encode()).hexdigest()
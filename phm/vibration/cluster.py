@@ -27,11 +27,43 @@ Cluster and fft functions.
 # Author: Awen <26896225@qq.com>
 # License: MIT
 
-import logging
+import os
+import pickle
 import numpy as np
-import pandas as pd
-import hdbscan
-from scipy import signal
+from phm.modules import utils
+
+
+def welch_batch(segments, samplerate, nperseg, dtype=np.float64):
+    """
+    This function computes the power spectral density of many segments in one call.
+    Parameters
+    ----------
+    segments : 2-D array
+        Input signal of shape (n_segments, chunksize), a strided view of one
+        long signal is accepted without copy.
+    samplerate : int
+        The sample rate of the input signals.
+    nperseg : int
+        Length of each welch window, must not exceed chunksize.
+    dtype : numpy dtype, optional
+        float32 or float64 of the returned spectrum.
+    Returns
+    -------
+    A tuple, `(frequencies, spectrum)`
+        Spectrum is a contiguous (n_segments, n_frequencies) array.
+    Raises
+    ------
+    ValueError
+        If segments are not 2-D or shorter than `nperseg`.
+    """
+    segs = np.asarray(segments, dtype=dtype)
+    if segs.ndim != 2:
+        raise ValueError(f'Segments should be a 2-D array, got {segs.ndim}-D.')
+    if segs.shape[1] < nperseg:
+        raise ValueError(f'Segment length {segs.shape[1]} is shorter than nperseg {nperseg}.')
+    from scipy import signal  # loaded on demand, see `phm.LAZY`
+    fre, psd = signal.welch(segs, fs=samplerate, scaling='density', nperseg=nperseg, axis=-1)
+    return fre, np.ascontiguousarray(psd, dtype=dtype)
 
 
 def ts2fft(datumn, samplerate, nperseg):
@@ -39,9 +71,9 @@ def ts2fft(datumn, samplerate, nperseg):
     This function computes all the one-dimensional time domain signals by FFT.
     Parameters
     ----------
-    datumn : array of timeseries(list)
+    datumn : array of timeseries(list) or 2-D array
         Input signal is list array, list element contain many sample points
-        in time domain.
+        in time domain. A 2-D array is transformed by `welch_batch` directly.
     samplerate : int
         The sample rate of the input signals. All signals are assumed as the
         same sample rate.
@@ -51,31 +83,39 @@ def ts2fft(datumn, samplerate, nperseg):
     Returns
     -------
     A tuple, `(frequencies, spectrumn_vectors)`
-        The result of datumn transform by fft.
+        The result of datumn transform by fft, spectrum vectors are rows of
+        a (len(datumn), n_frequencies) array.
     Raises
     ------
+    ValueError
+        If a signal is shorter than `nperseg`, see `welch_batch`.
     See Also
     --------
+    welch_batch
     Notes
     -----
+    Segments of the same length are transformed in one batch, so the ragged
+    tail of each file costs one more `welch` call instead of breaking the
+    batch. Segments shorter than `nperseg` are rejected.
     References
     ----------
     Examples
     --------
     >>>
     """
-    try:
-        fre = None
-        spectrum_list = []
-        # Because frequency domain is symmetrical, take only positive frequencies
-        for idx, sig in enumerate(datumn):
-            fre, amp = signal.welch(sig, fs=samplerate, scaling='density', nperseg=nperseg)
-            spectrum_list.append(np.abs(amp))
-    except BaseException as err:
-        logging.error(err)
-        fre = None
-        spectrum_list = []
-    return fre, spectrum_list
+    if isinstance(datumn, np.ndarray) and datumn.ndim == 2:
+        return welch_batch(datumn, samplerate, nperseg)
+    fre = None
+    spectrum = np.empty((0, 0))
+    lengths = np.array([len(sig) for sig in datumn])
+    # Because frequency domain is symmetrical, take only positive frequencies
+    for length in np.unique(lengths):
+        indices = np.flatnonzero(lengths == length)
+        fre, amp = welch_batch(np.stack([datumn[idx] for idx in indices]), samplerate, nperseg)
+        if len(spectrum) == 0:
+            spectrum = np.empty((len(datumn), amp.shape[1]), dtype=amp.dtype)
+        spectrum[indices] = amp
+    return fre, spectrum
 
 
 def cluster_vectors(vectors, predict=True):
@@ -102,6 +142,26 @@ def cluster_vectors(vectors, predict=True):
     --------
     >>>
     """
+    import hdbscan
+    dat = np.asarray(vectors)
+    clusterer = hdbscan.HDBSCAN(min_cluster_size=10, prediction_data=predict).fit(dat)
+    return clusterer, cluster_frame(clusterer.labels_)
+
+
+def cluster_frame(labels, cids=None):
+    """
+    This function groups the vector indices by cluster label.
+    ----------
+    labels : array of int
+        Cluster label of each vector, -1 for outliers.
+    cids : array of int, optional
+        Cluster ids colored first, e.g. the baseline clusters, so the colors
+        do not depend on the labels of new vectors. Other labels follow.
+    Returns
+    -------
+    out : DataFrame object
+        Dataframe's columns are cluster id, color, vector indices.
+    """
     # 聚类数量和对应颜色空间
     # https://jdherman.github.io/colormap/
     # ['#35ffcc', '#7cdc66', '#c3b900', '#e15d61', '#ff00c3', '#df5ee1', '#bfbbff', '#7ddde0', '#000000']
@@ -114,10 +174,13 @@ def cluster_vectors(vectors, predict=True):
                    '#0108f8', '#0129d7', '#014ab6', '#006b95', '#008c74', '#00ad53', '#00ce32', '#00ef11',
                    '#0def0c', '#26ce25', '#3fad3e', '#588c56', '#716b6f', '#8a4a87', '#a329a0', '#bc08b9',
                    '#c212ac', '#c22b94', '#c2437b', '#c25c63', '#c2754a', '#c38d31', '#c3a619', '#c3be00'])
-    dat = np.array([list(vec) for vec in vectors])
-    clusterer = hdbscan.HDBSCAN(min_cluster_size=10, prediction_data=predict).fit(dat)
-    cids = np.unique(clusterer.labels_)
-    labels = clusterer.labels_
+    labels = np.asarray(labels)
+    if cids is None:
+        cids = np.unique(labels)
+    else:
+        cids = np.unique(cids)
+        cids = np.concatenate([cids, np.setdiff1d(np.unique(labels), cids)])
+    pd = utils.pandas()
     df = pd.DataFrame(cids, columns=['cid'])
     cl = []
     iii = 0
@@ -127,4 +190,52 @@ def cluster_vectors(vectors, predict=True):
         iii += 3
     df['color'] = cl
     df['vectors'] = [list(np.where(labels == sid)[0]) for sid in cids]
-    return clusterer, df
+    return df
+
+
+def fit_cluster_model(vectors):
+    """
+    This function fits the baseline cluster model once, ready for prediction.
+    """
+    import hdbscan
+    return hdbscan.HDBSCAN(min_cluster_size=10, prediction_data=True).fit(np.asarray(vectors))
+
+
+def save_cluster_model(clusterer, path, version=''):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump({'version': version, 'model': clusterer}, f)
+    os.replace(tmp, path)
+
+
+def load_cluster_model(path, version=''):
+    """
+    Load the cluster model saved by `save_cluster_model`, None if it is
+    missing or fitted for another baseline version.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        return data['model'] if data['version'] == version else None
+    except (OSError, KeyError, pickle.UnpicklingError, EOFError):
+        return None
+
+
+def predict_clusters(clusterer, vectors):
+    """
+    This function assigns new vectors to the clusters of a fitted model.
+    ----------
+    clusterer : hdbscan.HDBSCAN
+        Model fitted with `prediction_data=True`, see `fit_cluster_model`.
+    vectors : array of frequency vectors
+        New vectors, predicted in one batch.
+    Returns
+    -------
+    A tuple, `(labels, strengths)`
+        Cluster label (-1 for outliers) and membership strength of each vector.
+    """
+    vectors = np.asarray(vectors)
+    if len(vectors) == 0:
+        return np.empty(0, dtype=int), np.empty(0)
+    import hdbscan
+    return hdbscan.approximate_predict(clusterer, vectors)
@@ -0,0 +1,120 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+ingest module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Load, segment and transform many data files on a process pool.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import os
+import functools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from phm.vibration import segment, streaming
+
+STREAMBYTES = 256 << 20     # data files larger than this are read and transformed block by block
+
+
+def file_spectrum(file, path, samplerate=20480, nperseg=2048, chunksize=20480, hop=None, sidecar=False):
+    """
+    Load one data file, segment it and transform the segments. Files larger
+    than `STREAMBYTES` go through `streaming.stream_spectrum`, which gives the
+    same rows without holding the file in memory.
+
+    Returns
+    -------
+    out : 2-D array
+        (n_segments, nperseg // 2 + 1) spectrum of the file.
+    """
+    if os.path.getsize(f'{path}{file}') > STREAMBYTES:
+        return streaming.stream_spectrum(file, path, samplerate, nperseg, chunksize, hop, sidecar)
+    segs = segment.load_segments([file], path, chunksize, nperseg, hop, sidecar)
+    fre, spec = segs.spectrum(samplerate, nperseg)
+    return spec
+
+
+def ingest_files(files, path, samplerate=20480, nperseg=2048, chunksize=20480, hop=None, sidecar=False,
+                 workers=None):
+    """
+    Compute the spectrum of each data file, on a process pool if asked.
+
+    Parameters
+    ----------
+    files : list
+        Data file names.
+    path : string
+        Directory of the data files, ends with '/'.
+    workers : int, optional
+        Size of the process pool, None or 1 runs in the calling process.
+
+    Yields
+    ------
+    A tuple, `(file, spectrum)`
+        In the order of `files`, each one as soon as it and all the files
+        before it are finished. The segment order (and the age and device
+        labels computed from it) never depends on the pool scheduling.
+    """
+    job = functools.partial(file_spectrum, path=path, samplerate=samplerate, nperseg=nperseg,
+                            chunksize=chunksize, hop=hop, sidecar=sidecar)
+    if workers is None or workers <= 1 or len(files) <= 1:
+        for item in files:
+            yield item, job(item)
+        return
+    with ProcessPoolExecutor(max_workers=min(workers, len(files))) as executor:
+        yield from zip(files, executor.map(job, files))
+
+
+def ingest_spectrum(files, path, samplerate=20480, nperseg=2048, chunksize=20480, hop=None, sidecar=False,
+                    workers=None, cache=None):
+    """
+    Compute the spectrum of all data files, see `ingest_files`.
+
+    Parameters
+    ----------
+    cache : ResultCache, optional
+        Spectrum of each file is memoized by its content hash and the fft
+        parameters, only the files not in the cache are transformed.
+
+    Returns
+    -------
+    A tuple, `(frequencies, spectrum, agelist)`
+        Spectrum rows follow the file order, agelist counts the segments of
+        each file.
+    """
+    fre = np.fft.rfftfreq(nperseg, 1 / samplerate)
+    specs = {}
+    keys = {}
+    if cache is not None:
+        for item in files:
+            keys[item] = f'spec:{cache.file_hash(f"{path}{item}")}:{samplerate}:{nperseg}:{chunksize}:{hop}:{sidecar}'
+            specs[item] = cache.get(keys[item])
+    missing = [item for item in files if specs.get(item) is None]
+    for item, spec in ingest_files(missing, path, samplerate, nperseg, chunksize, hop, sidecar, workers):
+        specs[item] = spec
+        if cache is not None:
+            cache.put(keys[item], spec)
+    blocks = [specs[item] for item in files]
+    agelist = [len(spec) for spec in blocks]
+    spectrum = np.concatenate(blocks) if len(blocks) > 0 else np.empty((0, len(fre)))
+    return fre, spectrum, agelist
@@ -27,11 +27,15 @@ Exploring->Clustering->MDS->Predicting.
 # Author: Awen <26896225@qq.com>
 # License: MIT
 
-import pandas as pd
+import os
 import numpy as np
-from sklearn import manifold
-from sklearn.metrics import euclidean_distances
-from sklearn.decomposition import PCA
+from concurrent.futures import ThreadPoolExecutor
+from phm.modules import utils
+
+SMACOFMAX = 3000    # vectors embedded by the PCA started SMACOF, landmark MDS beyond
+LANDMARKS = 500     # landmarks of the landmark MDS
+REFINE = 30         # majorization steps placing the other vectors against the landmarks
+BLOCK = 1024        # rows of a distance block
 
 
 def dev_age_compute(vectors, freqs, segment):
@@ -51,6 +55,7 @@ def dev_age_compute(vectors, freqs, segment):
     out: DataFrame object
         Dataframe's columns are frequency components, dev, and age.
     """
+    pd = utils.pandas()
     df = pd.DataFrame(vectors, columns=freqs)
 
     devs = []
@@ -67,19 +72,358 @@ def dev_age_compute(vectors, freqs, segment):
     return df
 
 
-def compute_mds_pos(vectors):
+def exact_mds_pos(vectors):
+    """
+    This function embeds the vectors by the full sklearn metric MDS.
+    ----------
+    vectors : array of frequency vectors
+        Dense float64 distances and 3000 SMACOF iterations from 4 random
+        starts, fine for a few hundred vectors only.
+    Returns
+    -------
+    out: array
+        (n_vectors, 2) positions, not rotated yet.
+    Notes
+    -----
+    Kept as the stress reference of the tests only, `mds_backend` never
+    selects it: the random starts are not reproducible and the PCA started
+    `smacof_mds_pos` comes within a few percent of its stress, also for
+    small baselines.
+    """
+    from sklearn import manifold  # loaded on demand, see `phm.LAZY`
+    from sklearn.metrics import euclidean_distances
     similarities = euclidean_distances(vectors)
     # vecs = np.array([list(vec) for vec in vectors])
     mds = manifold.MDS(n_components=2, max_iter=3000, eps=1e-9,
                        dissimilarity="precomputed", n_jobs=1)
-    pos = mds.fit(similarities).embedding_
+    return mds.fit(similarities).embedding_
+
+
+def blocked_distances(x, y=None, block=BLOCK, dtype=np.float32, workers=None):
+    """
+    This function computes the euclidean distances in row blocks.
+    ----------
+    x : array
+        (n, d) vectors.
+    y : array, optional
+        (m, d) vectors, `x` by default.
+    block : int, optional
+        Rows of `x` computed at once, bounds the temporary memory.
+    dtype : dtype, optional
+        float32 halves the memory of the (n, m) result.
+    workers : int, optional
+        Threads computing the blocks, the matrix products release the GIL.
+    Returns
+    -------
+    out: array
+        (n, m) distances.
+    """
+    x = np.asarray(x, dtype=dtype)
+    y = x if y is None else np.asarray(y, dtype=dtype)
+    out = np.empty((len(x), len(y)), dtype=dtype)
+    yy = np.einsum('ij,ij->i', y, y)
+
+    def job(start):
+        xb = x[start: start + block]
+        d = out[start: start + block]
+        np.matmul(xb, y.T, out=d)
+        d *= -2
+        d += np.einsum('ij,ij->i', xb, xb)[:, None]
+        d += yy[None, :]
+        np.maximum(d, 0, out=d)
+        np.sqrt(d, out=d)
+        if y is x:  # exact zeros on the diagonal despite the rounding
+            np.fill_diagonal(d[:, start:], 0)
+
+    starts = range(0, len(x), block)
+    if workers is None or workers <= 1 or len(x) <= block:
+        for start in starts:
+            job(start)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(job, starts))
+    return out
+
+
+def smacof_mds_pos(vectors, max_iter=300, eps=1e-4, block=BLOCK, workers=None, dis=None):
+    """
+    This function embeds the vectors by SMACOF started from their PCA projection.
+    ----------
+    vectors : array of frequency vectors
+        Vectors to embed.
+    max_iter : int, optional
+        Maximum Guttman transforms.
+    eps : float, optional
+        Stop when the relative decrease of the stress is below `eps`.
+    block : int, optional
+        Rows updated at once, see `blocked_distances`.
+    workers : int, optional
+        Threads updating the row blocks.
+    dis : array, optional
+        Precomputed (n, n) distances of the vectors.
+    Returns
+    -------
+    out: array
+        (n_vectors, 2) positions, not rotated yet.
+    Notes
+    -----
+    A PCA start is already close to the optimum for spectra dominated by a
+    few components, so tens of iterations replace the 3000 of four random
+    starts. Only the float32 distance matrix is kept in memory, the
+    distances of the configuration are computed block by block.
+    """
+    vectors = np.asarray(vectors)
+    n = len(vectors)
+    if n < 3:
+        return np.zeros((n, 2))
+    if dis is None:
+        dis = blocked_distances(vectors, block=block, workers=workers)
+    from sklearn.decomposition import PCA
+    pos = PCA(n_components=2).fit_transform(vectors)
+    # scale the start to fit the distances best
+    dist = blocked_distances(pos, block=block, dtype=np.float64, workers=workers)
+    # sums accumulate in float64 without n x n temporaries
+    pos *= np.einsum('ij,ij->', dis, dist, dtype=np.float64) / max(np.einsum('ij,ij->', dist, dist), 1e-12)
+    del dist
+    norm = np.einsum('ij,ij->', dis, dis, dtype=np.float64) / 2
+    starts = range(0, n, block)
+    old = None
+    for _ in range(max_iter):
+        update = np.empty_like(pos)
+        stress = np.zeros(len(starts))
+
+        def job(idx):
+            start = starts[idx]
+            d = blocked_distances(pos[start: start + block], pos, block=block, dtype=np.float64)
+            stress[idx] = ((dis[start: start + block] - d) ** 2).sum()
+            ratio = np.divide(dis[start: start + block], d, out=np.zeros_like(d), where=d > 1e-12)
+            update[start: start + block] = (ratio.sum(axis=1)[:, None] * pos[start: start + block] - ratio @ pos) / n
+
+        if workers is None or workers <= 1 or len(starts) == 1:
+            for idx in range(len(starts)):
+                job(idx)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(job, range(len(starts))))
+        stress = stress.sum() / 2 / norm  # each pair is counted twice
+        if old is not None and old - stress < eps * old:
+            break
+        old = stress
+        pos = update
+    return pos
+
+
+def pick_landmarks(vectors, landmarks=LANDMARKS, seed=0):
+    """
+    This function picks landmarks by max-min (farthest point) sampling.
+    ----------
+    vectors : array of frequency vectors
+        Vectors to pick from.
+    landmarks : int, optional
+        Landmarks to pick, at most the vector count.
+    seed : int, optional
+        Seed of the first landmark.
+    Returns
+    -------
+    out: array
+        Distinct indices of the landmarks, in picking order.
+    """
+    vectors = np.asarray(vectors)
+    n = len(vectors)
+    landmarks = min(landmarks, n)
+    vecs = vectors.astype(np.float32)
+    norms = np.einsum('ij,ij->i', vecs, vecs)
+    idx = [int(np.random.default_rng(seed).integers(n))]
+    mindis = np.full(n, np.inf, dtype=np.float32)
+    for _ in range(landmarks - 1):
+        # squared distances to the newest landmark, the farthest vector from all of them is the next one.
+        # float32 cancellation may leave them slightly negative, or positive for the landmark itself.
+        dis = norms + norms[idx[-1]] - 2 * (vecs @ vecs[idx[-1]])
+        np.minimum(mindis, np.maximum(dis, 0), out=mindis)
+        mindis[idx[-1]] = -np.inf  # never picked again
+        idx.append(int(np.argmax(mindis)))
+    return np.array(idx)
+
+
+def landmark_mds_pos(vectors, landmarks=LANDMARKS, refine=REFINE, block=BLOCK, workers=None, seed=0):
+    """
+    This function embeds many vectors through a subset of landmarks.
+    ----------
+    vectors : array of frequency vectors
+        Vectors to embed.
+    landmarks : int, optional
+        Landmarks picked by max-min (farthest point) sampling, see
+        `pick_landmarks`.
+    refine : int, optional
+        Maximum iterations placing each other vector, see `place_mds_pos`.
+    seed : int, optional
+        Seed of the first landmark.
+    Returns
+    -------
+    out: array
+        (n_vectors, 2) positions, not rotated yet.
+    Notes
+    -----
+    The landmarks are embedded by `smacof_mds_pos`, the other vectors are
+    placed against them by `place_mds_pos`, so memory and time are
+    O(n * landmarks) instead of O(n ** 2).
+    """
+    vectors = np.asarray(vectors)
+    n = len(vectors)
+    idx = pick_landmarks(vectors, landmarks, seed)
+    model = {'vectors': vectors[idx], 'pos': smacof_mds_pos(vectors[idx], block=block, workers=workers)}
+    pos = np.empty((n, 2))
+    pos[idx] = model['pos']
+    rest = np.setdiff1d(np.arange(n), idx)
+    chunks = [rest[start: start + block] for start in range(0, len(rest), block)]
+
+    def job(chunk):
+        pos[chunk] = place_mds_pos(model, vectors[chunk], max_iter=refine, eps=1e-4)
+
+    if workers is None or workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            job(chunk)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(job, chunks))
+    return pos
+
+
+BACKENDS = {
+    'exact': exact_mds_pos,     # stress reference of the tests, never selected by 'auto'
+    'smacof': smacof_mds_pos,
+    'landmark': landmark_mds_pos,
+}
+
+
+def mds_backend(n):
+    """
+    This function selects the embedding backend by the sample count.
+
+    Small baselines are embedded by 'smacof' too, 'exact' is only the stress
+    reference of the tests, see `exact_mds_pos`.
+    """
+    if n <= SMACOFMAX:
+        return 'smacof'
+    return 'landmark'
+
+
+def compute_mds_pos(vectors, method='auto', **kwargs):
+    """
+    This function embeds the frequency vectors into a 2-D plane.
+    ----------
+    vectors : array of frequency vectors
+        Vectors to embed.
+    method : string, optional
+        A key of `BACKENDS`, 'auto' selects it by `mds_backend`. More
+        backends can be registered in `BACKENDS`.
+    kwargs : dict, optional
+        Passed to the backend, e.g. `workers`.
+    Returns
+    -------
+    out: array
+        (n_vectors, 2) positions, rotated to their principal axes.
+    """
+    vectors = np.asarray(vectors)
+    if method == 'auto':
+        method = mds_backend(len(vectors))
+    pos = BACKENDS[method](vectors, **kwargs)
 
     # Rescale the data
     # pos *= np.sqrt((vecs ** 2).sum()) / np.sqrt((pos ** 2).sum())
 
     # Rotate the data
+    from sklearn.decomposition import PCA
     clf = PCA(n_components=2)
     # vecs = clf.fit_transform(vecs)
 
     pos = clf.fit_transform(pos)
     return pos
+
+
+def fit_mds_model(vectors):
+    """
+    This function fits the MDS configuration of the baseline vectors once.
+    ----------
+    vectors : array of frequency vectors
+        Baseline vectors, they keep fixed positions afterwards.
+    Returns
+    -------
+    out: dict
+        Baseline `vectors` and their 2-D positions `pos`.
+    """
+    vectors = np.asarray(vectors)
+    return {'vectors': vectors, 'pos': compute_mds_pos(vectors)}
+
+
+def save_mds_model(model, path, version=''):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, vectors=model['vectors'], pos=model['pos'], version=np.array(version))
+    os.replace(tmp, path)
+
+
+def load_mds_model(path, version=''):
+    """
+    Load the MDS model saved by `save_mds_model`, None if it is missing or
+    fitted for another baseline version.
+    """
+    try:
+        with np.load(path) as data:
+            if str(data['version']) != version:
+                return None
+            return {'vectors': data['vectors'], 'pos': data['pos']}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def place_mds_pos(model, vectors, max_iter=300, eps=1e-6, k=5):
+    """
+    This function places new vectors into the frozen baseline configuration.
+    ----------
+    model : dict
+        Baseline configuration from `fit_mds_model`.
+    vectors : array of frequency vectors
+        New vectors to place.
+    max_iter : int, optional
+        Maximum iterations of the majorization.
+    eps : float, optional
+        Relative tolerance of the position update to stop.
+    k : int, optional
+        Nearest baseline vectors used to initialize the positions.
+    Returns
+    -------
+    out: array
+        (n_vectors, 2) positions in the baseline coordinates.
+    Notes
+    -----
+    Each new point minimizes its own stress against the baseline points,
+    sum_i (||x - p_i|| - d_i) ** 2, by the SMACOF (Guttman) update with the
+    baseline positions p_i held fixed. New points never move the baseline
+    nor each other, so the position of a vector does not depend on the
+    other vectors placed with it.
+    """
+    vectors = np.asarray(vectors)
+    base = model['pos']
+    if len(vectors) == 0:
+        return np.empty((0, base.shape[1]))
+    from sklearn.metrics import euclidean_distances
+    dis = euclidean_distances(vectors, model['vectors'])  # (m, n)
+    # start from the inverse distance weighted nearest baseline points
+    k = min(k, len(base))
+    nearest = np.argsort(dis, axis=1)[:, :k]
+    weights = 1 / (np.take_along_axis(dis, nearest, axis=1) + 1e-12)
+    pos = (weights[:, :, None] * base[nearest]).sum(axis=1) / weights.sum(axis=1, keepdims=True)
+    scale = np.ptp(base, axis=0).max() + 1e-12
+    active = np.arange(len(pos))  # each point stops on its own, whatever else is in the batch
+    for _ in range(max_iter):
+        diff = pos[active, None, :] - base[None, :, :]  # (m, n, 2)
+        dist = np.linalg.norm(diff, axis=2)
+        ratio = np.divide(dis[active], dist, out=np.zeros_like(dist), where=dist > 1e-12)
+        update = (base[None, :, :] + ratio[:, :, None] * diff).mean(axis=1)
+        shift = np.abs(update - pos[active]).max(axis=1)
+        pos[active] = update
+        active = active[shift >= eps * scale]
+        if len(active) == 0:
+            break
+    return pos
@@ -0,0 +1,143 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+render module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Headless MDS scatter chart, written to PNG/SVG by the Agg backend.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from phm.modules import metrics
+
+executor_ = None  # background renderer, created at the first submit.
+
+
+@metrics.Stage('plot')
+def render_mds(res, path, prefix='PT'):
+    """
+    Plot the MDS scatter chart of a pipeline result into a file.
+
+    Parameters
+    ----------
+    res : dict
+        Result of `phm.mds_pipeline`.
+    path : string
+        Output file, the format follows its extension (.png, .svg, ...).
+    prefix : string, optional
+        Label prefix of the object points.
+
+    Returns
+    -------
+    out : string
+        The output file.
+    """
+    from matplotlib.figure import Figure  # loaded on demand, see `phm.LAZY`
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib import patches as mpatches
+    from adjustText import adjust_text
+    pos = res['pos']
+    df2 = res['df2']
+    dfnew = res['dfnew']
+    objpos = res['objpos']
+    agelist = res['agelist']
+    # a figure bound to the Agg canvas never touches pyplot or a display.
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_axes([0., 0., 1., 1.])
+    # collections = list(range(len(pos)))
+    # mask = dfnew[dfnew['cid'] == -1]['vectors'][0]
+    # dispindices = list(set(collections).difference(set(mask)))
+    dispindices = list(range(objpos))  # only plot benchmark points.
+    ax.scatter(x=pos[dispindices, 0],
+               y=pos[dispindices, 1],
+               s=df2.loc[dispindices, 'age'],
+               label=df2.loc[dispindices, 'color'],
+               edgecolors=df2.loc[dispindices, 'color'],
+               facecolors='none', marker='.', alpha=0.5, lw=1)
+    hnds = []
+    for idx, el in enumerate(dfnew['color']):
+        pop = mpatches.Patch(color=el, label=f'C: [{dfnew["cid"][idx]}], cnts:[{len(dfnew["vectors"][idx])}]')
+        hnds.append(pop)
+    ax.legend(handles=hnds, prop={'size': 6})
+    # label baseline points
+    # baseline should be the first points
+    # agelist = [24, 12, 24, 24, 6, ...]
+    # dfnew:
+    #       cid,       vectors
+    #        -1     [84,85,86,87, ...]
+    #         0     [156,157, ...]
+    #        ...
+    #         8     [0,1,2, ...]
+    # should label points: 0, 24, 36, 60
+    blcnts = 2
+    baselineclass = [0]
+    for idx, el in enumerate(agelist[0: blcnts]):
+        ps = baselineclass[idx] + el
+        baselineclass.append(ps)
+    # find baselineclass leader points in dfnew and
+    texts = []
+    for obj in baselineclass:  # 0, 24, 36, 60
+        for idx, vecs in enumerate(dfnew['vectors']):
+            if obj in vecs:
+                txt = f'{obj} in C: [{dfnew["cid"][idx]}]'
+                texts.append(ax.text(pos[obj, 0], pos[obj, 1], txt))
+    adjust_text(texts, ax=ax)
+    # label object points
+    ax.scatter(x=pos[objpos:, 0],
+               y=pos[objpos:, 1],
+               label=df2.loc[objpos:, 'color'],
+               marker='*', s=300, color='k', alpha=0.5, lw=1)
+    for txt in list(range(objpos, len(pos))):
+        ax.text(pos[txt, 0], pos[txt, 1], f'{prefix}: {txt}', c='#000000')
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    fig.savefig(path)
+    return path
+
+
+def _render(res, path, prefix):
+    try:
+        render_mds(res, path, prefix)
+        logging.info(f'MDS plot written: {path}')
+    except BaseException as err:
+        logging.error(err)
+    return path
+
+
+def submit_render(res, path, prefix='PT'):
+    """
+    Render the MDS chart on a background thread, off the request path.
+
+    Returns
+    -------
+    out : concurrent.futures.Future
+        Resolves to the output file.
+    """
+    global executor_
+    if executor_ is None:
+        executor_ = ThreadPoolExecutor(max_workers=1, thread_name_prefix='render')
+    return executor_.submit(_render, res, path, prefix)
@@ -0,0 +1,172 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+segment module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Zero copy segmentation of the time domain signals.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import os
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from phm.modules import metrics, utils
+from phm.vibration import cluster
+
+
+def segment_view(sig, chunksize=20480, hop=None):
+    """
+    This function exposes a signal as overlapped or adjacent segments without copy.
+    Parameters
+    ----------
+    sig : 1-D array
+        Time domain signal.
+    chunksize : int, optional
+        Sample points of each segment.
+    hop : int, optional
+        Distance between the start of two segments, default is `chunksize`.
+        A hop less than `chunksize` gives overlapped segments.
+    Returns
+    -------
+    A tuple, `(view, tail)`
+        View is a read only (n_segments, chunksize) view of `sig`, tail is
+        the remaining points starting at the next hop, shorter than chunksize.
+    """
+    sig = np.asarray(sig)
+    hop = chunksize if hop is None else hop
+    if hop <= 0:
+        raise ValueError(f'Hop should be positive, got {hop}.')
+    if len(sig) < chunksize:
+        return np.empty((0, chunksize), dtype=sig.dtype), sig
+    view = sliding_window_view(sig, chunksize)[::hop]
+    return view, sig[len(view) * hop:]
+
+
+class Segments:
+    """
+    Segments of many files, kept as views of the loaded signals.
+
+    Segment order is file order, within a file the full segments come first
+    and the tail (if longer than `minlen`) at last, the same order as slicing
+    `de[subset: subset + chunksize]` in a loop. `files` and `ages` map each
+    segment to its file index and its ordinal within the file.
+    """
+
+    # Constructor
+    def __init__(self, chunksize=20480, hop=None, minlen=2048):
+        self.chunksize_ = chunksize
+        self.hop_ = chunksize if hop is None else hop
+        self.minlen_ = minlen
+        self.names = []
+        self.blocks_ = []       # (view, tail) of each file, tail may be None
+        self.files = np.empty(0, dtype=np.int64)
+        self.ages = np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.files)
+
+    @property
+    def agelist(self):
+        """Segment counts of each file."""
+        return np.bincount(self.files, minlength=len(self.names)).tolist()
+
+    def append(self, name, sig):
+        """
+        Append the segments of one signal, return the segment counts.
+        """
+        view, tail = segment_view(sig, self.chunksize_, self.hop_)
+        tail = tail if len(tail) > self.minlen_ else None  # some segment is too short and should be drop out.
+        cnts = len(view) + (tail is not None)
+        self.files = np.concatenate([self.files, np.full(cnts, len(self.names), dtype=np.int64)])
+        self.ages = np.concatenate([self.ages, np.arange(cnts, dtype=np.int64)])
+        self.names.append(name)
+        self.blocks_.append((view, tail))
+        return cnts
+
+    def segments(self):
+        """
+        Iterate all segments in order, each one is a view of the signal.
+        """
+        for view, tail in self.blocks_:
+            yield from view
+            if tail is not None:
+                yield tail
+
+    def spectrum(self, samplerate, nperseg, dtype=np.float64):
+        """
+        Transform all the segments by `cluster.welch_batch`, one call per view.
+
+        Returns
+        -------
+        A tuple, `(frequencies, spectrum)`
+            Spectrum is a (n_segments, nperseg // 2 + 1) array in segment order.
+        """
+        fre = np.fft.rfftfreq(nperseg, 1 / samplerate)
+        out = np.empty((len(self), len(fre)), dtype=dtype)
+        pos = 0
+        with metrics.Stage('fft', segments=len(self)) as st:
+            for view, tail in self.blocks_:
+                for block in (view, None if tail is None else tail[None, :]):
+                    if block is None or len(block) == 0:
+                        continue
+                    _, out[pos: pos + len(block)] = cluster.welch_batch(block, samplerate, nperseg, dtype)
+                    st.add(nbytes=block.nbytes)
+                    pos += len(block)
+        return fre, out
+
+
+def load_segments(files, path, chunksize=20480, minlen=2048, hop=None, sidecar=False):
+    """
+    Load data files and segment the drive end signal of each one.
+
+    Parameters
+    ----------
+    files : list
+        Data file names.
+    path : string
+        Directory of the data files, ends with '/'.
+    chunksize : int, optional
+        Sample points of each segment.
+    minlen : int, optional
+        Tail segments not longer than `minlen` are dropped, often the window
+        size of the fft.
+    hop : int, optional
+        Distance between the start of two segments, default is `chunksize`.
+    sidecar : bool, optional
+        Load through the float32 sidecars, see `utils.load_dat`.
+
+    Returns
+    -------
+    out : Segments
+        Segments of all files.
+    """
+    segs = Segments(chunksize, hop, minlen)
+    for item in files:
+        with metrics.Stage('load') as st:
+            (de, fe) = utils.load_dat(item, path, sidecar=sidecar)
+            st.add(nbytes=os.path.getsize(f'{path}{item}'))
+        with metrics.Stage('segment', nbytes=de.nbytes) as st:
+            count = len(segs)
+            segs.append(item, de)
+            st.add(segments=len(segs) - count)
+    return segs
@@ -0,0 +1,176 @@
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+
+"""
+=========================
+streaming module
+=========================
+
+An illustration of the rotation machine health model by viberation metric.
+Welch spectrum of recordings larger than memory, read block by block.
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import os
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from phm.modules import metrics, utils
+from phm.vibration import cluster, segment
+
+
+class StreamingWelch:
+    """
+    Welch estimate of a whole stream, the running average of the
+    periodograms of its `nperseg` windows (half overlapped, as
+    `scipy.signal.welch` by default).
+
+    Only the last window is kept between blocks, the result equals the welch
+    of the concatenated stream up to floating point rounding.
+
+    Examples
+    --------
+    >>> est = StreamingWelch(20480, 2048)
+    >>> for de, fe in utils.iter_dat(file, path):
+    ...     est.update(de)
+    >>> fre, psd = est.result()
+    """
+
+    # Constructor
+    def __init__(self, samplerate, nperseg, dtype=np.float64):
+        self.samplerate_ = samplerate
+        self.nperseg_ = nperseg
+        self.step_ = nperseg - nperseg // 2
+        self.dtype_ = dtype
+        self.buf_ = np.empty(0, dtype=dtype)
+        self.sum_ = np.zeros(nperseg // 2 + 1, dtype=np.float64)
+        self.count_ = 0
+
+    def update(self, block):
+        """
+        Add the periodograms of the windows completed by `block`.
+        """
+        buf = np.concatenate([self.buf_, np.asarray(block, dtype=self.dtype_)])
+        if len(buf) >= self.nperseg_:
+            frames = sliding_window_view(buf, self.nperseg_)[::self.step_]
+            _, psd = cluster.welch_batch(frames, self.samplerate_, self.nperseg_, self.dtype_)
+            self.sum_ += psd.sum(axis=0)
+            self.count_ += len(frames)
+            buf = buf[len(frames) * self.step_:]
+        self.buf_ = buf.copy()  # drops the reference to the consumed block
+        return self.count_
+
+    def result(self):
+        """
+        Returns
+        -------
+        A tuple, `(frequencies, psd)`
+
+        Raises
+        ------
+        ValueError
+            If the stream is shorter than `nperseg`.
+        """
+        if self.count_ == 0:
+            raise ValueError(f'Stream of {len(self.buf_)} points is shorter than nperseg {self.nperseg_}.')
+        fre = np.fft.rfftfreq(self.nperseg_, 1 / self.samplerate_)
+        return fre, (self.sum_ / self.count_).astype(self.dtype_)
+
+
+class StreamingSegments:
+    """
+    Spectrum of the segments of a stream as the blocks arrive, the same
+    segments and rows as `segment.Segments.spectrum` of the whole signal.
+
+    A segment is transformed by `cluster.welch_batch` once all its points
+    arrived, so the rows are identical to the batch ones. At most one
+    segment and one block are kept in memory.
+    """
+
+    # Constructor
+    def __init__(self, samplerate, nperseg, chunksize=20480, hop=None, minlen=None, dtype=np.float64):
+        self.samplerate_ = samplerate
+        self.nperseg_ = nperseg
+        self.chunksize_ = chunksize
+        self.hop_ = chunksize if hop is None else hop
+        self.minlen_ = nperseg if minlen is None else minlen
+        self.dtype_ = dtype
+        self.buf_ = np.empty(0)
+        self.base_ = 0      # stream position of `buf_[0]`
+        self.next_ = 0      # stream position of the next segment
+        self.count_ = 0     # segments transformed
+
+    def update(self, block):
+        """
+        Returns
+        -------
+        out : 2-D array
+            (n, nperseg // 2 + 1) spectrum of the segments completed by
+            `block`, n may be 0.
+        """
+        buf = np.concatenate([self.buf_, block]) if len(self.buf_) > 0 else np.asarray(block)
+        skip = min(self.next_ - self.base_, len(buf))  # points before the next segment if hop > chunksize
+        buf = buf[skip:]
+        self.base_ += skip
+        view, tail = segment.segment_view(buf, self.chunksize_, self.hop_)
+        out = np.empty((0, self.nperseg_ // 2 + 1), dtype=self.dtype_)
+        if len(view) > 0:
+            _, out = cluster.welch_batch(view, self.samplerate_, self.nperseg_, self.dtype_)
+            self.next_ = self.base_ + len(view) * self.hop_
+            self.count_ += len(view)
+        used = min(len(view) * self.hop_, len(buf))
+        self.buf_ = buf[used:].copy()  # drops the reference to the consumed block
+        self.base_ += used
+        return out
+
+    def finish(self):
+        """
+        Returns
+        -------
+        out : 2-D array
+            Spectrum of the tail segment, if longer than `minlen`.
+        """
+        tail = self.buf_
+        self.buf_ = np.empty(0)
+        if len(tail) <= self.minlen_:
+            return np.empty((0, self.nperseg_ // 2 + 1), dtype=self.dtype_)
+        self.count_ += 1
+        _, out = cluster.welch_batch(tail[None, :], self.samplerate_, self.nperseg_, self.dtype_)
+        return out
+
+
+def stream_spectrum(file, path, samplerate=20480, nperseg=2048, chunksize=20480, hop=None, sidecar=False,
+                    block=utils.BLOCK):
+    """
+    Spectrum of the drive end signal of a data file read in blocks, equal to
+    `ingest.file_spectrum` but the memory is bounded by `block` and
+    `chunksize` points instead of the file size.
+
+    Returns
+    -------
+    out : 2-D array
+        (n_segments, nperseg // 2 + 1) spectrum of the file.
+    """
+    est = StreamingSegments(samplerate, nperseg, chunksize, hop, nperseg)
+    rows = []
+    with metrics.Stage('stream', nbytes=os.path.getsize(f'{path}{file}')) as st:
+        for de, fe in utils.iter_dat(file, path, block, sidecar=sidecar):
+            rows.append(est.update(de))
+        rows.append(est.finish())
+        st.add(segments=est.count_)
+    return np.concatenate(rows)
@@ -25,9 +25,15 @@
 # License: MIT
 
 import json
+import threading
+import numpy as np
 import multiprocessing as mul
+import phm.modules.jobqueue as jobqueue
+import phm.modules.metrics as metrics
 import phm.modules.mqttworker as mqttworker
 import phm.modules.restworker as restworker
+import phm.modules.scheduler as scheduler
+import phm.modules.sharedarray as sharedarray
 import phm.phm as phm
 import logging
 from phm import BENCHPATH
@@ -41,8 +47,7 @@ def setup_mqtt(process, param):
 
     (chB, chA) = mul.Pipe()
     if process:
-        process.terminate()
-        process.join()
+        stop_mqtt(process)
     process = mul.Process(target=mqttworker.proc_mqtt, args=(chB, tk, hst, pt))
     process.start()
     process.chanel = lambda: None
@@ -50,52 +55,116 @@ def setup_mqtt(process, param):
     return process, chA
 
 
-# 计算指标并推送
-def compute_publish(process, channel, param):
+# subscribe to the wave files of a device, each one is scored on arrival
+def setup_subscriber(process, param):
+    (chB, chA) = mul.Pipe()
+    if process:
+        stop_mqtt(process)
+    process = mul.Process(target=mqttworker.proc_subscribe,
+                          args=(chB, param['token'], param['host'], param['port'], param['topic'], BENCHPATH))
+    process.start()
+    process.chanel = lambda: None
+    setattr(process.chanel, 'channel', chA)
+    return process
+
+
+# stop mqtt process after its buffered points are published
+def stop_mqtt(process, timeout=30):
+    try:
+        process.chanel.channel.send('stop')
+        process.join(timeout)
+    except BrokenPipeError:
+        pass
+    if process.is_alive():
+        process.terminate()
+        process.join()
+
+
+# 推送计算结果，大的结果经共享内存传递，管道只传描述
+def publish(process, channel, retidx):
+    msg = None
     try:
         if process:
-            # retidx = compute_indicator(param)
-            retidx = phm.calculate_mds_indicator(param, BENCHPATH)
             if retidx:
-                for item in retidx:
-                    mds = {"ts": item['ts'], "values": {"MDS": item['MDS']}}
-                    channel.send(json.dumps(mds))
+                # MDS is the json of each row or None, a large batch of them travels in one shared block.
+                msg = sharedarray.pack({'ts': np.array([item['ts'] for item in retidx], dtype=np.int64),
+                                        'MDS': [item['MDS'] for item in retidx]})
+                channel.send(json.dumps(msg))
         else:
             logging.info('Mqtt connectoin should be set and cache firstly.')
     except BrokenPipeError as be:
         logging.error(f'compute_publish to mqtt error.')
+        if msg is not None:
+            sharedarray.release_packed(msg)
     return
 
 
 if __name__ == "__main__":
+    # stage metrics of all processes are merged by the restful service
+    metrics.METRICSDIR = '.cache/metrics/'
     # prepare communication channels
     (endRE_B, endRE_A) = mul.Pipe()
     # init restful service
     rest_p = mul.Process(target=restworker.proc_rest, args=(endRE_B,))
     rest_p.start()
-    # prepare mqtt service
-    mqtt_p = None
-    endMQ_A = None
+    # prepare compute workers
+    jobs = jobqueue.CoalescingJobQueue(workers=jobqueue.WORKERS)
+    # prepare mqtt service, results are published from the job callbacks
+    mqtt = {'process': None, 'channel': None}
+    lock = threading.Lock()
+    # subscriber process of each device
+    subscribers = {}
+    # periodic evaluation of the scheduled devices from their watermarks
+    sched = None
+
+    def on_done(jobids, retidx):
+        with lock:
+            publish(mqtt['process'], mqtt['channel'], retidx)
+
     while True:
         data = endRE_A.recv()
         obj = json.loads(data)
         cmd = obj['command']
-        if cmd == 'comboindicator':  # 根据观测值计算健康评估指标
+        if cmd == 'comboindicator':  # 根据观测值计算健康评估指标，同一设备的重叠时间窗口合并计算
             reconnect = obj['reconnectmqtt']
-            if reconnect:
-                (mqtt_p, endMQ_A) = setup_mqtt(mqtt_p, obj)
-            compute_publish(mqtt_p, endMQ_A, obj)
+            if reconnect or mqtt['process'] is None:
+                with lock:
+                    (mqtt['process'], mqtt['channel']) = setup_mqtt(mqtt['process'], obj)
+            jobs.submit(obj['jobid'], phm.calculate_mds_indicator, obj, BENCHPATH, callback=on_done)
+        elif cmd == 'fleetindicator':  # 多设备健康评估指标，结果由任务接口查询
+            jobs.submit(obj['jobid'], phm.calculate_fleet_indicator, obj, BENCHPATH)
         elif cmd == 'setupmqtt':  # 建立MQTT通道
-            (mqtt_p, endMQ_A) = setup_mqtt(mqtt_p, obj)
-            logging.info('Mqtt channel is set.', mqtt_p, endMQ_A)
+            with lock:
+                (mqtt['process'], mqtt['channel']) = setup_mqtt(mqtt['process'], obj)
+            logging.info(f'Mqtt channel is set: {mqtt["process"]}')
+        elif cmd == 'subscribe':  # 订阅波形文件，到达即计算并推送
+            key = (obj['host'], obj['port'], obj['token'])
+            subscribers[key] = setup_subscriber(subscribers.get(key), obj)
+            logging.info(f'Mqtt subscriber is set: {subscribers[key]}')
+        elif cmd == 'unsubscribe':
+            key = (obj['host'], obj['port'], obj['token'])
+            if key in subscribers:
+                stop_mqtt(subscribers.pop(key))
+        elif cmd == 'schedule':  # 周期评估多个设备，只计算水位线之后的新数据
+            if sched is None:
+                sched = scheduler.Scheduler(phm.calculate_fleet_indicator, BENCHPATH)
+                sched.start()
+            for entityid, token in zip(obj['entityids'], obj['tokens']):
+                sched.add(dict(obj, entityid=entityid, token=token), obj['interval'])
+        elif cmd == 'unschedule':
+            for entityid in obj['entityids'] if sched else []:
+                sched.remove(scheduler.device_key(dict(obj, entityid=entityid)))
         elif cmd == 'kill':
             logging.info(obj)
             break
         else:  # 异常情况
-            if mqtt_p:
-                endMQ_A.send('stop')
-                mqtt_p.join()
-                mqtt_p = None
             break
 
+    jobs.shutdown(wait=cmd != 'kill')
+    if mqtt['process']:
+        stop_mqtt(mqtt['process'])
+    for process in subscribers.values():
+        stop_mqtt(process)
+    if sched:
+        sched.shutdown(wait=cmd != 'kill')
     logging.info('Main loop terminated, service exit.')
@@ -23,12 +23,72 @@
 # Author: Awen <26896225@qq.com>
 # License: MIT
 
+import os
+import sys
 import json
+import time
+import base64
+import functools
+import hashlib
+import threading
+import multiprocessing as mul
 import logging
 import unittest
 import shutil
+import subprocess
+import tempfile
+import numpy as np
+import pandas as pd
+import phm as phm_package
 import phm.phm as phm
+from phm.modules import download, iotclient, jobqueue, metrics, mqttworker, publisher, resultcache, scheduler, \
+    sharedarray, subscriber, wavecache
+from phm.vibration import baseline
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from tests import main as service
+from tests.test_vibration import write_ims
+
+IMPORTBUDGET = {                    # cold import seconds of the service processes
+    'phm.modules.mqttworker': 0.5,  # respawned on each request with reconnectmqtt
+    'phm.modules.restworker': 2.0,  # fastapi and pydantic take most of it
+    'phm.phm': 1.0,                 # the model, numpy and requests take most of it
+}
+
+
+def fake_indicator(param):
+    """MDS rows of a window every 10 minutes, slow enough to be coalesced."""
+    time.sleep(0.5)
+    st, et = jobqueue.window_ms(param)
+    return [{'ts': ts, 'MDS': param['entityid']} for ts in range(st, et + 1, 600000)]
+
+
+def fake_fleet(param, bp, since=None):
+    """MDS rows every 10 minutes of each device newer than its mark, None at the `fail` timestamps."""
+    st, et = (round(datetime.strptime(param[key], '%Y-%m-%dT%X').timestamp() * 1000) for key in ('stime', 'etime'))
+    out = {}
+    for dev in param['entityids']:
+        start = st if since.get(dev) is None else max(st, since[dev] + 1)
+        out[dev] = [{'ts': ts, 'MDS': None if ts in param.get('fail', []) else dev}
+                    for ts in range(-(-start // 600000) * 600000, et + 1, 600000)]
+    return out
+
+
+def copy_remote(remote, url, local):
+    """`download.download_file` from the local directory `remote`, by the file name of the url."""
+    src = os.path.join(remote, os.path.basename(url))
+    if not os.path.isfile(src):
+        return 404
+    os.makedirs(os.path.dirname(local), exist_ok=True)
+    shutil.copyfile(src, local)
+    return 200
+
+
+def shared_sum(pipe):
+    """Sum of the array of a descriptor, read in another process."""
+    pipe.send(float(sharedarray.load(pipe.recv()).sum()))
 
 
 class TestPhm(unittest.TestCase):
@@ -36,27 +96,404 @@ class TestPhm(unittest.TestCase):
 
     def setUp(self):
         """Set up test fixtures, if any."""
+        self.tmp_ = tempfile.mkdtemp()  # cache and store of the tests, never the working tree
 
     def tearDown(self):
         """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp_, True)
 
     def test_retrieve_url_file(self):
         """Test phm.retrieve_url_file."""
+        cache = os.path.join(self.tmp_, 'data/')
         # 1. OK condition file is there or can be download there
         ret = phm.retrieve_url_file('http://192.168.101.19:20080/archive/1st_test/1st_test/2003.10.23.05.04.13',
-                                    '.cache/data/')
+                                    cache)
         self.assertTrue(ret == 200 or ret == -2)
         # 2. BAD URL
         ret = phm.retrieve_url_file('http://192.168.101.19:20080/archive/1st_test/1st_test/',
-                                    '.cache/data/')
+                                    cache)
         self.assertTrue(ret == -3)
         # 3. New directory
-        td = './tmp/'
+        td = os.path.join(self.tmp_, 'tmp/')
         phm.mkdir_p(td)    # test phm function
         shutil.rmtree(td)
         ret = phm.retrieve_url_file('http://192.168.101.19:20080/archive/1st_test/1st_test/2003.10.23.05.04.13', td)
         self.assertTrue(ret, 200)
 
+    def test_fetch_wave_files(self):
+        """Test wavecache.WaveCache.fetch downloading concurrently from a local http server."""
+        tmp = tempfile.mkdtemp()
+        handler = functools.partial(SimpleHTTPRequestHandler, directory=tmp)
+        httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            for idx in range(4):
+                with open(os.path.join(tmp, f'wave{idx}'), 'wb') as f:
+                    f.write(os.urandom(200000 + idx))
+            base = f'http://127.0.0.1:{httpd.server_port}/'
+            urls = [f'{base}wave{idx}' for idx in range(4)] + [f'{base}missing']
+            td = os.path.join(tmp, 'cache/')
+            cache = wavecache.WaveCache(td)
+            fns = cache.fetch(urls, workers=3)
+            self.assertEqual([fns[url] for url in urls], [wavecache.WaveCache.key(url) for url in urls[:4]] + [None])
+            for idx in range(4):
+                with open(os.path.join(tmp, f'wave{idx}'), 'rb') as f1, open(f'{td}{fns[urls[idx]]}', 'rb') as f2:
+                    self.assertEqual(f1.read(), f2.read())
+            self.assertEqual(os.listdir(os.path.join(td, '.part')), [])
+            with mock.patch.object(download, 'download_file', side_effect=AssertionError):
+                self.assertEqual(cache.fetch(urls[:1])[urls[0]], fns[urls[0]])  # cached, not downloaded again
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+            shutil.rmtree(tmp)
+
+    def test_wave_cache(self):
+        """Test wavecache.WaveCache eviction and sharing."""
+        tmp = tempfile.mkdtemp()
+
+        def download_file(url, local):
+            with open(local, 'wb') as f:
+                f.write(b'0' * 100)
+            return 200
+
+        try:
+            cache = wavecache.WaveCache(f'{tmp}/', maxbytes=250)
+            with mock.patch.object(download, 'download_file', side_effect=download_file):
+                fns = cache.fetch(['http://a/1', 'http://a/2'])
+                self.assertEqual(fns['http://a/1'], wavecache.WaveCache.key('http://a/1'))
+                cache.get('http://a/1')  # 2 is the least recently used now.
+                cache.fetch(['http://a/3'])
+            self.assertIsNone(cache.get('http://a/2'))
+            self.assertFalse(os.path.exists(os.path.join(tmp, fns['http://a/2'])))
+            # index is persisted, a new instance sees the same entries.
+            cache = wavecache.WaveCache(f'{tmp}/', maxbytes=250, maxage=-1)
+            self.assertIsNotNone(cache.get('http://a/1'))
+            cache.evict()
+            self.assertIsNone(cache.get('http://a/1'))
+            # processes sharing the path merge their entries, files evicted by another one are fetched again.
+            first = wavecache.WaveCache(f'{tmp}/', maxbytes=1000)
+            second = wavecache.WaveCache(f'{tmp}/', maxbytes=1000)
+            with mock.patch.object(download, 'download_file', side_effect=download_file) as m:
+                first.fetch(['http://a/1'])
+                second.fetch(['http://a/2'])
+                self.assertEqual(sorted(wavecache.WaveCache(f'{tmp}/').entries_),
+                                 sorted(wavecache.WaveCache.key(url) for url in ['http://a/1', 'http://a/2']))
+                os.unlink(os.path.join(tmp, wavecache.WaveCache.key('http://a/1')))
+                self.assertIsNone(first.get('http://a/1'))
+                self.assertIsNotNone(first.fetch(['http://a/1'])['http://a/1'])
+                self.assertEqual(m.call_count, 3)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_result_cache(self):
+        """Test resultcache.ResultCache with sqlite backing."""
+        tmp = tempfile.mkdtemp()
+        try:
+            dbpath = os.path.join(tmp, 'results.db')
+            cache = resultcache.ResultCache(dbpath, maxitems=1)
+            cache.put('a', np.arange(3))
+            cache.put('b', '{"pos_x": {}}')
+            self.assertNotIn('a', cache.items_)  # evicted from memory, kept in sqlite.
+            np.testing.assert_array_equal(resultcache.ResultCache(dbpath).get('a'), np.arange(3))
+            self.assertIsNone(cache.get('c'))
+            with open(os.path.join(tmp, 'wave'), 'wb') as f:
+                f.write(b'123')
+            self.assertEqual(cache.file_hash(os.path.join(tmp, 'wave')), hashlib.sha1(b'123').hexdigest())
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_mqtt_publisher(self):
+        """Test publisher.MqttPublisher batching."""
+        class Client:
+            def __init__(self):
+                self.payloads = []
+                self.on_publish = None
+
+            def publish(self, topic, payload, qos):
+                self.payloads.append(json.loads(payload))
+                self.on_publish(self, None, len(self.payloads))  # acknowledged at once.
+                return mock.Mock(rc=0, mid=len(self.payloads))
+
+        client = Client()
+        for name in ('username_pw_set', 'max_inflight_messages_set', 'connect', 'loop_start', 'loop_stop',
+                     'disconnect'):
+            setattr(client, name, mock.Mock())
+        with mock.patch.object(publisher.mqtt, 'Client', return_value=client):
+            pub = publisher.MqttPublisher('token', '127.0.0.1', interval=3600, batchsize=10, inflight=2)
+            pub.publish(json.dumps([{'ts': ts, 'values': {'MDS': ts}} for ts in range(15)]))
+            self.assertEqual(len(client.payloads), 1)  # a full batch is sent, the rest is buffered.
+            time.sleep(0.2)
+            self.assertEqual(len(client.payloads), 1)  # acknowledgements do not flush before the interval.
+            self.assertEqual(len(pub.points_), 5)
+            pub.publish({'ts': 15, 'values': {'MDS': 15}})
+            pub.publish({'MDS': 16})
+            pub.close()
+        self.assertEqual([len(el) for el in client.payloads], [10, 7])
+        self.assertEqual([el['ts'] for el in client.payloads[0] + client.payloads[1][:-1]], list(range(16)))
+        self.assertEqual(client.payloads[1][-1]['values'], {'MDS': 16})
+        self.assertEqual(pub.latency()['count'], 2)
+
+    def test_mqtt_subscriber(self):
+        """Test subscriber.MqttSubscriber hands each new wave file to the model."""
+        self.assertEqual(subscriber.wave_rows(b'{"ts": 1, "values": {"wave_url": "a", "MDS": 1}}'),
+                         [{'ts': 1, 'wave_url': 'a'}])
+        self.assertEqual(subscriber.wave_rows('[{"ts": 2, "values": {"wave_url": "b"}}, {"ts": 3, "values": {}}]'),
+                         [{'ts': 2, 'wave_url': 'b'}])
+        self.assertEqual(subscriber.wave_rows('{"wave_url": "c"}')[0]['wave_url'], 'c')  # attribute update
+        self.assertEqual(subscriber.wave_rows('{"deleted": ["wave_url"]}'), [])
+        self.assertEqual(subscriber.wave_rows('not json'), [])
+
+        client = mock.Mock()
+        handled = []
+        done = threading.Event()
+
+        def handler(rows):
+            handled.append([el['wave_url'] for el in rows])
+            if 'd' in handled[-1]:
+                done.set()
+
+        with mock.patch.object(subscriber.mqtt, 'Client', return_value=client):
+            sub = subscriber.MqttSubscriber('token', '127.0.0.1', handler, topics=['t1', 't2'])
+            sub._on_connect(client, None, {}, 0)
+            self.assertEqual(client.subscribe.call_args_list, [mock.call('t1', 1), mock.call('t2', 1)])
+            for payload in ['{"wave_url": "a"}', '{"wave_url": "a"}', '[{"ts": 1, "values": {"wave_url": "d"}}]']:
+                sub._on_message(client, None, mock.Mock(payload=payload))
+            self.assertTrue(done.wait(5))
+            sub.close()
+        self.assertEqual(sum(handled, []), ['a', 'd'])  # the redelivered url is dropped.
+
+        pub = mock.Mock()
+        daemon = mqttworker.MqttSubDaemon.__new__(mqttworker.MqttSubDaemon)
+        daemon.publisher_, daemon.subscriber_, daemon.pipe_ = pub, None, None
+        daemon.scorer_ = lambda rows: [{'ts': el['ts'], 'MDS': None if el['wave_url'] == 'x' else '{}'} for el in rows]
+        daemon.score([{'ts': 1, 'wave_url': 'a'}, {'ts': 2, 'wave_url': 'x'}])
+        pub.publish.assert_called_once_with([{'ts': 1, 'values': {'MDS': '{}'}}])
+        daemon.publisher_ = None
+
+    def test_scheduler(self):
+        """Test scheduler.Scheduler scores only telemetry newer than the watermarks."""
+        tmp = tempfile.mkdtemp()
+        dbpath = os.path.join(tmp, 'watermarks.db')
+        published = []
+        acked = [True]
+
+        def publish(param, rows):
+            published.append((param['entityid'], [el['ts'] for el in rows]))
+            return acked[0]
+
+        sched = scheduler.Scheduler(fake_fleet, 'bench', publish, dbpath, lookback=3600000)
+        try:
+            param = {'iot': 'iot', 'entitytype': 'DEVICE', 'keys': 'wave_url', 'obj': 'MDS'}
+            a = sched.add(dict(param, entityid='a'), interval=60)
+            b = sched.add(dict(param, entityid='b'), interval=60)
+            now = 1209600000  # on a 10 minutes boundary
+            out = sched.tick(now)
+            self.assertEqual(sorted(out), sorted([a, b]))
+            self.assertEqual(len(out[a]), 7)  # the lookback window
+            self.assertEqual(sched.store_.get(a), now * 1000)
+            self.assertEqual(sched.tick(now + 30), {})  # not due yet
+            published.clear()
+            out = sched.tick(now + 600)
+            self.assertEqual(sorted(published), [('a', [(now + 600) * 1000]), ('b', [(now + 600) * 1000])])
+
+            # a failing wave file holds the watermark, then it is skipped.
+            sched.remove(b)
+            sched.add(dict(param, entityid='a', fail=[(now + 1200) * 1000]), interval=60)
+            for idx in range(scheduler.RETRIES - 1):
+                self.assertEqual(sched.tick(now + 1800 + idx * 60)[a], [])
+                self.assertEqual(sched.store_.get(a), (now + 600) * 1000)
+            self.assertEqual([el['ts'] for el in sched.tick(now + 1800 + 120)[a]], [(now + 1800) * 1000])
+            self.assertEqual(sched.store_.get(a), (now + 1800) * 1000)
+
+            # the watermark moves only once the publish is acknowledged.
+            acked[0] = False
+            sched.tick(now + 2400)
+            self.assertEqual(sched.store_.get(a), (now + 1800) * 1000)
+            acked[0] = True
+            self.assertEqual(len(sched.tick(now + 2460)[a]), 1)
+
+            store = scheduler.WatermarkStore(dbpath)  # persisted
+            self.assertEqual(store.get(a), (now + 2400) * 1000)
+            store.advance(a, 0)
+            self.assertEqual(store.get(a), (now + 2400) * 1000)
+            self.assertIsNone(store.get(b + 'x'))
+        finally:
+            sched.shutdown()
+            shutil.rmtree(tmp)
+
+    def test_job_queue(self):
+        """Test jobqueue.JobQueue."""
+        tmp = tempfile.mkdtemp()
+        try:
+            dbpath = os.path.join(tmp, 'jobs.db')
+            store = jobqueue.JobStore(dbpath)
+            queue = jobqueue.JobQueue(dbpath, workers=2)
+            ok, bad = store.create({'command': 'sum'}), store.create({'command': 'int'})
+            self.assertEqual(store.get(ok)['status'], jobqueue.QUEUED)
+            results = {}
+            queue.submit(ok, sum, [np.int64(1), 2], callback=results.__setitem__)
+            queue.submit(bad, int, 'x', callback=results.__setitem__)
+            queue.shutdown()
+            self.assertEqual(results, {ok: 3})
+            self.assertEqual(store.get(ok, result=True)['result'], 3)
+            self.assertEqual(store.get(bad)['status'], jobqueue.FAILED)
+            self.assertIn('ValueError', store.get(bad)['error'])
+            self.assertIsNone(store.get('unknown'))
+
+            # the connection of a store is shared by the threads of a process.
+            def use_store(idx):
+                jobid = store.create({'command': idx})
+                store.start(jobid)
+                store.finish(jobid, idx)
+                return store.get(jobid, result=True)['result']
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                self.assertEqual(list(executor.map(use_store, range(200))), list(range(200)))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_coalescing_job_queue(self):
+        """Test jobqueue.CoalescingJobQueue merging the windows of a device."""
+        tmp = tempfile.mkdtemp()
+        try:
+            dbpath = os.path.join(tmp, 'jobs.db')
+            store = jobqueue.JobStore(dbpath)
+            queue = jobqueue.CoalescingJobQueue(dbpath, workers=1)
+            param = {'iot': 'iot', 'entitytype': 'DEVICE', 'entityid': 'dev-1', 'keys': 'wave_url', 'obj': 'MDS'}
+            windows = [('2008-05-03T21:00:00', '2008-05-03T22:00:00'),   # runs at once
+                       ('2008-05-03T21:10:00', '2008-05-03T21:20:00'),   # covered by the running one
+                       ('2008-05-03T23:00:00', '2008-05-04T01:00:00'),   # waits for the worker
+                       ('2008-05-04T00:30:00', '2008-05-04T02:00:00')]   # merged with the waiting one
+            calls = []
+            jobids = [store.create({}) for el in windows]
+            for jobid, (st, et) in zip(jobids, windows):
+                queue.submit(jobid, fake_indicator, dict(param, stime=st, etime=et),
+                             callback=lambda ids, ret: calls.append((ids, len(ret))))
+            queue.submit(store.create({}), fake_indicator, dict(param, entityid='dev-2', stime=st, etime=et))
+            queue.shutdown()
+            self.assertEqual([el[0] for el in calls], [jobids[:2], jobids[2:]])  # two evaluations for dev-1.
+            for jobid, (st, et) in zip(jobids, windows):
+                rows = store.get(jobid, result=True)['result']
+                lo, hi = jobqueue.window_ms({'stime': st, 'etime': et})
+                self.assertEqual([el['ts'] for el in rows], list(range(lo, hi + 1, 600000)))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_metrics(self):
+        """Test metrics.Stage and the prometheus exposition."""
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'metrics/')
+            with mock.patch.object(metrics, 'METRICSDIR', path), mock.patch.object(metrics, 'stats_', {}), \
+                    mock.patch.object(metrics, 'dumped_', None), mock.patch.object(metrics, 'DUMPINTERVAL', 3600):
+                with metrics.Stage('load') as st:
+                    st.add(nbytes=100, segments=2)
+                    with metrics.Stage('fft', segments=2):
+                        pass
+                    self.assertFalse(os.path.exists(path))  # written when the outermost stage ends.
+                metrics.Stage('fft')(sum)([1, 2])
+                with open(f'{path}{os.getpid()}.json') as f:
+                    self.assertEqual(json.load(f)['fft']['calls'], 1)  # at most once per interval.
+                with open(f'{path}1.json', 'w') as f:  # another process
+                    json.dump({'fft': {'calls': 3, 'seconds': 1.0, 'segments': 5, metrics.PEAK: 1}}, f)
+                stats = metrics.collect()
+                self.assertEqual(stats['load']['calls'], 1)
+                self.assertEqual(stats['load']['bytes'], 100)
+                self.assertEqual(stats['fft']['calls'], 5)
+                self.assertEqual(stats['fft']['segments'], 7)
+                self.assertGreater(stats['fft'][metrics.PEAK], 1)
+                text = metrics.exposition()
+                self.assertIn('# TYPE phm_stage_seconds_total counter', text)
+                self.assertIn('phm_stage_calls_total{stage="fft"} 5', text)
+            # the last snapshot is written when the process exits.
+            code = (f'from phm.modules import metrics; metrics.METRICSDIR = {path!r}; metrics.DUMPINTERVAL = 3600\n'
+                    'for idx in range(3):\n    metrics.Stage("exit")(sum)([1, 2])')
+            subprocess.run([sys.executable, '-c', code], check=True)
+            self.assertEqual(metrics.collect(path)['exit']['calls'], 3)
+            with mock.patch.object(metrics, 'PROFILEDIR', os.path.join(tmp, 'profiles/')):
+                self.assertEqual(metrics.run_profiled('job', sum, [1, 2]), 3)
+                self.assertEqual(len(os.listdir(os.path.join(tmp, 'profiles/'))), 1)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_shared_array(self):
+        """Test sharedarray descriptors between processes."""
+        spectra = np.random.rand(64, 1025)
+        desc = sharedarray.share(spectra)
+        self.assertLess(len(json.dumps(desc)), 200)
+        parent, child = mul.Pipe()
+        proc = mul.Process(target=shared_sum, args=(child,))
+        proc.start()
+        parent.send(desc)
+        self.assertAlmostEqual(parent.recv(), spectra.sum())
+        proc.join()
+        with self.assertRaises(FileNotFoundError):  # freed by the reader
+            sharedarray.load(desc)
+
+        msg = sharedarray.pack({'ts': np.arange(10000, dtype=np.int64), 'pos': np.array([.5, 1.5])})
+        self.assertIn('shm', msg['frame']['ts'])
+        self.assertEqual(msg['frame']['pos'], {'data': [.5, 1.5]})  # small arrays are inlined
+        cols = sharedarray.unpack(json.loads(json.dumps(msg)))
+        np.testing.assert_array_equal(cols['ts'], np.arange(10000))
+        self.assertEqual(mqttworker.frame_points('[{"ts": 1}]'), [{'ts': 1}])
+        sharedarray.release_packed(sharedarray.pack({'x': np.zeros(10)}, threshold=0))
+        texts = ['{"pos_x": {"0": 1.5}}', None, 'ü' * 10]
+        desc = sharedarray.share_texts(texts)
+        self.assertEqual(sharedarray.load_texts(json.loads(json.dumps(desc))), texts)
+        msg = sharedarray.pack({'MDS': texts}, threshold=10)
+        self.assertIn('shm', msg['frame']['MDS'])
+        self.assertEqual(sharedarray.unpack_lists(msg)['MDS'], texts)
+        self.assertEqual(sharedarray.pack({'MDS': texts})['frame']['MDS'], {'data': texts})  # small ones inline
+
+        # rows of calculate_mds_indicator, MDS is a json string or None, from the main loop to the mqtt process.
+        tmp = tempfile.mkdtemp()
+        try:
+            bench = os.path.join(tmp, 'baseline/')
+            remote = os.path.join(tmp, 'remote/')
+            os.makedirs(bench)
+            os.makedirs(remote)
+            for idx in range(3):
+                write_ims(bench, f'2003.10.22.12.0{idx}.00', 20480 * 10, idx)
+            write_ims(remote, '2004.02.12.10.32.39', 20480, 3)
+            df = pd.DataFrame({'ts': [1, 2], 'wave_url': ['http://127.0.0.1/2004.02.12.10.32.39',
+                                                          'http://127.0.0.1/missing']})
+            param = {'iot': 'iot', 'usr': 'usr', 'pwd': 'pwd', 'entitytype': 'DEVICE', 'entityid': 'dev',
+                     'keys': 'wave_url', 'obj': 'MDS', 'stime': '2008-05-03T21:00:00', 'etime': '2008-05-03T22:00:00'}
+            wrap = functools.partial(phm.wrap_mds, cachepath=os.path.join(tmp, 'data/'),
+                                     storepath=os.path.join(tmp, 'store/'))
+            with mock.patch.object(download, 'download_file', side_effect=functools.partial(copy_remote, remote)), \
+                    mock.patch.object(phm, 'get_iot_data', return_value=df), mock.patch.object(phm, 'wrap_mds', wrap):
+                retidx = phm.calculate_mds_indicator(param, bench)
+            self.assertIsInstance(retidx[0]['MDS'], str)
+            self.assertIsNone(retidx[1]['MDS'])
+            parent, child = mul.Pipe()
+            with mock.patch.object(sharedarray, 'THRESHOLD', 0):  # the json and the timestamps go through shared memory
+                service.publish(True, parent, retidx)
+            msg = json.loads(child.recv())
+            self.assertIn('shm', msg['frame']['ts'])
+            self.assertIn('shm', msg['frame']['MDS'])
+            self.assertLess(len(json.dumps(msg)), 200)  # only the descriptors are on the pipe
+            self.assertEqual(mqttworker.frame_points(msg), [{'ts': 1, 'values': {'MDS': retidx[0]['MDS']}},
+                                                            {'ts': 2, 'values': {'MDS': None}}])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_import_budget(self):
+        """Test the service modules import fast and without the heavy packages."""
+        for module, budget in IMPORTBUDGET.items():
+            code = f'import sys, {module}; print(" ".join(sys.modules))'
+            out = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True,
+                                 check=True)
+            loaded = set(el.split('.')[0] for el in out.stdout.split())
+            self.assertEqual(loaded & set(phm_package.LAZY), set(), module)
+            if module.endswith('mqttworker'):
+                self.assertNotIn('numpy', loaded)
+            # import time: self [us] | cumulative [us] | module
+            cumulative = [int(el.split('|')[1]) for el in out.stderr.splitlines() if el.endswith(f'| {module}')]
+            self.assertLess(cumulative[0] / 1e6, budget, module)
+        self.assertAlmostEqual(publisher.percentile([1., 2., 3., 4.], 50), np.percentile([1., 2., 3., 4.], 50))
+        self.assertAlmostEqual(publisher.percentile([1., 2., 5.], 99), np.percentile([1., 2., 5.], 99))
+
     def test_mqtt_publish(self):
         """Test phm.mqtt_publish."""
         # 本测试案例要求先推送一个文件wave_url到iot，按照要求的时间和设备号
@@ -93,17 +530,133 @@ class TestPhm(unittest.TestCase):
         df = phm.get_iot_data(iot, usr, pwd, entitytype, entityid, keys, st, et)
         self.assertTrue(len(df) > 0)
 
+    def test_wrap_mds(self):
+        """Test phm.wrap_mds with local wave files."""
+        tmp = tempfile.mkdtemp()
+        try:
+            bench = os.path.join(tmp, 'baseline/')
+            cache = os.path.join(tmp, 'data/')
+            remote = os.path.join(tmp, 'remote/')
+            os.makedirs(bench)
+            os.makedirs(cache)
+            os.makedirs(remote)
+            for idx in range(3):
+                write_ims(bench, f'2003.10.22.12.0{idx}.00', 20480 * 10, idx)
+            write_ims(remote, '2004.02.12.10.32.39', 20480, 3)
+            write_ims(remote, '2004.02.12.10.42.39', 20480 * 2, 4)
+            df = pd.DataFrame({'ts': [1, 2, 3],
+                               'wave_url': ['http://127.0.0.1/2004.02.12.10.32.39',
+                                            'http://127.0.0.1/2004.02.12.10.42.39',
+                                            'http://127.0.0.1/2004.02.12.10.32.39']})
+
+            download_file = functools.partial(copy_remote, remote)
+
+            with mock.patch.object(download, 'download_file', side_effect=download_file) as m:
+                ret = phm.wrap_mds(df, bench, cache, os.path.join(tmp, 'store/'))
+                self.assertEqual(m.call_count, 2)  # each url is retrieved once.
+            self.assertEqual([item['ts'] for item in ret], [1, 2, 3])
+            shapes = [list(json.loads(item['MDS'])['shape'].values()) for item in ret]
+            self.assertEqual(shapes[0], [0] * 30 + [1])
+            self.assertEqual(shapes[1], [0] * 30 + [1, 1])
+            self.assertEqual(ret[0]['MDS'], ret[2]['MDS'])
+            # the json of a wave file does not depend on the other files of its batch.
+            devs = [set(list(json.loads(item['MDS'])['dev'].values())[30:]) for item in ret]
+            self.assertEqual(devs, [{3}] * 3)
+            fn = wavecache.get_cache(cache).fetch(['http://127.0.0.1/2004.02.12.10.42.39'])[
+                'http://127.0.0.1/2004.02.12.10.42.39']
+            res = phm.mds_pipeline(bench, cache, os.path.join(tmp, 'store/'), objfiles=[fn])
+            self.assertEqual(phm.mds_json(res, fn), ret[1]['MDS'])
+            # overlapping window is answered from the result cache.
+            with mock.patch.object(phm, 'mds_pipeline', side_effect=AssertionError):
+                self.assertEqual(phm.wrap_mds(df, bench, cache, os.path.join(tmp, 'store/')), ret)
+            # a wave file arriving by mqtt is scored alone.
+            with mock.patch.object(download, 'download_file', side_effect=download_file):
+                rows = [{'ts': 4, 'wave_url': 'http://127.0.0.1/2004.02.12.10.32.39'}]
+                self.assertEqual(phm.score_waves(rows, bench, cache, os.path.join(tmp, 'store/')),
+                                 [{'ts': 4, 'MDS': ret[0]['MDS']}])
+            self.assertEqual(phm.score_waves([], bench), [])
+            # the subscriber process loads the baseline once, not for each arrival.
+            store = phm.load_store(bench, os.path.join(tmp, 'store/'))
+            with mock.patch.object(download, 'download_file', side_effect=download_file), \
+                    mock.patch.object(baseline.BaselineStore, 'load', side_effect=AssertionError):
+                self.assertEqual(phm.score_waves(rows, bench, cache, os.path.join(tmp, 'store/'), store=store),
+                                 [{'ts': 4, 'MDS': ret[0]['MDS']}])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_calculate_fleet_indicator(self):
+        """Test phm.calculate_fleet_indicator scoring all devices in one pass."""
+        tmp = tempfile.mkdtemp()
+        try:
+            bench = os.path.join(tmp, 'baseline/')
+            cache = os.path.join(tmp, 'data/')
+            remote = os.path.join(tmp, 'remote/')
+            for dirname in (bench, cache, remote):
+                os.makedirs(dirname)
+            for idx in range(3):
+                write_ims(bench, f'2003.10.22.12.0{idx}.00', 20480 * 10, idx)
+            for idx in range(3):
+                write_ims(remote, f'2004.02.12.10.{idx}2.39', 20480, 3 + idx)
+            urls = [f'http://127.0.0.1/2004.02.12.10.{idx}2.39' for idx in range(3)]
+            dfs = {'dev-1': pd.DataFrame({'ts': [1, 2], 'wave_url': urls[:2]}),
+                   'dev-2': pd.DataFrame({'ts': [1], 'wave_url': urls[2:]}),
+                   'dev-3': None}
+            param = {'iot': 'iot', 'usr': 'usr', 'pwd': 'pwd', 'entitytype': 'DEVICE', 'keys': 'wave_url',
+                     'obj': 'MDS', 'stime': '2008-05-03T21:00:00', 'etime': '2008-05-03T22:00:00',
+                     'entityids': ['dev-1', 'dev-2', 'dev-3', 'dev-1']}
+
+            download_file = functools.partial(copy_remote, remote)
+
+            with mock.patch.object(download, 'download_file', side_effect=download_file), \
+                    mock.patch.object(phm, 'get_iot_data', side_effect=lambda *args: dfs[args[4]]), \
+                    mock.patch.object(phm, 'mds_pipeline', wraps=phm.mds_pipeline) as m:
+                ret = phm.calculate_fleet_indicator(param, bench, cache, os.path.join(tmp, 'store/'))
+                self.assertEqual(m.call_count, 1)  # all devices in one pass.
+            self.assertEqual(sorted(ret), ['dev-1', 'dev-2', 'dev-3'])
+            self.assertIsNone(ret['dev-3'])
+            self.assertEqual([item['ts'] for item in ret['dev-1']], [1, 2])
+            shapes = [list(json.loads(item['MDS'])['shape'].values()) for item in ret['dev-1'] + ret['dev-2']]
+            self.assertEqual(shapes, [[0] * 30 + [1]] * 3)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_iter_timeseries(self):
+        """Test iotclient.IotClient paging and token reuse."""
+        points = {'wave_url': [{'ts': ts, 'value': f'http://127.0.0.1/{ts}'} for ts in range(0, 60000, 10)],
+                  'MDS': [{'ts': ts, 'value': '{}'} for ts in range(0, 60000, 20)]}
+        exp = base64.urlsafe_b64encode(json.dumps({'exp': time.time() + 3600}).encode()).decode()
+        session = mock.Mock()
+        session.post.return_value.json.return_value = {'token': f'h.{exp}.s'}
+
+        def get(url, headers, params, timeout):
+            lo, hi, limit = int(params['startTs']), int(params['endTs']), int(params['limit'])
+            body = {key: [el for el in vals if lo <= el['ts'] <= hi][:limit] for key, vals in points.items()}
+            return mock.Mock(status_code=200, json=mock.Mock(return_value=body))
+
+        session.get.side_effect = get
+        with mock.patch.object(download, 'get_session', return_value=session):
+            client = iotclient.IotClient('127.0.0.1:8090', 'usr', 'pwd')
+            frames = list(client.iter_frames('DEVICE', 'dev', 'wave_url,MDS', 0, 59999, slice_ms=30000, limit=1000))
+            df = pd.concat(frames, ignore_index=True)
+            self.assertEqual(list(df['ts']), list(range(0, 60000, 20)))  # nothing truncated, inner join on ts.
+            self.assertEqual(list(df.columns), ['ts', 'wave_url', 'MDS'])
+            client.get_timeseries('DEVICE', 'dev', 'wave_url', 0, 10)
+            self.assertEqual(session.post.call_count, 1)  # token is reused.
+            points.pop('wave_url')  # a device with MDS history only.
+            self.assertIsNone(phm.get_iot_data('127.0.0.1:8090', 'usr', 'pwd', 'DEVICE', 'dev', 'wave_url,MDS', 0,
+                                               59999))
+
     def test_cwru(self):
         """Test phm.get_iot_data."""
         param = 'http://192.168.101.19:8000/fault/105.mat'
         bpath = '../../phm-model/hvac/data/baseline/'
-        df = phm.fre2mds(param, bpath)
+        df = phm.fre2mds(param, bpath, os.path.join(self.tmp_, 'data/'), os.path.join(self.tmp_, 'store/'))
 
     def test_ims(self):
         """Test phm.get_iot_data."""
         param = 'http://192.168.101.19:8000/2004.04.01.00.01.57'
         bpath = '../data/'
-        df = phm.fre2mds(param, bpath)
+        df = phm.fre2mds(param, bpath, os.path.join(self.tmp_, 'data/'), os.path.join(self.tmp_, 'store/'))
 
 
 if __name__ == "__main__":
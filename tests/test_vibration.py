@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# Copyright 2021 The CASICloud Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+# pylint: disable=invalid-name
+# pylint: disable=missing-docstring
+"""旋转机械健康管理模型.
+振动分析单元测试模块, 使用本地生成的数据, 不依赖网络环境.
+
+"""
+
+# Author: Awen <26896225@qq.com>
+# License: MIT
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from unittest import mock
+from scipy import signal
+from sklearn.metrics import euclidean_distances
+from phm.modules import utils
+from phm.vibration import baseline, cluster, ingest, mds, render, segment, streaming
+from benchmarks import synthetic
+
+
+def write_ims(path, name, points, seed):
+    """Write an IMS like text file, 8 channels separated by tab."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(points) / 20480
+    sig = np.sin(2 * np.pi * 236 * t)[:, None] + 0.1 * rng.standard_normal((points, 8))
+    np.savetxt(os.path.join(path, name), sig, fmt='%.3f', delimiter='\t')
+
+
+class TestVibration(unittest.TestCase):
+    """Tests for `phm.vibration` package."""
+
+    def setUp(self):
+        """Set up test fixtures, if any."""
+        self.tmp_ = tempfile.mkdtemp()
+        self.bench_ = os.path.join(self.tmp_, 'baseline/')
+        self.store_ = os.path.join(self.tmp_, 'store/')
+        os.makedirs(self.bench_)
+        write_ims(self.bench_, '2003.10.22.12.06.24', 20480 * 2 + 4096, 0)
+        write_ims(self.bench_, '2003.10.22.12.09.13', 20480 * 2, 1)
+
+    def tearDown(self):
+        """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp_)
+
+    def test_welch_batch(self):
+        """Test cluster.welch_batch and cluster.ts2fft."""
+        rng = np.random.default_rng(0)
+        datumn = list(rng.standard_normal((4, 20480))) + [rng.standard_normal(4096)]
+        fre, spec = cluster.ts2fft(datumn, 20480, 2048)
+        self.assertEqual(spec.shape, (5, 1025))
+        self.assertTrue(spec.flags['C_CONTIGUOUS'])
+        for idx, sig in enumerate(datumn):
+            _, amp = signal.welch(sig, fs=20480, scaling='density', nperseg=2048)
+            np.testing.assert_allclose(spec[idx], amp)
+        _, spec32 = cluster.welch_batch(np.stack(datumn[:4]), 20480, 2048, np.float32)
+        self.assertEqual(spec32.dtype, np.float32)
+        np.testing.assert_allclose(spec32, spec[:4], rtol=1e-4)
+        with self.assertRaises(ValueError):
+            cluster.welch_batch(np.zeros((2, 1024)), 20480, 2048)
+        with self.assertRaises(ValueError):  # a short segment is an error, not an empty spectrum.
+            cluster.ts2fft(datumn + [rng.standard_normal(1024)], 20480, 2048)
+
+    def test_synthetic(self):
+        """Test the fault harmonics of the synthetic benchmark data."""
+        sig = synthetic.bearing_signal(20480, 1.0, 'outer', 2, rng=np.random.default_rng(0))
+        self.assertEqual(sig.shape, (20480, 8))
+        fre, spec = cluster.welch_batch(sig.T.copy(), 20480, 8192)
+        peak = np.argmin(np.abs(fre - synthetic.FAULTS['outer']))
+        self.assertGreater(spec[4, peak], 100 * spec[0, peak])  # only the faulty bearing carries it.
+        healthy = synthetic.bearing_signal(20480, 0.0, 'outer', 2, rng=np.random.default_rng(0))
+        self.assertLess(healthy.std(), sig.std())
+        names = synthetic.make_dataset(self.tmp_, 2, 4096, seed=1)
+        self.assertEqual(len(names), 6)
+        self.assertEqual(utils.load_dat(names[0], f'{self.tmp_}/')[0].shape, (4096,))
+
+    def test_segment_view(self):
+        """Test segment.segment_view and segment.Segments."""
+        sig = np.arange(10.)
+        view, tail = segment.segment_view(sig, 4)
+        np.testing.assert_array_equal(view, [[0, 1, 2, 3], [4, 5, 6, 7]])
+        np.testing.assert_array_equal(tail, [8, 9])
+        self.assertTrue(np.shares_memory(view, sig))
+        view, tail = segment.segment_view(sig, 4, hop=2)
+        self.assertEqual(view.shape, (4, 4))
+        np.testing.assert_array_equal(tail, [8, 9])
+
+        segs = segment.Segments(chunksize=4, minlen=1)
+        segs.append('a', sig)
+        segs.append('b', np.arange(3.))
+        self.assertEqual(segs.agelist, [3, 1])
+        np.testing.assert_array_equal(segs.files, [0, 0, 0, 1])
+        np.testing.assert_array_equal(segs.ages, [0, 1, 2, 0])
+        self.assertEqual([len(seg) for seg in segs.segments()], [4, 4, 2, 3])
+
+    def test_load_dat(self):
+        """Test utils.load_dat with and without sidecar."""
+        name = '2003.10.22.12.09.13'
+        (de, fe) = utils.load_dat(name, self.bench_)
+        self.assertIsInstance(de, np.ndarray)
+        self.assertEqual(de.shape, (20480 * 2,))
+        self.assertIsNone(utils.load_sidecar(name, self.bench_))
+        (de32, fe32) = utils.load_dat(name, self.bench_, sidecar=True)
+        self.assertTrue(os.path.isfile(utils.sidecar_path(name, self.bench_)))
+        with mock.patch.object(utils, 'load_csv', side_effect=AssertionError):
+            (de32, fe32) = utils.load_dat(name, self.bench_, sidecar=True)
+        self.assertEqual(de32.dtype, np.float32)
+        np.testing.assert_allclose(de32, de, rtol=1e-6)
+        np.testing.assert_allclose(fe32, fe, rtol=1e-6)
+        # 2nd and 3rd IMS tests have 4 channels only
+        np.savetxt(os.path.join(self.bench_, '2004.02.12.10.32.39'), np.ones((10, 4)), delimiter='\t')
+        (de, fe) = utils.load_dat('2004.02.12.10.32.39', self.bench_)
+        np.testing.assert_array_equal(de, np.ones(10))
+
+    def test_ingest_files(self):
+        """Test ingest.ingest_files on a process pool."""
+        files = sorted(os.listdir(self.bench_))
+        fre, spec, agelist = ingest.ingest_spectrum(files, self.bench_)
+        fre2, spec2, agelist2 = ingest.ingest_spectrum(files, self.bench_, workers=2)
+        self.assertEqual(agelist, [3, 2])
+        self.assertEqual(agelist2, agelist)
+        np.testing.assert_array_equal(spec2, spec)
+        self.assertEqual([item for item, _ in ingest.ingest_files(files, self.bench_, workers=2)], files)
+
+    def test_streaming(self):
+        """Test streaming spectra equal the batch ones, block by block."""
+        rng = np.random.default_rng(0)
+        sig = rng.standard_normal(20480 * 3 + 5000)
+        for chunksize, hop in [(20480, None), (20480, 5000), (4096, 8000)]:
+            segs = segment.Segments(chunksize, hop, 2048)
+            segs.append('a', sig)
+            _, ref = segs.spectrum(20480, 2048)
+            for block in [1000, 30000, len(sig)]:
+                est = streaming.StreamingSegments(20480, 2048, chunksize, hop)
+                rows = [est.update(sig[i: i + block]) for i in range(0, len(sig), block)] + [est.finish()]
+                self.assertLessEqual(len(est.buf_), chunksize + block)
+                np.testing.assert_array_equal(np.concatenate(rows), ref)
+        est = streaming.StreamingWelch(20480, 2048)
+        with self.assertRaises(ValueError):
+            est.result()
+        for i in range(0, len(sig), 3333):
+            est.update(sig[i: i + 3333])
+        self.assertLess(len(est.buf_), 2048)
+        _, ref = signal.welch(sig, fs=20480, nperseg=2048)
+        np.testing.assert_allclose(est.result()[1], ref, rtol=1e-12)
+
+        name = '2003.10.22.12.06.24'
+        blocks = list(utils.iter_dat(name, self.bench_, block=5000))
+        self.assertEqual([len(de) for de, fe in blocks], [5000] * 9 + [20480 * 2 + 4096 - 45000])
+        np.testing.assert_array_equal(np.concatenate([de for de, fe in blocks]), utils.load_dat(name, self.bench_)[0])
+        ref = ingest.file_spectrum(name, self.bench_)
+        np.testing.assert_array_equal(streaming.stream_spectrum(name, self.bench_, block=5000), ref)
+        with mock.patch.object(ingest, 'STREAMBYTES', 0):
+            np.testing.assert_array_equal(ingest.file_spectrum(name, self.bench_), ref)
+        # the sidecar is written while streaming, then mapped.
+        list(utils.iter_dat(name, self.bench_, block=5000, sidecar=True))
+        np.testing.assert_array_equal(streaming.stream_spectrum(name, self.bench_, sidecar=True, block=5000),
+                                      ingest.file_spectrum(name, self.bench_, sidecar=True))
+        self.assertIsNotNone(utils.load_sidecar(name, self.bench_))
+
+    def test_place_mds_pos(self):
+        """Test mds.place_mds_pos against the fitted baseline."""
+        rng = np.random.default_rng(0)
+        centers = rng.standard_normal((3, 16)) * 10
+        vectors = np.concatenate([c + rng.standard_normal((20, 16)) for c in centers])
+        model = mds.fit_mds_model(vectors)
+        pos = mds.place_mds_pos(model, vectors[[0, 25, 50]])
+        for idx, el in zip([0, 25, 50], pos):
+            nearest = np.argmin(np.linalg.norm(model['pos'] - el, axis=1))
+            self.assertEqual(nearest // 20, idx // 20)  # lands in its own cluster
+        path = os.path.join(self.tmp_, 'mds.npz')
+        mds.save_mds_model(model, path, 'v1')
+        self.assertIsNone(mds.load_mds_model(path, 'v2'))
+        np.testing.assert_array_equal(mds.load_mds_model(path, 'v1')['pos'], model['pos'])
+
+    def test_compute_mds_pos(self):
+        """Test the mds embedding backends."""
+        rng = np.random.default_rng(0)
+        centers = rng.standard_normal((3, 16)) * 10
+        vectors = np.concatenate([c + rng.standard_normal((40, 16)) for c in centers])
+        dis = euclidean_distances(vectors)
+        np.testing.assert_allclose(mds.blocked_distances(vectors, block=32, workers=2), dis, rtol=1e-4, atol=1e-3)
+        np.testing.assert_allclose(mds.blocked_distances(vectors[:5], vectors, dtype=np.float64), dis[:5], atol=1e-6)
+
+        def stress(pos):
+            return np.sqrt(((dis - euclidean_distances(pos)) ** 2).sum() / (dis ** 2).sum())
+
+        np.random.seed(0)
+        exact = stress(mds.compute_mds_pos(vectors, 'exact'))
+        self.assertLess(stress(mds.compute_mds_pos(vectors, 'smacof', block=32, workers=2)), exact * 1.05)
+        pos = mds.compute_mds_pos(vectors, 'landmark', landmarks=30, block=32, workers=2)
+        self.assertEqual(pos.shape, (120, 2))
+        self.assertLess(stress(pos), exact * 1.5)
+        # near identical spectra never yield the same landmark twice.
+        same = np.repeat(centers, 100, axis=0) + rng.standard_normal((300, 16)) * 1e-6
+        idx = mds.pick_landmarks(same, 50)
+        self.assertEqual(len(np.unique(idx)), 50)
+        self.assertEqual(sorted(idx[:3] // 100), [0, 1, 2])  # the distinct spectra come first.
+        self.assertEqual(len(np.unique(mds.pick_landmarks(vectors, 500))), 120)
+        self.assertEqual(mds.mds_backend(10), 'smacof')  # 'exact' is a reference only.
+        self.assertEqual(mds.mds_backend(120), 'smacof')
+        self.assertEqual(mds.mds_backend(mds.SMACOFMAX + 1), 'landmark')
+
+    def test_predict_clusters(self):
+        """Test cluster.predict_clusters with a saved model."""
+        rng = np.random.default_rng(0)
+        centers = rng.standard_normal((2, 16)) * 10
+        vectors = np.concatenate([c + rng.standard_normal((30, 16)) for c in centers])
+        path = os.path.join(self.tmp_, 'hdbscan.pkl')
+        cluster.save_cluster_model(cluster.fit_cluster_model(vectors), path, 'v1')
+        self.assertIsNone(cluster.load_cluster_model(path, 'v2'))
+        clusterer = cluster.load_cluster_model(path, 'v1')
+        labels, strengths = cluster.predict_clusters(clusterer, centers)
+        np.testing.assert_array_equal(labels, clusterer.labels_[[0, 30]])
+        self.assertTrue(np.all(strengths > 0))
+        df = cluster.cluster_frame(np.concatenate([clusterer.labels_, labels]))
+        self.assertEqual(sum(len(vecs) for vecs in df['vectors']), 62)
+
+    def test_render_mds(self):
+        """Test render.render_mds without display."""
+        rng = np.random.default_rng(0)
+        labels = np.array([0] * 6 + [1] * 6 + [-1] * 2)
+        df2 = pd.DataFrame({'dev': [0] * 12 + [1] * 2, 'age': range(14), 'color': '#000000'})
+        res = {'pos': rng.standard_normal((14, 2)), 'df2': df2, 'dfnew': cluster.cluster_frame(labels),
+               'objpos': 12, 'agelist': [6, 6, 2]}
+        path = os.path.join(self.tmp_, 'plot', 'mds.png')
+        self.assertEqual(render.submit_render(res, path).result(), path)
+        self.assertTrue(os.path.getsize(path) > 0)
+
+    def test_baseline_store(self):
+        """Test baseline.BaselineStore."""
+        fre, spec, agelist = baseline.BaselineStore(self.bench_, self.store_).load()
+        self.assertEqual(agelist, [3, 2])
+        self.assertEqual(spec.shape, (5, len(fre)))
+        (de, fe) = utils.load_dat('2003.10.22.12.06.24', self.bench_)
+        datumn = [de[subset: subset + 20480] for subset in range(0, len(de), 20480)]
+        _, expected = cluster.ts2fft(datumn, 20480, 2048)
+        np.testing.assert_allclose(spec[:3], expected)
+
+        # unchanged baseline is reloaded without reading any data file
+        with mock.patch.object(utils, 'load_dat', side_effect=AssertionError) as m:
+            fre2, spec2, agelist2 = baseline.BaselineStore(self.bench_, self.store_).load()
+            self.assertEqual(m.call_count, 0)
+        np.testing.assert_array_equal(spec, spec2)
+
+        # only the new file is read
+        write_ims(self.bench_, '2003.10.22.12.14.13', 20480, 2)
+        with mock.patch.object(utils, 'load_dat', wraps=utils.load_dat) as m:
+            store = baseline.BaselineStore(self.bench_, self.store_)
+            fre3, spec3, agelist3 = store.load()
+            self.assertEqual(m.call_count, 1)
+        self.assertEqual(agelist3, [3, 2, 1])
+        np.testing.assert_array_equal(spec3[:5], spec)
+        self.assertEqual(store.files[-1], '2003.10.22.12.14.13')
+
+
+if __name__ == "__main__":
+    unittest.main()